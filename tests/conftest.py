@@ -0,0 +1,37 @@
+#   --- Turms ---
+#   Test setup. Application modules import each
+#   other as top level modules from turms directory.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import configparser
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "turms"))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """ Run every test in its own directory, since application keeps
+    configuration, logs and downloads relative to working directory. """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def config(workdir):
+    """ Default configuration in working directory. Returns function
+    setting 'TURMS' section values, f.e. config(AllowUpload="True"). """
+    from config import Config, CFG_FILE_NAME
+    Config.create_config()
+
+    def set_values(**values):
+        parser = configparser.ConfigParser()
+        parser.read(CFG_FILE_NAME)
+        parser["TURMS"].update(values)
+        with open(CFG_FILE_NAME, "w") as f:
+            parser.write(f)
+    return set_values
@@ -0,0 +1,91 @@
+import os
+
+import encrypt
+from blob_store import BlobStore
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def create_store(workdir):
+    os.makedirs("content")
+    return BlobStore("content", "blobs", workers=2)
+
+
+def test_duplicates_share_writable_blob(workdir):
+    store = create_store(workdir)
+    write("content/a", b"same data")
+    write("content/b", b"same data")
+    write("content/c", b"other data")
+    os.chmod("content/a", 0o640)
+    os.chmod("content/b", 0o640)
+    store.import_content()
+
+    assert os.stat("content/a").st_ino == os.stat("content/b").st_ino
+    assert os.stat("content/a").st_ino != os.stat("content/c").st_ino
+    assert os.stat("content/b").st_mode & 0o777 == 0o640
+    assert store.checksum("a") == store.checksum("b")
+
+
+def test_unchanged_blob_is_not_hashed_again(workdir, monkeypatch):
+    store = create_store(workdir)
+    hashed = []
+    checksum = encrypt.get_file_checksum
+
+    def get_file_checksum(f):
+        hashed.append(f.name)
+        return checksum(f)
+    monkeypatch.setattr(encrypt, "get_file_checksum", get_file_checksum)
+
+    write("content/a", b"same data")
+    write("content/b", b"same data")
+    store.import_content()
+    # Both files and the new blob once, blob isn't verified again for the duplicate.
+    assert len(hashed) == 3
+
+    hashed.clear()
+    write("content/c", b"same data")
+    BlobStore("content", "blobs").import_content()
+    assert hashed == [os.path.join("content", "c")]
+
+
+def test_blob_modified_in_place_is_not_reused(workdir):
+    store = create_store(workdir)
+    write("content/a", b"original")
+    store.import_content()
+    digest = store.lookup("a")["hash"]
+
+    with open("content/a", "ab") as f:
+        f.write(b" appended")
+
+    # New file with the original content must keep it.
+    write("content/b", b"original")
+    store.import_content()
+
+    assert read("content/b") == b"original"
+    assert store.lookup("b")["hash"] == digest
+    assert read(store.blob_path(digest)) == b"original"
+    assert read("content/a") == b"original appended"
+    assert store.lookup("a")["hash"] != digest
+    assert store.checksum("a") == encrypt.get_checksum(b"original appended")
+
+
+def test_changed_file_is_imported_again(workdir):
+    store = create_store(workdir)
+    write("content/a", b"first")
+    store.import_content()
+    first = store.checksum("a")
+
+    os.remove("content/a")
+    write("content/a", b"second version")
+    store.import_content()
+
+    assert store.checksum("a") not in (None, first)
+    assert not os.path.exists(store.blob_path(first.hex()))
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+import tornado.httpclient
+from tornado.httputil import HTTPHeaders
+
+# Same import order as in application, modules import each other.
+import download_manager  # noqa: F401
+import connection_handler
+
+
+class Session:
+    """ Answers requests with given status codes in order """
+
+    def __init__(self, codes, retry_after="1"):
+        self.codes = list(codes)
+        self.retry_after = retry_after
+        self.requests = 0
+
+    async def fetch(self, request):
+        self.requests += 1
+        code = self.codes.pop(0)
+        response = tornado.httpclient.HTTPResponse(request, code,
+                                                   headers=HTTPHeaders({"Retry-After": self.retry_after}))
+        if code >= 400:
+            raise tornado.httpclient.HTTPClientError(code, response=response)
+        return response
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    """ Record waits instead of sleeping """
+    waited = []
+
+    async def sleep(seconds):
+        waited.append(seconds)
+    monkeypatch.setattr(connection_handler.asyncio, "sleep", sleep)
+    return waited
+
+
+def fetch(session):
+    handler = connection_handler.ConnectionHandler()
+    handler._ConnectionHandler__session = session
+    request = tornado.httpclient.HTTPRequest("https://127.0.0.1/")
+    return asyncio.run(handler.fetch(request))
+
+
+def test_retries_after_too_many_requests(waits):
+    session = Session([429, 429, 200], "2")
+    assert fetch(session).code == 200
+    assert session.requests == 3
+    assert waits == [2, 2]
+
+
+def test_gives_up_after_retries(waits):
+    session = Session([429] * (connection_handler.RATE_LIMIT_RETRIES + 1), "1000")
+    with pytest.raises(tornado.httpclient.HTTPClientError):
+        fetch(session)
+    assert waits == [connection_handler.MAX_RETRY_WAIT] * connection_handler.RATE_LIMIT_RETRIES
+
+
+def test_other_errors_are_not_retried(waits):
+    session = Session([503, 200])
+    with pytest.raises(tornado.httpclient.HTTPClientError):
+        fetch(session)
+    assert session.requests == 1
+    assert not waits
+
+
+class StoppingSession:
+    """ Stops transfer while body of response is being received """
+
+    def __init__(self, stop):
+        self.stop = stop
+
+    async def fetch(self, request):
+        self.stop()
+        # Tornado raises exception of streaming callback from fetch.
+        request.streaming_callback(b"body")
+
+
+@pytest.mark.parametrize("action, state", [("pause", download_manager.PAUSED),
+                                           ("cancel", download_manager.CANCELLED)])
+def test_stopped_transfer_is_not_failed(config, monkeypatch, action, state):
+    config(**{"LocalCache": "False", "BlockVerification": "False"})
+    errors = []
+    monkeypatch.setattr(download_manager.Logger, "error", lambda *args, **kwargs: errors.append(args))
+
+    async def download():
+        handler = connection_handler.ConnectionHandler()
+        manager = download_manager.DownloadManager(handler, None)
+        handler._ConnectionHandler__server_url = "https://127.0.0.1"
+        handler._ConnectionHandler__session = StoppingSession(lambda: getattr(manager, action)(transfer))
+
+        transfer = manager.enqueue("a.bin", "a.bin")
+        transfer.get_downloader().decrypt_param("password", "pw")
+        while transfer.get_state() == download_manager.ACTIVE:
+            await asyncio.sleep(0.01)
+        return transfer
+
+    transfer = asyncio.run(download())
+    assert transfer.get_state() == state
+    assert not errors
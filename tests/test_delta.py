@@ -0,0 +1,80 @@
+import io
+import os
+import random
+
+import pytest
+
+import delta
+
+
+def round_trip(old, new, block_size=delta.MIN_BLOCK_SIZE):
+    """ Rebuild new from old with delta, return rebuilt data and instructions """
+    signature = delta.create_signature(io.BytesIO(old), block_size)
+    encoder = delta.DeltaEncoder(signature, io.BytesIO(new), read_size=4096)
+    instructions = io.BytesIO()
+    encoder.encode(instructions)
+
+    output = io.BytesIO()
+    applier = delta.DeltaApplier(io.BytesIO(old), output, block_size)
+    data = instructions.getvalue()
+    # Instructions arrive in arbitrary pieces.
+    for i in range(0, len(data), 777):
+        applier.feed(data[i:i + 777])
+    applier.finish()
+    return output.getvalue(), data
+
+
+@pytest.fixture
+def old():
+    return random.Random(1).randbytes(50000)
+
+
+def test_unchanged_file_is_copied(old):
+    rebuilt, data = round_trip(old, old)
+    assert rebuilt == old
+    assert len(data) < 2 * delta.MIN_BLOCK_SIZE
+
+
+def test_changed_file(old):
+    new = old[:10000] + b"inserted" + old[10000:30000] + old[31000:] + b"appended"
+    rebuilt, data = round_trip(old, new)
+    assert rebuilt == new
+    assert len(data) < len(new) // 2
+
+
+def test_no_common_blocks(old):
+    new = random.Random(2).randbytes(20000)
+    rebuilt, _ = round_trip(old, new)
+    assert rebuilt == new
+
+
+def test_empty_signature_sends_literals(old):
+    rebuilt, data = round_trip(b"", old)
+    assert rebuilt == old
+    assert data.count(delta.OP_LITERAL) >= len(old) // delta.MAX_LITERAL
+
+
+def test_empty_file(old):
+    rebuilt, data = round_trip(old, b"")
+    assert rebuilt == b"" and data == b""
+
+
+@pytest.mark.parametrize("block_size", [0, delta.MIN_BLOCK_SIZE - 1, delta.MAX_BLOCK_SIZE + 1])
+def test_block_size_out_of_limits_is_refused(block_size):
+    with pytest.raises(ValueError):
+        delta.parse_signature(delta.SIGNATURE_HEADER.pack(block_size, 0))
+
+
+def test_truncated_stream_is_detected(old):
+    _, data = round_trip(b"", old)
+    applier = delta.DeltaApplier(io.BytesIO(), io.BytesIO(), delta.MIN_BLOCK_SIZE)
+    applier.feed(data[:-10])
+    with pytest.raises(ValueError):
+        applier.finish()
+
+
+def test_basis_size(old):
+    signature = delta.create_signature(io.BytesIO(old), delta.MIN_BLOCK_SIZE)
+    encoder = delta.DeltaEncoder(signature, io.BytesIO())
+    blocks = -(-len(old) // delta.MIN_BLOCK_SIZE)
+    assert encoder.basis_size() == blocks * delta.MIN_BLOCK_SIZE
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import random
+
+import pytest
+
+import downloader as downloader_module
+import encrypt
+from downloader import Downloader, FileChanged, WrongPassword
+
+
+@pytest.fixture
+def paused(config):
+    """ Download of first version paused after part of it was received """
+    downloader = Downloader("file.bin")
+    downloader.set_checksum(b"A" * 32)
+    downloader.set_filesize(3000)
+    downloader.write_to_file(b"a" * 2000)
+    downloader.pause()
+    return downloader
+
+
+def test_resume_same_version(paused):
+    paused.resume_at(paused.resume_offset())
+    paused.set_checksum(b"A" * 32)
+    paused.write_to_file(b"a" * 1000)
+    paused.pause()
+    with open("file.bin", "rb") as f:
+        assert f.read() == b"a" * 3000
+
+
+def test_resume_changed_version(paused):
+    paused.resume_at(paused.resume_offset())
+    with pytest.raises(FileChanged):
+        paused.set_checksum(b"B" * 32)
+    assert paused.has_changed()
+
+
+def test_changed_version_starts_over(paused):
+    paused.resume_at(paused.resume_offset())
+    with pytest.raises(FileChanged):
+        paused.set_checksum(b"B" * 32)
+
+    # Received part of the first version is thrown away.
+    paused.resume_at(0)
+    assert not paused.has_changed()
+    assert not paused.is_partial()
+    paused.set_checksum(b"B" * 32)
+    paused.write_to_file(b"b" * 3000)
+    paused.pause()
+    assert paused.get_checksum() == b"B" * 32
+    with open("file.bin", "rb") as f:
+        assert f.read() == b"b" * 3000
+
+
+@pytest.fixture
+def stream(config, monkeypatch):
+    """ Content encrypted with password 'pw' and encryptor it was encrypted with """
+    monkeypatch.setattr(encrypt, "derive_key", lambda bpass, salt: hashlib.sha256(bpass + salt).digest())
+    content = random.Random(3).randbytes(300000)
+    encryptor = encrypt.new_encryptor(b"pw", encrypt.CIPHER_GCM)
+    return content, encryptor, encryptor.encrypt(content) + encryptor.finalize()
+
+
+def receive(stream, password, pieces=10000):
+    """ Receive stream while key is derived in a thread """
+    content, encryptor, data = stream
+    downloader = Downloader("file.bin")
+    for key, value in (("password", password), ("salt", encryptor.get_salt()),
+                       ("iv", encryptor.get_iv()), ("cipher", encrypt.CIPHER_GCM)):
+        downloader.decrypt_param(key, value)
+
+    async def run():
+        downloader.derive_decryptor(encryptor.get_key_check())
+        assert downloader.decryptor_ready()
+        for i in range(0, len(data), pieces):
+            downloader.chunk_decrypt_and_write(data[i:i + pieces])
+        await downloader.decryptor_derived()
+        downloader.finish()
+    asyncio.run(run())
+    return downloader
+
+
+def test_chunks_are_held_while_key_is_derived(stream):
+    downloader = receive(stream, "pw")
+    assert downloader.is_authenticated()
+    with open("file.bin", "rb") as f:
+        assert f.read() == stream[0]
+
+
+def test_held_chunks_are_limited(stream, monkeypatch):
+    monkeypatch.setattr(downloader_module, "MAX_HELD", 50000)
+    receive(stream, "pw")
+    with open("file.bin", "rb") as f:
+        assert f.read() == stream[0]
+
+
+def test_wrong_password_found_from_key_check(stream):
+    with pytest.raises(WrongPassword):
+        receive(stream, "wrong")
+
+
+def test_compare_checksum():
+    content = random.Random(3).randbytes(200000)
+    with open("file.bin", "wb") as f:
+        f.write(content)
+    downloader = Downloader("file.bin")
+    downloader.set_checksum(hashlib.sha256(content).digest())
+    assert downloader.compare_checksum()
+    downloader.set_checksum(hashlib.sha256(b"other").digest())
+    assert not downloader.compare_checksum()
@@ -0,0 +1,133 @@
+import hashlib
+import random
+
+import pytest
+
+import encrypt
+
+
+@pytest.fixture(autouse=True)
+def fast_kdf(config, monkeypatch):
+    """ Full PBKDF2 takes a second per key, tests don't need that """
+    monkeypatch.setattr(encrypt, "derive_key", lambda bpass, salt: hashlib.sha256(bpass + salt).digest())
+
+
+@pytest.fixture
+def content():
+    return random.Random(2).randbytes(5 * 1000 + 123)
+
+
+def encrypt_stream(content, cipher, record_size=1000, piece=777):
+    encryptor = encrypt.StreamEncryptor(b"pw", cipher, record_size)
+    stream = bytearray()
+    for i in range(0, len(content), piece):
+        stream += encryptor.encrypt(content[i:i + piece])
+    stream += encryptor.finalize()
+    return encryptor, bytes(stream)
+
+
+def decrypt_stream(encryptor, stream, password=b"pw", piece=555, batch=2):
+    decryptor = encrypt.StreamDecryptor(password, encryptor.get_salt(), encryptor.get_iv(),
+                                        encryptor.get_cipher(), batch)
+    output = bytearray()
+    for i in range(0, len(stream), piece):
+        output += decryptor.decrypt(stream[i:i + piece])
+    output += decryptor.finalize()
+    return decryptor, bytes(output)
+
+
+@pytest.mark.parametrize("cipher", sorted(encrypt.AEAD_CIPHERS))
+def test_record_stream_round_trip(content, cipher):
+    encryptor, stream = encrypt_stream(content, cipher)
+    assert len(stream) == encrypt.stream_size(len(content), cipher, 1000)
+    decryptor, output = decrypt_stream(encryptor, stream)
+    assert output == content
+    assert decryptor.verify_key(encryptor.get_key_check())
+
+
+def test_empty_stream():
+    encryptor, stream = encrypt_stream(b"", encrypt.CIPHER_GCM)
+    assert decrypt_stream(encryptor, stream)[1] == b""
+
+
+def test_wrong_password_fails_key_check(content):
+    encryptor, stream = encrypt_stream(content, encrypt.CIPHER_GCM)
+    decryptor = encrypt.StreamDecryptor(b"other", encryptor.get_salt(), encryptor.get_iv())
+    assert not decryptor.verify_key(encryptor.get_key_check())
+    with pytest.raises(ValueError):
+        decryptor.decrypt(stream)
+        decryptor.finalize()
+
+
+def test_modified_record_fails(content):
+    encryptor, stream = encrypt_stream(content, encrypt.CIPHER_GCM)
+    stream = bytearray(stream)
+    stream[1500] ^= 1
+    with pytest.raises(ValueError):
+        decrypt_stream(encryptor, bytes(stream))
+
+
+def test_truncated_stream_fails(content):
+    encryptor, stream = encrypt_stream(content, encrypt.CIPHER_GCM)
+    # Cut at a record boundary, so only missing final record tells.
+    with pytest.raises(ValueError):
+        decrypt_stream(encryptor, stream[:2 * (1000 + encrypt.RECORD_OVERHEAD)])
+
+
+def test_reordered_records_fail(content):
+    encryptor, stream = encrypt_stream(content, encrypt.CIPHER_GCM)
+    size = 1000 + encrypt.RECORD_OVERHEAD
+    swapped = stream[size:2 * size] + stream[:size] + stream[2 * size:]
+    with pytest.raises(ValueError):
+        decrypt_stream(encryptor, swapped)
+
+
+def test_cfb_round_trip(content):
+    encryptor = encrypt.new_encryptor(b"pw", encrypt.CIPHER_CFB)
+    stream = encryptor.encrypt(content) + encryptor.finalize()
+    decryptor = encrypt.new_decryptor(b"pw", encryptor.get_salt(), encryptor.get_iv(), encrypt.CIPHER_CFB)
+    assert decryptor.decrypt(stream) + decryptor.finalize() == content
+    assert decryptor.verify_key(encryptor.get_key_check())
+
+
+def test_negotiate_cipher():
+    allowed = [encrypt.CIPHER_GCM, encrypt.CIPHER_CFB]
+    assert encrypt.negotiate_cipher("chacha20-poly1305, aes-gcm", allowed) == encrypt.CIPHER_GCM
+    assert encrypt.negotiate_cipher(None, allowed) == encrypt.CIPHER_CFB
+    assert encrypt.negotiate_cipher("chacha20-poly1305", allowed) is None
+
+
+def test_overlong_record_fails_fast(content):
+    encryptor, stream = encrypt_stream(content, encrypt.CIPHER_GCM)
+    decryptor = encrypt.StreamDecryptor(b"pw", encryptor.get_salt(), encryptor.get_iv())
+    # Header alone claiming a huge record is rejected, nothing is buffered for it.
+    with pytest.raises(ValueError):
+        decryptor.decrypt(encrypt.RECORD_HEADER.pack(encrypt.MAX_RECORD_SIZE + 1))
+
+
+def test_record_size_limit():
+    with pytest.raises(ValueError):
+        encrypt.StreamEncryptor(b"pw", encrypt.CIPHER_GCM, encrypt.MAX_RECORD_SIZE + 1)
+
+
+def test_key_check_is_separate_from_content_key():
+    key = bytes(range(32))
+    check = encrypt.key_check(key)
+    assert len(check) == encrypt.KEY_CHECK_SIZE
+    assert check not in key
+    assert check != encrypt.key_check(bytes(32))
+
+
+@pytest.mark.parametrize("cipher", [encrypt.CIPHER_CFB] + sorted(encrypt.AEAD_CIPHERS))
+def test_every_cipher_derives_key_once(monkeypatch, cipher):
+    derived = []
+    fast = encrypt.derive_key
+
+    def derive_key(bpass, salt):
+        derived.append(salt)
+        return fast(bpass, salt)
+    monkeypatch.setattr(encrypt, "derive_key", derive_key)
+
+    encryptor = encrypt.new_encryptor(b"pw", cipher)
+    encrypt.new_decryptor(b"pw", encryptor.get_salt(), encryptor.get_iv(), cipher)
+    assert derived == [encryptor.get_salt()] * 2
@@ -0,0 +1,82 @@
+import pytest
+
+import ratelimit
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Controllable time.monotonic of the limiter """
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_rate(clock):
+    limiter = ratelimit.RateLimiter(2, 4, 0)
+    assert [limiter.acquire("a") for _ in range(4)] == [0, 0, 0, 0]
+    assert limiter.acquire("a") == 1
+
+    # Two requests per second, one token is back after half a second.
+    clock[0] += 0.5
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 1
+
+
+def test_retry_after_covers_missing_token(clock):
+    limiter = ratelimit.RateLimiter(0.25, 1, 0)
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 4
+
+
+def test_addresses_are_limited_separately(clock):
+    limiter = ratelimit.RateLimiter(1, 1, 0)
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 1
+    assert limiter.acquire("b") == 0
+
+
+def test_requests_in_progress(clock):
+    limiter = ratelimit.RateLimiter(0, 1, 2)
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 1
+    limiter.release("a")
+    assert limiter.acquire("a") == 0
+
+
+def test_disabled():
+    limiter = ratelimit.RateLimiter(0, 0, 0)
+    assert not limiter.enabled()
+    assert all(limiter.acquire("a") == 0 for _ in range(1000))
+    assert limiter.tracked() == 0
+
+
+def test_idle_addresses_expire(clock):
+    limiter = ratelimit.RateLimiter(10, 10, 0)
+    for address in "ab":
+        limiter.acquire(address)
+        limiter.release(address)
+    assert limiter.tracked() == 2
+
+    # Bucket would be full again, entry is no different from a new address.
+    clock[0] += 1
+    limiter.acquire("c")
+    assert limiter.tracked() == 1
+
+
+def test_active_addresses_are_kept(clock):
+    limiter = ratelimit.RateLimiter(10, 10, 4)
+    limiter.acquire("a")
+    limiter.acquire("b")
+    limiter.release("b")
+    clock[0] += 1
+    limiter.acquire("c")
+    assert limiter.tracked() == 2
+
+
+def test_table_is_capped(clock):
+    limiter = ratelimit.RateLimiter(1, 1, 0, max_clients=3)
+    for address in "abcdef":
+        limiter.acquire(address)
+        limiter.release(address)
+    assert limiter.tracked() == 3
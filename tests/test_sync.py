@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+import sync
+
+
+def manifest(*files):
+    return json.dumps({"files": list(files)})
+
+
+def entry(path, size=5, mtime=1000, checksum=None):
+    return {"path": path, "size": size, "mtime": mtime, "checksum": checksum}
+
+
+def test_parse_manifest():
+    entries = sync.parse_manifest(manifest(entry("a.txt", checksum="abc"), entry("sub dir/b.bin", 10, 2000)))
+    assert [(e.path, e.size, e.mtime, e.checksum) for e in entries] == [("a.txt", 5, 1000, "abc"),
+                                                                        ("sub dir/b.bin", 10, 2000, None)]
+
+
+@pytest.mark.parametrize("path", ["../escape.txt", "sub/../../escape.txt", "/etc/passwd", "a//b",
+                                  "sub/./a.txt", "", "a\0b", 5])
+def test_unsafe_paths_are_ignored(path):
+    entries = sync.parse_manifest(manifest(entry(path), entry("ok.txt")))
+    assert [e.path for e in entries] == ["ok.txt"]
+
+
+@pytest.mark.parametrize("item", [{"path": "a.txt"},
+                                  entry("a.txt", size=-1),
+                                  entry("a.txt", size="5"),
+                                  entry("a.txt", mtime=1.5),
+                                  entry("a.txt", checksum=5),
+                                  "a.txt"])
+def test_malformed_entries_are_ignored(item):
+    assert sync.parse_manifest(manifest(item)) == []
+
+
+@pytest.mark.parametrize("body", ["[]", "{}", '{"files": {}}', "not json"])
+def test_not_a_manifest(body):
+    with pytest.raises(ValueError):
+        sync.parse_manifest(body)
+
+
+def test_plan_sync_finds_new_and_changed(workdir):
+    os.makedirs("mirror/sub")
+    for name in ("same.txt", "sub/changed.txt"):
+        with open(os.path.join("mirror", name), "wb") as f:
+            f.write(b"hello")
+    same, changed, new = sync.parse_manifest(manifest(entry("same.txt"), entry("sub/changed.txt", mtime=2000),
+                                                      entry("new.txt")))
+    sync.mark_synced(same, sync.local_location("mirror", "same.txt"))
+
+    planned = sync.plan_sync([same, changed, new], "mirror")
+    assert [(e.path, location) for e, location in planned] == [
+        ("sub/changed.txt", os.path.join("mirror", "sub", "changed.txt")),
+        ("new.txt", os.path.join("mirror", "new.txt"))]
+
+
+def test_mark_synced_makes_file_up_to_date(workdir):
+    location = sync.local_location("mirror", "a.txt")
+    sync.prepare_location(location)
+    with open(location, "wb") as f:
+        f.write(b"hello")
+    item, = sync.parse_manifest(manifest(entry("a.txt", mtime=1234567890)))
+    assert not sync.is_up_to_date(item, location)
+    sync.mark_synced(item, location)
+    assert sync.is_up_to_date(item, location)
+    assert os.stat(location).st_mtime_ns == 1234567890
+
+
+def test_recorded_checksum_decides(workdir):
+    location = sync.local_location("mirror", "a.txt")
+    sync.prepare_location(location)
+    with open(location, "wb") as f:
+        f.write(b"hello")
+    st = os.stat(location)
+    recorded = {os.path.abspath(location): ("abc", st.st_size, st.st_mtime_ns)}
+
+    # Same size and modification time as on server, but checksum tells it is another version.
+    item, = sync.parse_manifest(manifest(entry("a.txt", mtime=st.st_mtime_ns, checksum="other")))
+    assert not sync.is_up_to_date(item, location, recorded)
+    item, = sync.parse_manifest(manifest(entry("a.txt", mtime=1, checksum="abc")))
+    assert sync.is_up_to_date(item, location, recorded)
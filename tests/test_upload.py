@@ -0,0 +1,59 @@
+import asyncio
+import os
+
+import tornado.httpserver
+import tornado.testing
+
+# Same import order as in application, modules import each other.
+import download_manager  # noqa: F401
+import server
+import server_file_handler
+
+
+def partial_files():
+    path = server_file_handler.PARTIAL_PATH
+    return os.listdir(path) if os.path.exists(path) else []
+
+
+def handler_tasks():
+    return [t for t in asyncio.all_tasks() if "_execute" in repr(t.get_coro())]
+
+
+def test_disconnect_during_upload(config):
+    config(**{"Ip-Address": "127.0.0.1", "AllowUpload": "True", "AllowUnencrypted": "True",
+              "MaxUploads": "1"})
+
+    async def upload_and_disconnect():
+        app = server.TurmsApp("")
+        sock, port = tornado.testing.bind_unused_port()
+        http_server = tornado.httpserver.HTTPServer(app)
+        http_server.add_sockets([sock])
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(("PUT /upload/up.bin HTTP/1.1\r\n"
+                          "Host: 127.0.0.1:%i\r\n"
+                          "Content-Length: 1000000\r\n"
+                          "Cookie: _xsrf=abcd\r\n"
+                          "X-Xsrftoken: abcd\r\n"
+                          "checksum: AAAA\r\n\r\n" % port).encode() + bytes(10000))
+            await writer.drain()
+            for _ in range(100):
+                if partial_files():
+                    break
+                await asyncio.sleep(0.02)
+            assert partial_files()
+            assert not app.acquire_upload()
+
+            # Client gives up in the middle of the body.
+            writer.close()
+            for _ in range(100):
+                if not partial_files() and not handler_tasks():
+                    break
+                await asyncio.sleep(0.02)
+            assert not partial_files()
+            assert not handler_tasks()
+            assert app.acquire_upload()
+        finally:
+            http_server.stop()
+
+    asyncio.run(upload_and_disconnect())
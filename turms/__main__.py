@@ -8,6 +8,8 @@
 # -----------------------------------------
 
 import application
+import eventloop
+from config import Config as Cfg
 
 def run():
     """
@@ -15,11 +17,15 @@ def run():
     :return:
     """
 
+    # Event loop implementation has to be chosen before any loop is created.
+    Cfg.create_config()
+    eventloop.install_event_loop()
+
     # Create logger for application
 
     # Create application window and run application
     app = application.App()
-    application.call_async(app.run())
+    app.run()
     return
 
 
@@ -0,0 +1,143 @@
+#   --- Turms ---
+#   Admission control for limiting amount
+#   of concurrent file transfers on server.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import asyncio
+import heapq
+import itertools
+
+
+class AdmissionError(Exception):
+    """ Raised when transfer can't be admitted because wait queue is full """
+    pass
+
+
+class FifoScheduler:
+    """ Admit waiting transfers in order of arrival. """
+
+    def __init__(self):
+        self._queue = []
+
+    def push(self, size, waiter):
+        """ Add waiter to queue.
+
+        :param size:    Size of the file to be transferred.
+        :param waiter:  Future to resolve when transfer is admitted.
+        """
+        self._queue.append(waiter)
+
+    def pop(self):
+        """ Remove and return next waiter to admit. """
+        return self._queue.pop(0)
+
+    def discard(self, waiter):
+        """ Remove waiter that gave up waiting. """
+        if waiter in self._queue:
+            self._queue.remove(waiter)
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class ShortestJobFirstScheduler(FifoScheduler):
+    """ Admit waiting transfer with the smallest file first.
+    Keeps mean latency for small files low under load. Transfers
+    of same size are admitted in order of arrival.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__order = itertools.count()
+
+    def push(self, size, waiter):
+        heapq.heappush(self._queue, (size, next(self.__order), waiter))
+
+    def pop(self):
+        return heapq.heappop(self._queue)[2]
+
+    def discard(self, waiter):
+        for i, item in enumerate(self._queue):
+            if item[2] is waiter:
+                self._queue.pop(i)
+                heapq.heapify(self._queue)
+                return
+
+
+SCHEDULERS = {"fifo": FifoScheduler,
+              "sjf": ShortestJobFirstScheduler}
+
+
+class AdmissionController:
+    """ Limits amount of concurrently running transfers. Transfers over the
+    limit wait in queue ordered by scheduler until a running one finishes.
+    """
+
+    __max_active = 0
+    __max_queued = 0
+    __timeout = 0
+    __active = 0
+    __scheduler = None
+
+    def __init__(self, max_active, max_queued, timeout, scheduler="sjf"):
+        """
+        :param max_active:  Maximum amount of concurrent transfers.
+        :param max_queued:  Maximum amount of transfers waiting for admission.
+        :param timeout:     Seconds to wait for admission before giving up.
+        :param scheduler:   Name of scheduling policy for waiting transfers, 'fifo' or 'sjf'.
+        """
+        self.__max_active = max(1, max_active)
+        self.__max_queued = max(0, max_queued)
+        self.__timeout = timeout
+        self.__scheduler = SCHEDULERS.get(scheduler, ShortestJobFirstScheduler)()
+
+    def get_timeout(self):
+        """ Return admission wait timeout in seconds """
+        return self.__timeout
+
+    async def acquire(self, size):
+        """ Wait until transfer is admitted. Has to be followed by release().
+
+        :param size:    Size of the file to be transferred.
+        :raises AdmissionError:         When wait queue is full.
+        :raises asyncio.TimeoutError:   When transfer wasn't admitted within timeout.
+        """
+        if self.__active < self.__max_active and len(self.__scheduler) == 0:
+            self.__active += 1
+            return
+
+        if len(self.__scheduler) >= self.__max_queued:
+            raise AdmissionError("Transfer queue is full.")
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.__scheduler.push(size, waiter)
+        try:
+            # Slot is handed over by release(), so active count
+            # is already incremented when waiter is resolved.
+            await asyncio.wait_for(waiter, self.__timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just as waiting was given up.
+                self.release()
+            else:
+                self.__scheduler.discard(waiter)
+            raise
+
+    def release(self):
+        """ Finish admitted transfer and admit next waiting one. """
+        self.__active -= 1
+        while len(self.__scheduler) > 0:
+            waiter = self.__scheduler.pop()
+            if not waiter.done():
+                self.__active += 1
+                waiter.set_result(None)
+                return
+
+    def active(self):
+        """ Return amount of currently admitted transfers """
+        return self.__active
+
+    def queued(self):
+        """ Return amount of transfers waiting for admission """
+        return len(self.__scheduler)
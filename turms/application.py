@@ -8,39 +8,43 @@ import tkinter as tk
 from _tkinter import TclError
 import tkinter.ttk as ttk
 import asyncio
+import threading
 
 import console_widget
+import filetree_widget
+import progress_widget
 from controller import Controller
 from logger import TurmsLogger as Logger
 import view
 from config import Config as Cfg
 from downloader import Downloader
+from watchdog import LoopWatchdog
 
 
-def call_async(target):
-    """ Fire and forget application events by creating new asyncio event_loop
-    when necessary and queueing functions for asynchronous execution.
+# Event loop running client and server. It runs in a thread of its own,
+# so that network callbacks don't wait for window redraws and window
+# doesn't have to poll for events in between.
+EVENT_LOOP = None
+
 
-    Either create new task with 'asyncio.get_event_loop().create_task()' or
-    if a loop is already running or start up a new loop and start execution
-    of first function with 'asyncio.get_event_loop.run_until_complete()'.
+def call_async(target):
+    """ Fire and forget application events by queueing functions
+    for asynchronous execution in application event loop.
+    Can be called from any thread, f.e. from Tkinter event bindings.
 
     Expect function to return after execution finishes, but
-    omit possible returned 'Future' object.
+    omit possible returned 'Future' object. Errors are logged.
 
     :param target : Target asynchronous function to be executed.
     """
-    # Create new event loop if necessary and add the new coroutine to loop.
-    try:
-        asyncio.get_event_loop()
-    except RuntimeError:
-        asyncio.new_event_loop()
-    finally:
-        loop = asyncio.get_event_loop()
-        if not loop.is_running():
-            loop.run_until_complete(target)
-        else:
-            loop.create_task(target)
+    future = asyncio.run_coroutine_threadsafe(target, EVENT_LOOP)
+    future.add_done_callback(log_failure)
+
+
+def log_failure(future):
+    """ Log error raised by coroutine started with call_async() """
+    if not future.cancelled() and future.exception():
+        Logger.error("Unhandled error: %s" % future.exception())
 
 
 class App:
@@ -50,20 +54,30 @@ class App:
     __controller = None
     __widgets = {}
     __run = False
+    __watchdog = None
+    __loop_thread = None
 
-    async def run(self):
+    def run(self):
         """ Run through app initialization actions
         of creating window and controllers for
-        application.
+        application. Window runs in calling thread
+        and event loop in its own thread until
+        window is closed.
         """
+        global EVENT_LOOP
 
         # Ensure that config file exists
         Cfg.create_config()
         Downloader.create_default_dir()
 
+        EVENT_LOOP = asyncio.new_event_loop()
+        self.__loop_thread = threading.Thread(target=self.run_event_loop, name="turms-loop", daemon=True)
+        self.__loop_thread.start()
+
         # Create tkinter window for app and
         # controller object for input handling.
         self.__window = self.create_window()
+        view.GuiDispatcher.attach(self.__window)
         self.__view = view.View(self.__window, self.__widgets)
         self.__controller = Controller(self.__widgets, self.__window, self.__view)
 
@@ -71,14 +85,34 @@ class App:
         self.__gui_pipeline = self.__view.get_console(self.__widgets["console"])
         sys.stdout = self.__gui_pipeline
 
-        call_async(self.__view.start_listener())
+        self.__view.start_listener()
+        call_async(self.__controller.start_progress_updates())
 
         Logger.create_logger()
         Logger.info("Application initialization finished.")
         Logger.set_log_level(logging.DEBUG)
 
+        # Opt-in monitoring of code blocking the event
+        # loop shared by client and server.
+        if Cfg.get_bool("TURMS", "LoopWatchdog", False):
+            self.__watchdog = LoopWatchdog(threshold=float(Cfg.get_turms_val("LoopLagThreshold", 0.25)),
+                                           report_interval=float(Cfg.get_turms_val("LoopLagReport", 60)))
+            EVENT_LOOP.call_soon_threadsafe(self.__watchdog.start)
+
+        # Tkinter waits for window events without polling.
         self.__run = True
-        await self.async_mainloop()
+        self.__window.mainloop()
+
+        # Window has been closed.
+        view.GuiDispatcher.close()
+        EVENT_LOOP.call_soon_threadsafe(EVENT_LOOP.stop)
+        self.__loop_thread.join(timeout=5)
+
+    @staticmethod
+    def run_event_loop():
+        """ Run application event loop until it is stopped, in event loop thread """
+        asyncio.set_event_loop(EVENT_LOOP)
+        EVENT_LOOP.run_forever()
 
     def create_window(self):
         """ Create tkinter window to serve as
@@ -108,10 +142,8 @@ class App:
         console.grid(row=0, column=0, padx=2, pady=1, sticky="NSEW")
 
         # -- Filetree view -- Right side
-        filetree = ttk.Treeview(rframe, columns=["filename", "filesize"])
+        filetree = filetree_widget.FileTree(rframe)
         filetree.grid(row=0, column=0, padx=1, pady=1, columnspan=3, sticky="N")
-        filetree.heading("filename", text="File name")
-        filetree.heading("filesize", text="File size")
 
         # -- Ip-address/port labels/input --
         ip_label = ttk.Label(master=rframe, text="IP-address")
@@ -130,6 +162,26 @@ class App:
         c_button.grid(row=5, column=0, padx=2, pady=2, columnspan=2, sticky="E")
         dc_button.grid(row=6, column=0, padx=2, pady=2, columnspan=2, sticky="E")
 
+        # -- Upload button --
+        u_button = ttk.Button(master=rframe, text="Upload", state="disabled")
+        u_button.grid(row=7, column=0, padx=2, pady=2, columnspan=2, sticky="E")
+
+        # -- Download queue buttons --
+        d_button = ttk.Button(master=rframe, text="Download", state="disabled")
+        d_button.grid(row=7, column=2, padx=2, pady=2, columnspan=2, sticky="E")
+        p_button = ttk.Button(master=rframe, text="Pause", state="disabled")
+        p_button.grid(row=8, column=0, padx=2, pady=2, columnspan=2, sticky="E")
+        r_button = ttk.Button(master=rframe, text="Resume", state="disabled")
+        r_button.grid(row=8, column=2, padx=2, pady=2, columnspan=2, sticky="E")
+        cancel_button = ttk.Button(master=rframe, text="Cancel", state="disabled")
+        cancel_button.grid(row=9, column=0, padx=2, pady=2, columnspan=2, sticky="E")
+        sync_button = ttk.Button(master=rframe, text="Sync", state="disabled")
+        sync_button.grid(row=9, column=2, padx=2, pady=2, columnspan=2, sticky="E")
+
+        # -- Download progress --
+        progress = progress_widget.TransferProgress(rframe)
+        progress.grid(row=10, column=0, padx=2, pady=2, columnspan=4, sticky="EW")
+
         s_button = ttk.Button(master=rframe, text="Start Server")
         s_button.grid(row=5, column=2, padx=2, pady=2, columnspan=2, sticky="E")
 
@@ -140,9 +192,16 @@ class App:
         self.__widgets["console"] = console
         self.__widgets["connect"] = c_button
         self.__widgets["disconnect"] = dc_button
+        self.__widgets["upload"] = u_button
+        self.__widgets["download"] = d_button
+        self.__widgets["pause"] = p_button
+        self.__widgets["resume"] = r_button
+        self.__widgets["cancel"] = cancel_button
+        self.__widgets["sync"] = sync_button
         self.__widgets["ip"] = ip_addr
         self.__widgets["port"] = port
         self.__widgets["filetree"] = filetree
+        self.__widgets["progress"] = progress
 
         self.__widgets["serverstart"] = s_button
         self.__widgets["serverstop"] = sstop_button
@@ -150,9 +209,15 @@ class App:
         # Action bindings to Controller
         c_button.bind("<Button-1>", lambda event: call_async(self.__controller.connect_to_server(event)))
         dc_button.bind("<Button-1>", lambda event: call_async(self.__controller.disconnect_from_server(event)))
+        u_button.bind("<Button-1>", lambda event: call_async(self.__controller.upload_file_to_server(event)))
+        d_button.bind("<Button-1>", lambda event: call_async(self.__controller.download_selected(event)))
+        p_button.bind("<Button-1>", lambda event: call_async(self.__controller.pause_selected(event)))
+        r_button.bind("<Button-1>", lambda event: call_async(self.__controller.resume_selected(event)))
+        cancel_button.bind("<Button-1>", lambda event: call_async(self.__controller.cancel_selected(event)))
+        sync_button.bind("<Button-1>", lambda event: call_async(self.__controller.sync_directory(event)))
         s_button.bind("<Button-1>", lambda event: call_async(self.__controller.start_server(event)))
         sstop_button.bind("<Button-1>", lambda event: call_async(self.__controller.stop_server(event)))
-        filetree.bind("<Double-1>", lambda event: call_async(self.__controller.fetch_file_from_server(event)))
+        filetree.bind_rows("<Double-1>", lambda event: call_async(self.__controller.fetch_file_from_server(event)))
 
         # On closing window / program
         window.protocol("WM_DELETE_WINDOW", self.on_window_exit)
@@ -162,17 +227,14 @@ class App:
 
         return window
 
-    async def async_mainloop(self):
-        """ Asynchronous version of tkinter.Tk.mainloop()"""
-        while self.__run:
-            self.__window.update()
-            await asyncio.sleep(0.01)
-
     def widget(self, name):
 
         return self.__widgets[name]
 
     def on_window_exit(self):
         Logger.info("Program exiting. Goodbye!")
+        if self.__watchdog:
+            EVENT_LOOP.call_soon_threadsafe(self.__watchdog.stop)
         self.__run = False
+        self.__window.destroy()
 
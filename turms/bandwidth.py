@@ -0,0 +1,214 @@
+#   --- Turms ---
+#   Token bucket based bandwidth shaping
+#   for server file transfers.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """ Token bucket for limiting rate of bytes sent.
+
+    Tokens refill continuously at the given rate up to capacity of
+    the bucket. Consuming more tokens than there are in the bucket
+    puts the bucket into debt, and the consumer waits until the debt
+    would be paid back. Consecutive consumers queue up behind the debt,
+    so waiting is first come, first served.
+    """
+
+    __rate = 0
+    __capacity = 0
+    __tokens = 0
+    __stamp = 0
+
+    def __init__(self, rate, burst=None, full=True):
+        """
+        :param rate:    Refill rate in bytes per second.
+        :param burst:   Maximum amount of tokens bucket can hold. Defaults to one second worth of tokens.
+        :param full:    Whether bucket starts full or empty.
+        """
+        self.__rate = float(rate)
+        self.__capacity = float(burst if burst else rate)
+        self.__tokens = self.__capacity if full else 0
+        self.__stamp = time.monotonic()
+
+    def __refill(self):
+        """ Add tokens accumulated since last refill. """
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__stamp) * self.__rate)
+        self.__stamp = now
+
+    def set_rate(self, rate):
+        """ Change refill rate of bucket. Capacity follows the rate. """
+        self.__refill()
+        self.__rate = float(rate)
+        self.__capacity = float(rate)
+        self.__tokens = min(self.__tokens, self.__capacity)
+
+    def get_rate(self):
+        """ Return refill rate in bytes per second. """
+        return self.__rate
+
+    def try_consume(self, amount):
+        """ Take tokens from bucket only if there is enough of them available.
+
+        :param amount:  Amount of tokens to take.
+        :return:        Whether tokens were taken.
+        """
+        self.__refill()
+        if self.__tokens >= amount:
+            self.__tokens -= amount
+            return True
+        return False
+
+    def debit(self, amount):
+        """ Take tokens from bucket regardless of available amount.
+
+        :param amount:  Amount of tokens to take.
+        :return:        Seconds until bucket is out of debt.
+        """
+        self.__refill()
+        self.__tokens -= amount
+        if self.__tokens >= 0:
+            return 0
+        return -self.__tokens / self.__rate
+
+    async def consume(self, amount):
+        """ Take tokens from bucket and wait asynchronously
+        until they would have been available.
+
+        :param amount:  Amount of tokens to take.
+        """
+        delay = self.debit(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Transfer:
+    """ Handle for single throttled transfer created by BandwidthShaper. """
+
+    __shaper = None
+    __client = None
+    __bucket = None
+    __closed = False
+
+    def __init__(self, shaper, client, rate):
+        """
+        :param shaper:  BandwidthShaper this transfer belongs to.
+        :param client:  Client ip-address.
+        :param rate:    Per transfer rate limit in bytes per second or 0 for no limit.
+        """
+        self.__shaper = shaper
+        self.__client = client
+        self.__bucket = TokenBucket(rate) if rate > 0 else None
+
+    def get_client(self):
+        """ Return ip-address of the client for this transfer """
+        return self.__client
+
+    async def throttle(self, amount):
+        """ Wait until sending given amount of bytes is allowed by all limits.
+
+        :param amount:  Amount of bytes about to be sent.
+        """
+        if self.__bucket:
+            await self.__bucket.consume(amount)
+        await self.__shaper.throttle(self.__client, amount)
+
+    def close(self):
+        """ Release transfer from shaper. Safe to call multiple times. """
+        if not self.__closed:
+            self.__closed = True
+            self.__shaper.release(self.__client)
+
+
+class BandwidthShaper:
+    """ Server wide bandwidth limits.
+
+    Enforces global egress cap, per client cap and per transfer cap.
+    While global cap has spare tokens transfers take them freely. When
+    the global cap is reached each active client gets equal share of
+    the global rate, so a single client with many transfers can't starve
+    the others.
+    """
+
+    __global = None
+    __client_rate = 0
+    __transfer_rate = 0
+
+    # Client ip-address -> [active transfer count, client bucket, fair share bucket]
+    __clients = None
+
+    def __init__(self, global_rate=0, client_rate=0, transfer_rate=0):
+        """
+        :param global_rate:     Server egress cap in bytes per second or 0 for no limit.
+        :param client_rate:     Per client ip-address cap in bytes per second or 0 for no limit.
+        :param transfer_rate:   Per transfer cap in bytes per second or 0 for no limit.
+        """
+        self.__global = TokenBucket(global_rate) if global_rate > 0 else None
+        self.__client_rate = client_rate
+        self.__transfer_rate = transfer_rate
+        self.__clients = {}
+
+    def open_transfer(self, client):
+        """ Register new transfer for client.
+
+        :param client:  Client ip-address.
+        :return:        Transfer handle to throttle sent data with.
+        """
+        entry = self.__clients.get(client)
+        if not entry:
+            bucket = TokenBucket(self.__client_rate) if self.__client_rate > 0 else None
+            # Fair share starts empty, global bucket already allows for bursts.
+            share = TokenBucket(self.__global.get_rate(), full=False) if self.__global else None
+            entry = [0, bucket, share]
+            self.__clients[client] = entry
+        entry[0] += 1
+        self.__rebalance()
+        return Transfer(self, client, self.__transfer_rate)
+
+    def release(self, client):
+        """ Remove finished transfer of client and forget client when it has none left. """
+        entry = self.__clients.get(client)
+        if not entry:
+            return
+        entry[0] -= 1
+        if entry[0] <= 0:
+            del self.__clients[client]
+        self.__rebalance()
+
+    def __rebalance(self):
+        """ Divide global rate equally between active clients. """
+        if not self.__global or not self.__clients:
+            return
+        share = self.__global.get_rate() / len(self.__clients)
+        for entry in self.__clients.values():
+            entry[2].set_rate(share)
+
+    async def throttle(self, client, amount):
+        """ Wait until client is allowed to send given amount of bytes.
+
+        :param client:  Client ip-address.
+        :param amount:  Amount of bytes about to be sent.
+        """
+        entry = self.__clients.get(client)
+        if not entry:
+            return
+
+        if entry[1]:
+            await entry[1].consume(amount)
+
+        if self.__global:
+            # Global cap has room, no need to share.
+            if self.__global.try_consume(amount):
+                return
+            # Global cap reached. Keep global bucket in debt so that
+            # only fair shares get through until load goes down.
+            self.__global.debit(amount)
+            await entry[2].consume(amount)
+
+    def active_clients(self):
+        """ Return amount of clients with active transfers. """
+        return len(self.__clients)
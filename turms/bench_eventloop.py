@@ -0,0 +1,159 @@
+#   --- Turms ---
+#   Benchmark comparing request rate and
+#   latency of server on asyncio and uvloop
+#   event loops.
+#
+#   Sipi Ylä-Nojonen, 2022
+#
+#   Usage: python bench_eventloop.py [--duration 5] [--clients 32] [--path /dir/]
+#
+#   Each event loop implementation is run in its own process in a temporary
+#   directory, where a server with Turms request handlers and clients keeping
+#   connections alive run on the same loop. Logging of requests is disabled
+#   so that it doesn't dominate the results.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import eventloop
+from watchdog import percentile
+
+# Files in content directory of benchmark server.
+CONTENT_FILES = 50
+
+
+async def read_response(reader):
+    """ Read HTTP response from stream, body with either Content-Length or chunked encoding.
+
+    :return:    Status code of the response.
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    return status
+
+
+async def client(port, path, deadline, latencies, errors):
+    """ Send requests over single keep-alive connection until deadline """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = ("GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n" % path).encode()
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def serve_and_load(duration, clients, path):
+    """ Run server and clients on current event loop and measure requests """
+    import tornado.httpserver
+    import tornado.netutil
+    import tornado.web
+    # Same import order as in application, modules import each other.
+    import download_manager
+    import server
+    rh = server.rh
+
+    class BenchApplication(tornado.web.Application):
+        """ Application without per address limits, all clients share loopback address """
+
+        def get_limiter(self):
+            return None
+
+    app = BenchApplication([(r"/", rh.IndexRequestHandler),
+                            (r"/dir/(.*)", rh.DirectoryRequestHandler)])
+    httpserver = tornado.httpserver.HTTPServer(app)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    httpserver.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+
+    latencies = []
+    errors = []
+    start = time.monotonic()
+    await asyncio.gather(*(client(port, path, start + duration, latencies, errors) for _ in range(clients)))
+    elapsed = time.monotonic() - start
+    httpserver.stop()
+
+    latencies.sort()
+    return {"requests": len(latencies),
+            "rate": len(latencies) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "errors": len(errors)}
+
+
+def worker(loop, duration, clients, path):
+    """ Run benchmark on given event loop in this process and print result as JSON """
+    from config import Config as Cfg
+
+    logging.disable(logging.CRITICAL)
+    Cfg.create_config()
+    os.makedirs("content", exist_ok=True)
+    for i in range(CONTENT_FILES):
+        with open(os.path.join("content", "file%i.txt" % i), "w") as f:
+            f.write("benchmark")
+
+    used = eventloop.install_event_loop(loop)
+    result = asyncio.run(serve_and_load(duration, clients, path))
+    result["loop"] = used
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare server request rate on asyncio and uvloop.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to run each benchmark.")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent keep-alive connections.")
+    parser.add_argument("--path", default="/dir/", help="Path requested from server.")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.duration, args.clients, args.path)
+        return
+
+    if eventloop.LOOP_UVLOOP not in eventloop.available_loops():
+        print("uvloop is not installed, benchmarking asyncio loop only.")
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print("%-8s %10s %10s %10s %10s %7s" % ("loop", "requests", "req/s", "p50 ms", "p99 ms", "errors"))
+    for loop in eventloop.available_loops():
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join([here, os.environ.get("PYTHONPATH", "")]))
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", loop,
+                                     "--duration", str(args.duration), "--clients", str(args.clients),
+                                     "--path", args.path],
+                                    cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%-8s %10i %10.0f %10.2f %10.2f %7i" % (result["loop"], result["requests"], result["rate"],
+                                                     result["p50"] * 1000, result["p99"] * 1000,
+                                                     result["errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#   --- Turms ---
+#   Content addressed storage for server
+#   content. Identical files are stored
+#   once and hashed once.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+from os import listdir, makedirs, link, replace, remove, stat
+from os.path import join, exists, isfile
+from concurrent.futures import ThreadPoolExecutor
+import json
+import shutil
+import tempfile
+import threading
+
+import encrypt
+from logger import TurmsLogger as Logger
+
+
+class BlobStore:
+    """ Keeps content files as blobs named by their SHA256 hash and maps
+    share file names to blobs.
+
+    Blobs are copies of imported files and files in content directory are
+    hard linked to their blob, so duplicates under different names share
+    the same data on disk and in page cache. Hash of every file is kept in
+    the index along with its size and modification time, which are used
+    to detect changed files on later imports.
+
+    Content files stay writable. Editing one in place modifies its blob and
+    every other name linked to it, which changes modification time of all
+    of them, so they are all imported again. A blob is trusted if its size
+    and modification time are the same as when it was stored or last
+    verified, otherwise it is hashed once and discarded if it no longer
+    matches its name.
+
+    Import runs in a worker thread while index is read from event loop, so
+    changes to index are made holding a lock.
+    """
+
+    __content_path = None
+    __blob_path = None
+    __index_path = None
+    __workers = 1
+    __stamp = None
+    __lock = None
+
+    # File name -> {"hash": hex digest, "size": bytes, "mtime": nanoseconds,
+    #               "linked": whether file is linked to blob}
+    __index = None
+
+    # Hex digest -> (size, mtime) of blob when it was stored or last verified.
+    __verified = None
+
+    def __init__(self, content_path, blob_path, workers=4):
+        """
+        :param content_path:    Directory of shared files.
+        :param blob_path:       Directory to keep blobs and index in.
+        :param workers:         Amount of threads used for hashing files on import.
+        """
+        self.__content_path = content_path
+        self.__blob_path = blob_path
+        self.__index_path = join(blob_path, "index.json")
+        self.__workers = max(1, workers)
+        self.__index = {}
+        self.__verified = {}
+        self.__lock = threading.Lock()
+
+        if not exists(self.__blob_path):
+            makedirs(self.__blob_path)
+        self.load()
+
+    def load(self):
+        """ Read blob index from disk """
+        try:
+            with open(self.__index_path, "r") as f:
+                self.__index = json.load(f)
+        except (OSError, ValueError):
+            self.__index = {}
+
+        # Linked files share modification time with their blob.
+        self.__verified = {entry["hash"]: (entry["size"], entry["mtime"])
+                           for entry in self.__index.values() if entry["linked"]}
+
+    def save(self):
+        """ Write blob index to disk atomically """
+        handle, path = tempfile.mkstemp(suffix=".tmp", dir=self.__blob_path)
+        with open(handle, "w") as f:
+            json.dump(self.__index, f)
+        replace(path, self.__index_path)
+
+    def blob_path(self, digest):
+        """ Return path of blob with given hex digest """
+        return join(self.__blob_path, digest[:2], digest)
+
+    def refresh(self):
+        """ Import content again if content directory has changed since last import """
+        try:
+            stamp = stat(self.__content_path).st_mtime_ns
+        except OSError:
+            return
+        if stamp != self.__stamp:
+            self.import_content()
+
+    def import_content(self):
+        """ Incrementally import flat content directory into the store.
+        Only new files and files with changed size or modification time
+        are hashed, in parallel.
+        """
+        present = {}
+        for name in listdir(self.__content_path):
+            path = join(self.__content_path, name)
+            if isfile(path):
+                present[name] = stat(path)
+
+        changed = []
+        for name, st in present.items():
+            entry = self.__index.get(name)
+            if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns \
+                    or (entry["linked"] and not exists(self.blob_path(entry["hash"]))):
+                changed.append(name)
+
+        # Files are hashed without holding the lock, it is held only for updating index.
+        digests = []
+        if changed:
+            Logger.info("Importing %i files to content store." % len(changed), "turms.server")
+            with ThreadPoolExecutor(max_workers=self.__workers) as pool:
+                digests = list(pool.map(self.__hash_file, changed))
+
+        with self.__lock:
+            # Forget removed files
+            removed = [name for name in self.__index if name not in present]
+            for name in removed:
+                del self.__index[name]
+
+            for name, digest in zip(changed, digests):
+                if digest:
+                    self.__store(name, digest)
+
+            if changed or removed:
+                self.collect_garbage()
+                self.save()
+
+            # Linking duplicates changes the directory too, so take
+            # the time stamp only after import is done.
+            self.__stamp = stat(self.__content_path).st_mtime_ns
+
+    def __hash_file(self, name):
+        """ Return hex SHA256 digest of content file or None if it can't be read """
+        try:
+            with open(join(self.__content_path, name), "rb") as f:
+                return encrypt.get_file_checksum(f).hex()
+        except OSError as e:
+            Logger.warning("Could not import %s: %s" % (name, e), "turms.server")
+            return None
+
+    def __hash_blob(self, blob):
+        """ Return hex SHA256 digest of blob or None if it can't be read """
+        try:
+            with open(blob, "rb") as f:
+                return encrypt.get_file_checksum(f).hex()
+        except OSError:
+            return None
+
+    def __blob_intact(self, blob, digest):
+        """ Check that existing blob still has content it is named by. Blob
+        is hashed only if it has changed since it was stored or verified.
+        """
+        st = stat(blob)
+        if self.__verified.get(digest) == (st.st_size, st.st_mtime_ns):
+            return True
+        if self.__hash_blob(blob) != digest:
+            self.__verified.pop(digest, None)
+            return False
+        self.__verified[digest] = (st.st_size, st.st_mtime_ns)
+        return True
+
+    def __create_blob(self, path, blob, digest):
+        """ Copy content file into a new blob.
+
+        :return:    Whether copy had the expected digest. File may have
+                    changed after it was hashed, then it is imported again
+                    on next refresh.
+        """
+        makedirs(join(self.__blob_path, digest[:2]), exist_ok=True)
+        handle, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.__blob_path)
+        try:
+            with open(handle, "wb") as f, open(path, "rb") as source:
+                shutil.copyfileobj(source, f)
+            # Linked content file gets mode of blob.
+            shutil.copymode(path, tmp)
+            if self.__hash_blob(tmp) != digest:
+                return False
+            st = stat(tmp)
+            replace(tmp, blob)
+            tmp = None
+            self.__verified[digest] = (st.st_size, st.st_mtime_ns)
+            return True
+        finally:
+            if tmp:
+                remove(tmp)
+
+    def __store(self, name, digest):
+        """ Link content file with its blob and record it in index.
+        Has to be called holding the lock.
+
+        :param name:    File name in content directory.
+        :param digest:  Hex digest of file content.
+        """
+        path = join(self.__content_path, name)
+        blob = self.blob_path(digest)
+        linked = True
+        try:
+            # Blob was modified through a file linked to it after it was stored.
+            if exists(blob) and not self.__blob_intact(blob, digest):
+                Logger.warning("Blob %s has changed since it was stored, discarding it." % digest,
+                               "turms.server")
+                remove(blob)
+
+            if not exists(blob) and not self.__create_blob(path, blob, digest):
+                Logger.warning("%s changed while it was imported." % name, "turms.server")
+                linked = False
+            elif stat(blob).st_ino != stat(path).st_ino:
+                # Replace file with link to the blob so data is stored only once.
+                tmp = path + ".turms-link"
+                link(blob, tmp)
+                replace(tmp, path)
+        except OSError as e:
+            # File system without hard links, file is still served
+            # from content directory with its hash cached.
+            Logger.warning("Could not link %s to content store: %s" % (name, e), "turms.server")
+            linked = False
+
+        st = stat(path)
+        self.__index[name] = {"hash": digest, "size": st.st_size, "mtime": st.st_mtime_ns, "linked": linked}
+
+    def add(self, name, checksum):
+        """ Add a new content file of which hash is already known.
+
+        :param name:        File name in content directory.
+        :param checksum:    SHA256 digest of the file as bytes.
+        """
+        with self.__lock:
+            self.__store(name, checksum.hex())
+            self.__stamp = stat(self.__content_path).st_mtime_ns
+            self.save()
+
+    def collect_garbage(self):
+        """ Remove blobs no longer referred to by any file name """
+        referred = set(entry["hash"] for entry in self.__index.values())
+        for prefix in listdir(self.__blob_path):
+            directory = join(self.__blob_path, prefix)
+            if len(prefix) != 2 or isfile(directory):
+                continue
+            for digest in listdir(directory):
+                if digest not in referred:
+                    remove(join(directory, digest))
+                    self.__verified.pop(digest, None)
+
+    def names(self):
+        """ Return list of file names in store """
+        return list(self.__index.keys())
+
+    def lookup(self, name):
+        """ Return index entry for file name or None if not present """
+        return self.__index.get(name)
+
+    def checksum(self, name):
+        """ Return SHA256 digest of file as bytes or None if not known or file
+        has changed since it was imported.
+        """
+        entry = self.__index.get(name)
+        if not entry:
+            return None
+        try:
+            st = stat(join(self.__content_path, name))
+        except OSError:
+            return None
+        if st.st_size != entry["size"] or st.st_mtime_ns != entry["mtime"]:
+            return None
+        return bytes.fromhex(entry["hash"])
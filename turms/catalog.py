@@ -0,0 +1,147 @@
+#   --- Turms ---
+#   Catalog of files downloaded by client
+#   for satisfying downloads of unchanged
+#   files locally.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+from os import link, replace, stat, makedirs, remove
+from os.path import abspath, exists, dirname, samefile
+import json
+import shutil
+import tempfile
+
+CATALOG_FILE = "./downloads/.turms-catalog.json"
+
+
+class DownloadCatalog:
+    """ Keeps track of downloaded files by checksum given by server.
+
+    Entries are only trusted as long as size and modification time of
+    the file are the same as when the file was downloaded and verified.
+    """
+
+    __path = None
+
+    # Base64 checksum -> list of {"path": absolute path, "size": bytes, "mtime": nanoseconds}
+    __entries = None
+
+    def __init__(self, path=CATALOG_FILE):
+        """
+        :param path:    Location of catalog file.
+        """
+        self.__path = path
+        self.__entries = {}
+        self.load()
+
+    def load(self):
+        """ Read catalog from disk """
+        try:
+            with open(self.__path, "r") as f:
+                self.__entries = json.load(f)
+        except (OSError, ValueError):
+            self.__entries = {}
+
+    def save(self):
+        """ Write catalog to disk atomically """
+        directory = dirname(abspath(self.__path))
+        if not exists(directory):
+            makedirs(directory)
+        handle, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        with open(handle, "w") as f:
+            json.dump(self.__entries, f)
+        replace(tmp, self.__path)
+
+    @staticmethod
+    def __valid(entry):
+        """ Whether file of entry is still the same as when recorded """
+        try:
+            st = stat(entry["path"])
+        except OSError:
+            return False
+        return st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime"]
+
+    def record(self, checksum, path):
+        """ Record verified downloaded file.
+
+        :param checksum:    Base64 encoded checksum given by server.
+        :param path:        Location of downloaded file.
+        """
+        path = abspath(path)
+        st = stat(path)
+
+        # Path now holds this version only.
+        self.forget(path)
+        self.__entries.setdefault(checksum, []).append({"path": path,
+                                                        "size": st.st_size,
+                                                        "mtime": st.st_mtime_ns})
+        self.save()
+
+    def forget(self, path):
+        """ Remove entries of given path """
+        path = abspath(path)
+        for checksum in list(self.__entries.keys()):
+            kept = [e for e in self.__entries[checksum] if e["path"] != path]
+            if kept:
+                self.__entries[checksum] = kept
+            else:
+                del self.__entries[checksum]
+
+    def find(self, checksum):
+        """ Find unchanged local file with given checksum.
+
+        :param checksum:    Base64 encoded checksum given by server.
+        :return:            Path of the file or None if there is none.
+        """
+        entries = self.__entries.get(checksum, [])
+        valid = [e for e in entries if self.__valid(e)]
+        if len(valid) != len(entries):
+            if valid:
+                self.__entries[checksum] = valid
+            else:
+                del self.__entries[checksum]
+            self.save()
+        return valid[0]["path"] if valid else None
+
+    def checksum_of(self, path):
+        """ Return checksum of unchanged downloaded file at path.
+
+        :param path:    Location of file.
+        :return:        Base64 encoded checksum or None if file is not known or has changed.
+        """
+        path = abspath(path)
+        for checksum, entries in self.__entries.items():
+            for entry in entries:
+                if entry["path"] == path and self.__valid(entry):
+                    return checksum
+        return None
+
+    def recorded(self):
+        """ Return recorded files by path, for looking up many files at once.
+        Entries have to be checked against the files like in checksum_of().
+
+        :return:    Dictionary of absolute path -> tuple of base64 encoded
+                    checksum, size and modification time in nanoseconds.
+        """
+        return {entry["path"]: (checksum, entry["size"], entry["mtime"])
+                for checksum, entries in self.__entries.items() for entry in entries}
+
+    @staticmethod
+    def materialize(source, destination):
+        """ Place copy of source file to destination. Hard link is used
+        when possible so no data has to be copied.
+
+        :param source:      Existing local file.
+        :param destination: Location to place the file to.
+        """
+        if exists(destination) and samefile(source, destination):
+            return
+
+        tmp = destination + ".turms-copy"
+        if exists(tmp):
+            remove(tmp)
+        try:
+            link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        replace(tmp, destination)
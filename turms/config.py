@@ -24,7 +24,69 @@ class Config:
                          "AllowUnencrypted": "False",
                          "UseTLS": "True",
                          "CertPath": "./keys",
-                         "AutoRemoveDamagedFile": "True"
+                         "AutoRemoveDamagedFile": "True",
+                         "DeltaTransfer": "True",
+                         # Largest file and client copy in bytes changes are sent for,
+                         # larger files are sent whole. Changed regions are matched
+                         # in Python at about a megabyte per second.
+                         "MaxDeltaSize": "4194304",
+                         "LocalCache": "True",
+                         "BlockVerification": "True",
+                         "BlockRetries": "3",
+                         "MerkleBlockSize": "1048576",
+                         # Bandwidth limits in bytes per second, 0 for no limit.
+                         "MaxBandwidth": "0",
+                         "MaxClientBandwidth": "0",
+                         "MaxTransferBandwidth": "0",
+                         # Concurrent download limits. Scheduler is either 'fifo' or 'sjf'
+                         # (shortest job first) and timeout is in seconds.
+                         "MaxTransfers": "8",
+                         "TransferQueueSize": "32",
+                         "TransferQueueTimeout": "30",
+                         "TransferScheduler": "sjf",
+                         # Requests per second and burst of requests allowed from a single address
+                         # and requests it may have in progress at once, 0 for no limit.
+                         "RequestRate": "20",
+                         "RequestBurst": "40",
+                         "MaxClientRequests": "16",
+                         # Chunks each download reads and encrypts ahead of sending. With
+                         # record stream ciphers chunk is 64 KiB per cipher thread.
+                         "ReadAhead": "4",
+                         # Threads encrypting records of a single transfer, 0 for one per CPU core.
+                         "CipherThreads": "0",
+                         # Downloads client runs at the same time, rest wait in queue.
+                         "MaxDownloads": "3",
+                         # Times per second download progress is updated in window.
+                         "ProgressUpdateRate": "4",
+                         # Log stack of code blocking event loop longer than threshold seconds
+                         # and percentiles of event loop lag every report interval seconds.
+                         "LoopWatchdog": "False",
+                         "LoopLagThreshold": "0.25",
+                         "LoopLagReport": "60",
+                         # Event loop implementation, 'asyncio' or 'uvloop'. Asyncio
+                         # loop is used when uvloop is not installed.
+                         "EventLoop": "asyncio",
+                         # Uploading files to server content. Size is in bytes.
+                         "AllowUpload": "False",
+                         "MaxUploadSize": "1073741824",
+                         "MaxUploads": "2",
+                         # Content storage, either 'flat' or 'cas' for content addressed
+                         # storage that keeps duplicate files only once.
+                         "StorageBackend": "flat",
+                         "StorageWorkers": "4",
+                         # Memory cache of small popular files and largest file
+                         # cached, both in bytes. Cache size 0 disables it.
+                         "FileCacheSize": "67108864",
+                         "FileCacheMaxFile": "1048576",
+                         # Seconds index of shared directory tree is used before rebuilding it.
+                         "IndexRefresh": "30",
+                         # File that requests to server are captured into for replaying
+                         # them later with replay.py, empty to not capture them.
+                         "TraceFile": "",
+                         # Ciphers allowed for encrypting transfers in order of preference.
+                         # aes-gcm and chacha20-poly1305 authenticate content record by
+                         # record, aes-cfb is for clients that don't negotiate a cipher.
+                         "Ciphers": "aes-gcm,chacha20-poly1305,aes-cfb"
                                  }}
 
     DEFAULT_CERT = {"ORGANIZATION": {
@@ -4,6 +4,11 @@
 #
 #   Sipi Ylä-Nojonen, 2022
 from ipaddress import ip_address
+from os.path import basename, getsize
+from http.cookies import SimpleCookie
+from urllib.parse import quote
+from functools import partial
+import asyncio
 import base64
 
 import pathvalidate
@@ -16,7 +21,19 @@ import tornado.httpclient
 from tornado.httputil import HTTPHeaders
 import json
 from pathvalidate import sanitize_filename, validate_filename
-from view import View
+from view import View, GuiDispatcher
+from request_handler import CHUNK_SIZE
+from catalog import DownloadCatalog
+from downloader import WrongPassword, FileChanged
+import download_manager
+import encrypt
+import merkle
+import sync
+
+# Times a request refused with '429 Too many requests' is sent again, and
+# longest wait in seconds asked by 'Retry-After' header that is followed.
+RATE_LIMIT_RETRIES = 5
+MAX_RETRY_WAIT = 30
 
 
 class ConnectionHandler:
@@ -24,11 +41,14 @@ class ConnectionHandler:
     __server_url = None
     __cookies = None
     __decryptor = None
-    __downloader = None
-    __headers = None
+
+    # Directory of server content currently listed, '' for content root.
+    __directory = ""
 
     def __init__(self):
-        pass
+        # Tornado logs exceptions raised in header callback as errors, even
+        # though wrong password and changed file raise one on purpose.
+        Logger.ignore_exceptions("tornado.application", WrongPassword, FileChanged)
 
     async def connect_to_server(self, ipaddr, port, controller):
         """
@@ -57,7 +77,7 @@ class ConnectionHandler:
             url = "https://%s:%s" % (ipaddr, portint)
 
             self.__server_url = url
-            self.__session = tornado.httpclient.AsyncHTTPClient()
+            self.__session = self.create_session()
 
             Logger.info("Connecting to " + url)
 
@@ -76,6 +96,12 @@ class ConnectionHandler:
             self.disconnect_from_server(controller)
             return False
 
+    @staticmethod
+    def create_session():
+        """ HTTP client requests are sent with. Application has a single connection,
+        so it uses the client shared by the event loop, which disconnecting closes. """
+        return tornado.httpclient.AsyncHTTPClient()
+
     def disconnect_from_server(self, controller):
         """ Attempt to disconnect from server if connection is active
         and clean up connection objects and filetree in View.
@@ -90,16 +116,42 @@ class ConnectionHandler:
 
         self.__decryptor = None
         self.__server_url = None
+        self.__directory = ""
 
         controller.update_filetree([])  # Empty filetree in GUI when not "connected"
         controller.state_to_disconnect()
         return True
 
-    async def get_request(self, path="/", timeout=10, header_cb = None, streaming_cb = None):
+    async def fetch(self, request):
+        """ Send request in session. Server limits rate of requests per client, and
+        request it refuses with '429 Too many requests' is sent again after
+        waiting as long as server asks in 'Retry-After' header.
+
+        :param request: tornado.httpclient.HTTPRequest to send.
+        :return:        Response got from the server.
+        """
+        retries = 0
+        while True:
+            try:
+                return await self.__session.fetch(request)
+            except tornado.httpclient.HTTPClientError as e:
+                if e.code != 429 or retries >= RATE_LIMIT_RETRIES:
+                    raise
+                retries += 1
+                try:
+                    wait = int(e.response.headers.get("Retry-After", 1))
+                except (AttributeError, ValueError):
+                    wait = 1
+                wait = min(max(wait, 1), MAX_RETRY_WAIT)
+                Logger.info("Too many requests to server, retrying in %i seconds." % wait)
+                await asyncio.sleep(wait)
+
+    async def get_request(self, path="/", timeout=10, header_cb = None, streaming_cb = None, headers=None):
         """
         Make a GET request to the server
 
         :param path:            url path to fetch.
+        :param headers:         Dictionary of additional request headers.
         :param header_cb:       Header callback function for tornado.httpclient.HTTPRequest
         :param streaming_cb:    Streaming callback function for tornado.httpclient.HTTPRequest
         :return:      Response got from the server
@@ -109,11 +161,60 @@ class ConnectionHandler:
 
             # Don't validate certificate since server certificate is self-signed and validation will fail.
             request = tornado.httpclient.HTTPRequest(url, "GET",
+                                                     headers=headers,
                                                      validate_cert=False,
                                                      request_timeout=timeout,
                                                      header_callback=header_cb,
                                                      streaming_callback=streaming_cb)
-            response = await self.__session.fetch(request)
+            response = await self.fetch(request)
+            return response
+        return None
+
+    async def head_request(self, path="/", headers=None, timeout=10):
+        """
+        Make a HEAD request to the server
+
+        :param path:            url path to fetch.
+        :param headers:         Dictionary of additional request headers.
+        :return:      Response got from the server
+        """
+        if self.__session and self.__server_url:
+            url = "%s%s" % (self.__server_url, path)
+
+            # Don't validate certificate since server certificate is self-signed and validation will fail.
+            request = tornado.httpclient.HTTPRequest(url, "HEAD",
+                                                     headers=headers,
+                                                     validate_cert=False,
+                                                     request_timeout=timeout)
+            response = await self.fetch(request)
+            return response
+        return None
+
+    async def post_request(self, path, body, timeout=10, header_cb=None, streaming_cb=None, headers=None):
+        """
+        Make a POST request to the server
+
+        :param path:            url path to post to.
+        :param body:            Request body as bytes.
+        :param headers:         Dictionary of additional request headers.
+        :param header_cb:       Header callback function for tornado.httpclient.HTTPRequest
+        :param streaming_cb:    Streaming callback function for tornado.httpclient.HTTPRequest
+        :return:      Response got from the server
+        """
+        if self.__session and self.__server_url:
+            url = "%s%s" % (self.__server_url, path)
+
+            # Don't validate certificate since server certificate is self-signed and validation will fail.
+            request_headers = self.xsrf_headers()
+            request_headers.update(headers or {})
+            request = tornado.httpclient.HTTPRequest(url, "POST",
+                                                     body=body,
+                                                     headers=request_headers,
+                                                     validate_cert=False,
+                                                     request_timeout=timeout,
+                                                     header_callback=header_cb,
+                                                     streaming_callback=streaming_cb)
+            response = await self.fetch(request)
             return response
         return None
 
@@ -126,7 +227,7 @@ class ConnectionHandler:
 
             # Don't validate certificate since server certificate is self-signed and validation will fail.
             request = tornado.httpclient.HTTPRequest(url, "GET", validate_cert=False)
-            response = await self.__session.fetch(request)
+            response = await self.fetch(request)
 
             try:
                 self.__cookies = response.headers["Set-Cookie"]
@@ -138,13 +239,18 @@ class ConnectionHandler:
             return response
         return
 
-    async def fetch_server_content(self, controller):
-        """ Request server content and print it to view
-        :param controller: Application Controller object
+    async def fetch_server_content(self, controller, path=None):
+        """ Request listing of a directory in server content and print it to view.
+        Directory names end with '/' and '../' leads to parent directory.
+
+        :param controller:  Application Controller object
+        :param path:        Path of the directory, current directory by default.
         :return: Whether fetching was successful
         """
+        if path is None:
+            path = self.__directory
         try:
-            response = await self.get_request("/dir/")
+            response = await self.get_request("/dir/%s" % quote(path))
 
             if not response:
                 Logger.error("Could not parse response.")
@@ -154,19 +260,21 @@ class ConnectionHandler:
 
             filenames = json.loads(response.body)
 
-            san_names = []
+            san_names = ["../"] if path else []
 
             # Sanitize and validate filenames in provided in response
             # body before printing them out as possible downloads.
             for name in filenames:
-                sname = sanitize_filename(name)
+                is_dir = name.endswith("/")
+                sname = sanitize_filename(name[:-1] if is_dir else name)
                 try:
                     validate_filename(sname)
-                    san_names.append(sname)
+                    san_names.append(sname + "/" if is_dir else sname)
                 except pathvalidate.ValidationError:
                     Logger.warning("Ignoring invalid filename %s with index %i in response."
                                    % (sname, filenames.index(name)))
 
+            self.__directory = path
             controller.update_filetree(san_names)
             return True
 
@@ -178,56 +286,159 @@ class ConnectionHandler:
             Logger.error("%s" % e)
             return False
 
-    async def fetch_file_from_server(self, filename, downloader, controller):
+    async def fetch_manifest(self, path=None):
+        """ Request manifest of every file under a directory of server content.
+        Manifest is sent compressed and decompressed by tornado client.
+
+        :param path:    Path of the directory, current directory by default.
+        :return:        List of sync.ManifestEntry or None if fetching failed.
+        """
+        if path is None:
+            path = self.__directory
+        try:
+            response = await self.get_request("/manifest/%s" % quote(path), 60)
+
+            if not response:
+                Logger.error("Could not parse response.")
+                return None
+
+            Logger.info("Response: %s %s " % (str(response.code), response.reason))
+            return sync.parse_manifest(response.body)
+
+        except tornado.httpclient.HTTPClientError as e:
+            Logger.warning("%s" % e)
+            return None
+
+        except ValueError as e:
+            Logger.error("Malformed manifest: %s" % e)
+            return None
+
+        except OSError as e:
+            Logger.error("%s" % e)
+            return None
+
+    async def change_directory(self, name, controller):
+        """ Move to a directory listed in current directory and list its content.
+
+        :param name:        Name of the directory ending with '/', or '../' for parent directory.
+        :param controller:  Controller object instance for callbacks.
+        :return:            Whether listing was successful.
+        """
+        if name == "../":
+            path = "/".join(self.__directory.split("/")[:-1])
+        else:
+            path = self.share_path(name.rstrip("/"))
+        return await self.fetch_server_content(controller, path)
+
+    def share_path(self, name):
+        """ Path of a file listed in current directory relative to content root """
+        return "%s/%s" % (self.__directory, name) if self.__directory else name
+
+    async def fetch_file_from_server(self, transfer, controller):
         """ Request to download a file from server.
 
-        :param filename:    Name of the file to be downloaded.
-        :param downloader:  Instance of downloader object to be assigned to decrypt and
-                            download file.
+        :param transfer:    Transfer object of the download holding its downloader
+                            and response headers. Download continues from offset of
+                            the transfer if it was paused earlier.
         :param controller:  Controller object instance for callbacks.
+        :return:            Whether file was downloaded and verified.
         """
+        filename = transfer.get_filename()
+        downloader = transfer.get_downloader()
+        offset = transfer.get_offset()
+        header_cb = partial(self.prepare_downloader, transfer)
+        streaming_cb = partial(self.delegate_download, transfer)
 
         try:
-            dl_url = "/download/%s" % filename
-            self.__downloader = downloader
-            password = View.prompt_input("Please enter decryption password.", "*")
-            # No password should be empty string
-            if not password:
-                password = ""
-            self.__downloader.decrypt_param("password", password)
-            del password
-            self.__headers = HTTPHeaders()
+            dl_url = "/download/%s" % quote(filename)
+
+            # Skip transfer if file is already available locally.
+            catalog = None
+            if Cfg.get_bool("TURMS", "LocalCache", True):
+                catalog = DownloadCatalog()
+                if not offset and await self.fetch_from_catalog(dl_url, downloader, catalog):
+                    return True
+
+            # Password is kept while download is paused.
+            if not downloader.has_password():
+                password = await GuiDispatcher.ask(View.prompt_input,
+                                                   "Please enter decryption password for %s." % filename, "*")
+                # No password should be empty string
+                if not password:
+                    password = ""
+                downloader.decrypt_param("password", password)
+                del password
+
+            response = None
+
+            # When there is an older version of the file at download location
+            # ask server to send only the changes to it.
+            if not offset and Cfg.get_bool("TURMS", "DeltaTransfer", True) and downloader.file_exists():
+                try:
+                    Logger.info("Requesting changes to existing file.")
+                    transfer.reset_headers()
+                    response = await self.post_request("/delta/%s" % quote(filename),
+                                                       downloader.create_signature(), 300,
+                                                       header_cb, streaming_cb, self.cipher_headers())
+                except tornado.httpclient.HTTPClientError as e:
+                    # Server doesn't support delta transfer, fall back to full download.
+                    if e.code not in (404, 405) or downloader.is_delta():
+                        raise
 
             # Set long enough timeout so that connection won't be interrupted if file download takes a while.
-            response = await self.get_request(dl_url, 300, self.prepare_downloader, self.delegate_download)
+            if not response:
+                response = await self.fetch_verified(transfer, dl_url, offset)
+
+            # Rebuild file from delta if one was received.
+            if downloader.is_delta():
+                await downloader.decryptor_derived()
+                downloader.finish()
 
             # File should be downloaded by now.
-            if not self.__downloader.file_exists():
+            if not downloader.file_exists():
                 Logger.error("Something went wrong. Failed to download file.")
-                return
+                return False
 
             if not response:
                 Logger.error("Could not parse response.")
                 return False
 
             Logger.info("Response: %s %s " % (str(response.code), response.reason))
-            Logger.info("Finished downloading.")
+            Logger.info(downloader.get_stats().summary())
 
             try:
-                if downloader.compare_checksum():
-                    Logger.info("File integrity check passed.")
+                # Authenticated encryption has already verified every record,
+                # no need to read the file through again.
+                if downloader.is_authenticated():
+                    Logger.info("File content was authenticated while downloading.")
+                    verified = True
+                else:
+                    verified = downloader.compare_checksum()
+                    if verified:
+                        Logger.info("File integrity check passed.")
+
+                if verified:
+                    if catalog:
+                        catalog.record(base64.urlsafe_b64encode(downloader.get_checksum()).decode(),
+                                       downloader.get_path())
                 else:
                     Logger.warning("File integrity check failed. File might be damaged.")
                     if Cfg.get_bool("TURMS", "AutoRemoveDamagedFile", False):
                         downloader.remove_file()
+                return verified
             except FileNotFoundError:
                 Logger.error("File could not be opened.")
-            finally:
-                self.__downloader = None
-                self.__headers = None
+                return False
+
+        except download_manager.DownloadAborted:
+            # Raised in streaming callback to pause or cancel transfer,
+            # download manager sets state requested.
+            return False
 
         except tornado.httpclient.HTTPClientError as e:
-            Logger.warning("%s" % e)
+            # Connection was dropped on purpose to pause or cancel transfer.
+            if not transfer.stop_requested():
+                Logger.warning("%s" % e)
             return False
 
         except ValueError as e:
@@ -235,48 +446,229 @@ class ConnectionHandler:
                 Logger.error("Wrong decryption password.")
             else:
                 Logger.error(e)
-            return
+            return False
 
         except ConnectionRefusedError:
             Logger.error("Server refused connection.")
+            return False
         finally:
-            self.__downloader = None
-            self.__headers = None
+            if transfer.stop_requested() == download_manager.PAUSED:
+                downloader.pause()
+            else:
+                downloader.abort()
+
+    async def fetch_verified(self, transfer, dl_url, offset=0):
+        """ Download whole file verifying it block by block if server publishes
+        block hashes. Blocks that fail verification are requested again with
+        range requests instead of downloading whole file again.
+
+        :param transfer:    Transfer object of the download.
+        :param dl_url:      Download path of the file on server.
+        :param offset:      Offset to continue paused download from.
+        :return:            Response of the last request.
+        """
+        downloader = transfer.get_downloader()
+        header_cb = partial(self.prepare_downloader, transfer)
+        streaming_cb = partial(self.delegate_download, transfer)
+
+        retries = 0
+        if Cfg.get_bool("TURMS", "BlockVerification", True):
+            await self.fetch_block_hashes(transfer)
+            retries = int(Cfg.get_turms_val("BlockRetries", 3))
+
+        headers = self.cipher_headers()
+        if offset:
+            Logger.info("Continuing download from %i bytes." % offset)
+            downloader.resume_at(offset)
+            headers.update(self.range_headers(downloader, offset))
+
+        transfer.reset_headers()
+        try:
+            response = await self.get_request(dl_url, 300, header_cb, streaming_cb, headers)
+        except (tornado.httpclient.HTTPClientError, FileChanged):
+            # Server didn't know 'If-Range' and sent rest of the new version.
+            # Tornado reports error raised in header callback as closed stream.
+            if not downloader.has_changed():
+                raise
+            Logger.warning("File changed on server, downloading it again from start.")
+            downloader.resume_at(0)
+            transfer.reset_headers()
+            response = await self.get_request(dl_url, 300, header_cb, streaming_cb, self.cipher_headers())
+        await downloader.decryptor_derived()
+        downloader.finish()
+
+        failed = downloader.failed_ranges()
+        while failed and retries > 0:
+            retries -= 1
+            Logger.warning("%i damaged block ranges. Requesting them again." % len(failed))
+            for start, length in failed:
+                downloader.refetch_range(start, length)
+                transfer.reset_headers()
+                headers = self.cipher_headers()
+                headers.update(self.range_headers(downloader, start, length))
+                response = await self.get_request(dl_url, 300, header_cb, streaming_cb, headers)
+                await downloader.decryptor_derived()
+                downloader.finish()
+            failed = downloader.failed_ranges()
+
+        # Whole file checksum will tell the file is damaged.
+        if failed:
+            Logger.warning("Blocks still damaged after %s retries." % Cfg.get_turms_val("BlockRetries", 3))
+        return response
+
+    @staticmethod
+    def range_headers(downloader, offset, length=None):
+        """ Headers requesting range of the file. Range is only sent if file is
+        still the version rest of it was received of, otherwise server sends
+        whole file.
+
+        :param downloader:  Downloader of the file.
+        :param offset:      Start of the range.
+        :param length:      Length of the range, rest of the file by default.
+        """
+        end = offset + length - 1 if length else ""
+        headers = {"Range": "bytes=%i-%s" % (offset, end)}
+        if downloader.get_checksum():
+            headers["If-Range"] = '"%s"' % base64.urlsafe_b64encode(downloader.get_checksum()).decode()
+        return headers
+
+    async def fetch_block_hashes(self, transfer):
+        """ Fetch block hashes of a file and pass them to downloader.
+        Download continues without block verification if server doesn't
+        publish them.
+
+        :param transfer:    Transfer object of the download.
+        """
+        try:
+            response = await self.get_request("/blocks/%s" % quote(transfer.get_filename()))
+            blocks = json.loads(response.body)
+            transfer.get_downloader().set_block_hashes(int(blocks["block_size"]),
+                                                       [bytes.fromhex(h) for h in blocks["hashes"]],
+                                                       bytes.fromhex(blocks["root"]))
+        except tornado.httpclient.HTTPClientError as e:
+            Logger.info("No block hashes for file: %s" % e)
+        except (ValueError, KeyError, TypeError):
+            Logger.warning("Ignoring malformed block hashes.")
+
+    async def fetch_from_catalog(self, dl_url, downloader, catalog):
+        """ Check with a HEAD request whether requested version of the file
+        has already been downloaded and satisfy download locally if so.
+
+        :param dl_url:      Download path of the file on server.
+        :param downloader:  Downloader assigned to download location.
+        :param catalog:     Catalog of downloaded files.
+        :return:            Whether download location now has the file.
+        """
+        # Let server tell whether file at download location is up-to-date.
+        etag = catalog.checksum_of(downloader.get_path())
+        headers = {"If-None-Match": '"%s"' % etag} if etag else None
+        try:
+            response = await self.head_request(dl_url, headers)
+        except tornado.httpclient.HTTPClientError as e:
+            if e.code == 304:
+                Logger.info("File is already up to date.")
+                return True
+            # Let actual download request handle errors.
+            return False
 
-    def prepare_downloader(self, *args):
+        checksum = response.headers.get("checksum") if response else None
+        if not checksum:
+            return False
+
+        # Same version has been downloaded somewhere else.
+        local = catalog.find(checksum)
+        if not local:
+            return False
+
+        try:
+            catalog.materialize(local, downloader.get_path())
+            catalog.record(checksum, downloader.get_path())
+        except OSError as e:
+            Logger.warning("Could not copy local file: %s" % e)
+            return False
+
+        Logger.info("File is unchanged since earlier download, copied from %s." % local)
+        return True
+
+    def prepare_downloader(self, transfer, *args):
         """ Header callback for tornado.httpclient.HTTPRequest to
-        parse headers needed for file download
+        parse headers needed for file download. Bound to transfer
+        with functools.partial.
         """
         # Arguments for callback contains tuple of single object ("Header-Name: Value")
 
-        # Ignore status line
+        # Ignore status line, except that whole file is sent instead
+        # of requested range when file has changed on server since.
+        # Headers of a refused request sent again are not kept.
         if str(args[0]).startswith("HTTP"):
             Logger.info("Got response. Starting download...")
+            transfer.reset_headers()
+            downloader = transfer.get_downloader()
+            if downloader.is_partial() and str(args[0]).split()[1] == "200":
+                Logger.warning("File changed on server, downloading it again from start.")
+                downloader.resume_at(0)
             return
 
-        self.__headers.parse_line(args[0])
+        # Empty line ends headers. When server sent a key check, start deriving
+        # the key already, connection is dropped once it shows password is wrong.
+        if not str(args[0]).strip():
+            downloader = transfer.get_downloader()
+            if transfer.get_headers().get("key-check") and not downloader.decryptor_ready():
+                self.setup_downloader(transfer)
+            return
 
-    def delegate_download(self, *args):
+        transfer.get_headers().parse_line(args[0])
+
+    @staticmethod
+    def setup_downloader(transfer):
+        """ Pass parameters from response headers to downloader and start deriving
+        key of its decryptor in a thread """
+        downloader = transfer.get_downloader()
+        headers = transfer.get_headers()
+
+        if headers.get("delta") == "True" and not downloader.is_delta():
+            downloader.set_delta()
+        if headers.get("cipher"):
+            downloader.decrypt_param("cipher", headers.get("cipher"))
+        if headers.get("salt"):
+            downloader.decrypt_param("salt", base64.urlsafe_b64decode(headers.get("salt")))
+        if headers.get("iv"):
+            downloader.decrypt_param("iv", base64.urlsafe_b64decode(headers.get("iv")))
+        if headers.get("checksum"):
+            downloader.set_checksum(base64.urlsafe_b64decode(headers.get("checksum")))
+        if headers.get("filesize"):
+            downloader.set_filesize(int(headers.get("filesize")))
+        if headers.get("merkle-root"):
+            downloader.check_root(bytes.fromhex(headers.get("merkle-root")))
+
+        check = headers.get("key-check")
+        downloader.derive_decryptor(base64.urlsafe_b64decode(check) if check else None)
+
+    def delegate_download(self, transfer, *args):
         """ Streaming callback for tornado.httpclient.HTTPRequest to
-        parse headers needed for file download"""
+        parse headers needed for file download. Bound to transfer
+        with functools.partial.
+
+        :raises DownloadAborted:    If transfer was paused or cancelled. Raising
+                                    is the only way to drop connection of a
+                                    request tornado is already receiving.
+        """
+        transfer.check_stop()
+        downloader = transfer.get_downloader()
 
         # Has to be checked every time since streaming callback doesn't
-        # know whether this is the first call or not.
-        if not self.__downloader.decryptor_ready():
-            if self.__headers.get("salt"):
-                self.__downloader.decrypt_param("salt", base64.urlsafe_b64decode(self.__headers.get("salt")))
-            if self.__headers.get("iv"):
-                self.__downloader.decrypt_param("iv", base64.urlsafe_b64decode(self.__headers.get("iv")))
-            if self.__headers.get("checksum"):
-                self.__downloader.set_checksum(base64.urlsafe_b64decode(self.__headers.get("checksum")))
-            if self.__headers.get("filesize"):
-                self.__downloader.set_filesize(int(self.__headers.get("filesize")))
-
-            self.__downloader.create_decryptor()
+        # know whether this is the first call or not. Decryptor is being
+        # derived already if server sent a key check.
+        if not downloader.decryptor_ready():
+            self.setup_downloader(transfer)
+
+        # Drop connection once derived key shows password is wrong.
+        if downloader.wrong_password():
+            raise WrongPassword("Wrong decryption password.")
         try:
             # Callback parameters should contain only bytestring body
             # chunk of response.
-            self.__downloader.chunk_decrypt_and_write(args[0])
+            downloader.chunk_decrypt_and_write(args[0])
 
         # There seems to be no easy way of catching exception raised
         # inside streaming callback from outside the tornado request
@@ -285,4 +677,133 @@ class ConnectionHandler:
         # without actually doing anything to it.
         except ValueError as e:
             Logger.warning(e)
-            return
\ No newline at end of file
+            return
+
+    @staticmethod
+    def cipher_headers():
+        """ Create headers offering ciphers this client supports, fastest first.
+
+        :return:    Dictionary of headers.
+        """
+        return {"Accept-Cipher": ", ".join(encrypt.preferred_ciphers(encrypt.allowed_ciphers()))}
+
+    def xsrf_headers(self):
+        """ Create headers carrying XSRF-token server set in initial request.
+        Server requires these for other methods than GET and HEAD.
+
+        :return:    Dictionary of headers.
+        """
+        if not self.__cookies:
+            return {}
+
+        cookie = SimpleCookie()
+        cookie.load(self.__cookies)
+        if "_xsrf" not in cookie:
+            return {}
+
+        token = cookie["_xsrf"].value
+        return {"Cookie": "_xsrf=%s" % token, "X-XSRFToken": token}
+
+    async def upload_file_to_server(self, filepath, controller):
+        """ Upload a local file to server content. File is encrypted and
+        streamed in chunks without reading whole file into memory.
+
+        :param filepath:    Path of the file to upload.
+        :param controller:  Controller object instance for callbacks.
+        :return:            Whether upload was successful.
+        """
+        if not self.__session or not self.__server_url:
+            Logger.warning("Not connected to a server.")
+            return False
+
+        try:
+            filename = sanitize_filename(basename(filepath))
+            validate_filename(filename)
+        except pathvalidate.ValidationError:
+            Logger.warning("Invalid filename for upload.")
+            return False
+
+        try:
+            password = await GuiDispatcher.ask(View.prompt_input, "Please enter encryption password.", "*")
+            bpass = bytes(password, "utf-8") if password else None
+            del password
+
+            with open(filepath, "rb") as f:
+                checksum = encrypt.get_file_checksum(f)
+
+            Logger.info("Uploading file %s." % filename)
+
+            cipher = encrypt.preferred_ciphers(encrypt.allowed_ciphers())[0]
+            try:
+                response = await self.upload(filepath, filename, checksum, bpass, cipher)
+            except tornado.httpclient.HTTPClientError as e:
+                # Server doesn't accept the cipher, retry once with one it advertises.
+                # Servers not advertising any only know AES-CFB.
+                if e.code != 406 or not bpass:
+                    raise
+                offer = e.response.headers.get("Accept-Cipher") if e.response else None
+                fallback = encrypt.negotiate_cipher(offer, encrypt.allowed_ciphers())
+                if not fallback or fallback == cipher:
+                    raise
+                Logger.info("Server doesn't accept %s, uploading with %s." % (cipher, fallback))
+                response = await self.upload(filepath, filename, checksum, bpass, fallback)
+
+            Logger.info("Response: %s %s " % (str(response.code), response.reason))
+            Logger.info("Finished uploading.")
+
+            # Show uploaded file in listing.
+            await self.fetch_server_content(controller)
+            return True
+
+        except tornado.httpclient.HTTPClientError as e:
+            Logger.warning("%s" % e)
+            return False
+
+        except OSError as e:
+            Logger.error("%s" % e)
+            return False
+
+    async def upload(self, filepath, filename, checksum, bpass, cipher):
+        """ Send file to server in a single PUT request.
+
+        :param filepath:    Path of the file to upload.
+        :param filename:    Validated name of the file on server.
+        :param checksum:    SHA256 checksum of the file.
+        :param bpass:       Password bytes to encrypt with, None to send unencrypted.
+        :param cipher:      Cipher to encrypt with.
+        :return:            Response of the server.
+        """
+        # Key derivation takes a while, don't block other transfers meanwhile.
+        encryptor = None
+        if bpass:
+            encryptor = await asyncio.get_event_loop().run_in_executor(None, encrypt.new_encryptor, bpass, cipher)
+        size = getsize(filepath)
+
+        headers = self.xsrf_headers()
+        headers["Content-Length"] = str(encrypt.stream_size(size, cipher) if encryptor else size)
+        headers["checksum"] = base64.urlsafe_b64encode(checksum).decode()
+        if encryptor:
+            headers["cipher"] = cipher
+            headers["salt"] = base64.urlsafe_b64encode(encryptor.get_salt()).decode()
+            headers["iv"] = base64.urlsafe_b64encode(encryptor.get_iv()).decode()
+            headers["key-check"] = base64.urlsafe_b64encode(encryptor.get_key_check()).decode()
+
+        async def body_producer(write):
+            """ Read, encrypt and write file to request body one chunk at a time """
+            with open(filepath, "rb") as file:
+                chunk = file.read(CHUNK_SIZE)
+                while chunk:
+                    await write(encryptor.encrypt(chunk) if encryptor else chunk)
+                    chunk = file.read(CHUNK_SIZE)
+            if encryptor:
+                final = encryptor.finalize()
+                if final:
+                    await write(final)
+
+        url = "%s/upload/%s" % (self.__server_url, quote(filename))
+        request = tornado.httpclient.HTTPRequest(url, "PUT",
+                                                 headers=headers,
+                                                 body_producer=body_producer,
+                                                 validate_cert=False,
+                                                 request_timeout=300)
+        return await self.fetch(request)
@@ -4,12 +4,19 @@
 #
 #   Sipi Ylä-Nojonen, 2022
 
-from downloader import Downloader
+from os.path import join
+import asyncio
+
+import download_manager
 import server
 import connection_handler
+import sync
 import view
+from catalog import DownloadCatalog
+from view import GuiDispatcher
 from logger import TurmsLogger as Logger
-from pathvalidate import validate_filename, sanitize_filename
+from config import Config as Cfg
+from pathvalidate import validate_filename, sanitize_filename, ValidationError
 
 
 class Controller:
@@ -18,6 +25,7 @@ class Controller:
     __app = None
     __window = None
     __conn_handler = None
+    __downloads = None
     __server = None
 
     def __init__(self, widgets, window, view_):
@@ -34,6 +42,7 @@ class Controller:
         self.__window = window
         self.__view = view_
         self.__conn_handler = connection_handler.ConnectionHandler()
+        self.__downloads = download_manager.DownloadManager(self.__conn_handler, self)
         return
 
     async def connect_to_server(self, event):
@@ -47,8 +56,7 @@ class Controller:
 
         self.state_to_connect()             # Called already here so input fields can be
                                             # locked before reading values.
-        ip = self.__widgets["ip"].get()
-        port = self.__widgets["port"].get()
+        ip, port = await GuiDispatcher.ask(lambda: (self.__widgets["ip"].get(), self.__widgets["port"].get()))
 
         if self.__conn_handler:
             await self.__conn_handler.connect_to_server(ip, port, self)
@@ -60,14 +68,24 @@ class Controller:
         """
 
         if self.__conn_handler:
+            self.__downloads.cancel_all()
             self.__conn_handler.disconnect_from_server(self)
 
     async def fetch_file_from_server(self, event):
-        """ Request to fetch specified file from server """
+        """ Queue double-clicked file for download or open double-clicked directory.
+        File clicked on is started before files queued from selection. """
 
         try:
-            focus = self.__widgets["filetree"].focus()
-            filename = self.__widgets["filetree"].item(focus)["values"][0]
+            filename = await GuiDispatcher.ask(self.__widgets["filetree"].focused)
+
+            # User clicked on non-existent item in tree.
+            if not filename:
+                return
+
+            # Directories are opened instead of downloaded.
+            if filename.endswith("/"):
+                await self.__conn_handler.change_directory(filename, self)
+                return
 
             # Sanitize filename by replacing invalid characters with "" and
             # adding underscore to filename if it is a name reserved by system.
@@ -77,19 +95,13 @@ class Controller:
             # length limits and sanitation was successful.
             validate_filename(san_name)
 
-            location = view.View.prompt_save_location(san_name)
+            location = await GuiDispatcher.ask(view.View.prompt_save_location, san_name)
 
             # User cancelled action.
             if location == "":
                 return
 
-            Logger.info("Requesting file %s. " % san_name)
-
-            # Downloader class sanitizes and validates download destination internally.
-            #   Raises pathvalidate.ValidationError if validation is not successful.
-            download = Downloader(location)
-
-            await self.__conn_handler.fetch_file_from_server(san_name, download, self)
+            self.__enqueue(filename, location, 1)
         # User clicked on non-existent item in tree.
         except IndexError as e:
             Logger.warning(e)
@@ -100,6 +112,137 @@ class Controller:
         #     logger.error("Invalid file path %s" % value)
         #     return
 
+    async def download_selected(self, event):
+        """ Queue all selected files for download. Single file is saved where user
+        chooses, several files are saved with their own names in chosen directory. """
+
+        selected = await GuiDispatcher.ask(self.__widgets["filetree"].selected)
+        names = [name for name in selected if not name.endswith("/")]
+        if not names:
+            Logger.info("No files selected for download.")
+            return
+
+        if len(names) == 1:
+            location = await GuiDispatcher.ask(view.View.prompt_save_location, names[0])
+            if location:
+                self.__enqueue(names[0], location)
+            return
+
+        directory = await GuiDispatcher.ask(view.View.prompt_directory)
+
+        # User cancelled action.
+        if not directory:
+            return
+
+        for name in names:
+            try:
+                san_name = sanitize_filename(name)
+                validate_filename(san_name)
+            except ValidationError:
+                Logger.warning("Skipping file with invalid name %s." % name)
+                continue
+            self.__enqueue(name, join(directory, san_name))
+
+    async def sync_directory(self, event):
+        """ Mirror current directory of server content into a directory user chooses.
+        Whole directory tree is compared with a single manifest request and only new
+        or changed files are downloaded, concurrently through download queue. """
+
+        directory = await GuiDispatcher.ask(view.View.prompt_directory)
+
+        # User cancelled action.
+        if not directory:
+            return
+
+        entries = await self.__conn_handler.fetch_manifest()
+        if entries is None:
+            return
+
+        catalog = DownloadCatalog() if Cfg.get_bool("TURMS", "LocalCache", True) else None
+        planned = [(self.__conn_handler.share_path(entry.path), entry, location)
+                   for entry, location in sync.plan_sync(entries, directory, catalog)]
+        Logger.info("%i of %i files are new or changed." % (len(planned), len(entries)))
+        if not planned:
+            return
+
+        # Same password for every file, instead of asking it for each download.
+        password = await GuiDispatcher.ask(view.View.prompt_input, "Please enter decryption password.", "*")
+        transfers = []
+        for filename, entry, location in planned:
+            try:
+                sync.prepare_location(location)
+                transfer = self.__downloads.enqueue(filename, location)
+            except (OSError, ValidationError) as e:
+                Logger.warning("Skipping %s: %s" % (entry.path, e))
+                continue
+            transfer.get_downloader().decrypt_param("password", password or "")
+            transfers.append((transfer, entry, location))
+        del password
+
+        await asyncio.gather(*(transfer.wait() for transfer, _, _ in transfers))
+
+        synced = 0
+        for transfer, entry, location in transfers:
+            if transfer.get_state() != download_manager.DONE:
+                continue
+            try:
+                sync.mark_synced(entry, location, catalog)
+                synced += 1
+            except OSError as e:
+                Logger.warning("Could not update %s: %s" % (location, e))
+        Logger.info("Synced %i files into %s, %i failed." % (synced, directory, len(planned) - synced))
+
+    async def pause_selected(self, event):
+        """ Pause downloads of selected files """
+        for transfer in await self.__selected_transfers():
+            self.__downloads.pause(transfer)
+
+    async def resume_selected(self, event):
+        """ Resume paused downloads and retry failed or cancelled downloads of selected files """
+        for transfer in await self.__selected_transfers():
+            if transfer.get_state() == download_manager.PAUSED:
+                self.__downloads.resume(transfer)
+            else:
+                self.__downloads.retry(transfer)
+
+    async def cancel_selected(self, event):
+        """ Cancel downloads of selected files """
+        for transfer in await self.__selected_transfers():
+            self.__downloads.cancel(transfer)
+
+    def __enqueue(self, name, location, priority=0):
+        """ Queue file listed in current directory for download.
+
+        :param name:        Name of the file in current directory.
+        :param location:    Download location.
+        :param priority:    Downloads with higher priority are started first.
+        """
+        try:
+            # Transfer sanitizes and validates download destination internally.
+            self.__downloads.enqueue(self.__conn_handler.share_path(name), location, priority)
+        except ValidationError:
+            Logger.warning("Invalid download location %s." % location)
+
+    async def __selected_transfers(self):
+        """ Latest transfers of files selected in current directory """
+        transfers = []
+        for name in await GuiDispatcher.ask(self.__widgets["filetree"].selected):
+            transfer = self.__downloads.find(self.__conn_handler.share_path(name))
+            if transfer:
+                transfers.append(transfer)
+        return transfers
+
+    async def upload_file_to_server(self, event):
+        """ Request to upload a file chosen by user to server """
+
+        location = await GuiDispatcher.ask(view.View.prompt_open_file)
+
+        # User cancelled action.
+        if not location:
+            return
+
+        await self.__conn_handler.upload_file_to_server(location, self)
+
     async def start_server(self, event):
         """ Delegate to create instance of TurmsApp application and to
         start it up in daemon thread.
@@ -155,6 +298,20 @@ class Controller:
         """ Delegate for View to change GUI state to server not running """
         self.__view.state_to_server_stopped()
 
+    async def start_progress_updates(self):
+        """ Show progress of active downloads in GUI. Progress is updated at
+        most configured times per second however fast chunks arrive. """
+        rate = max(0.1, float(Cfg.get_turms_val("ProgressUpdateRate", 4)))
+        shown = False
+        while True:
+            stats = [t.get_downloader().get_stats() for t in self.__downloads.active()]
+
+            # Window isn't woken up while there are no downloads to show.
+            if stats or shown:
+                self.__view.print_out_progress(stats)
+            shown = bool(stats)
+            await asyncio.sleep(1 / rate)
+
     def update_filetree(self, items):
         """ Delegate for View to printout details if given file list to GUI """
         self.__view.print_out_filetree(items)
@@ -0,0 +1,272 @@
+#   --- Turms ---
+#   Rsync style delta encoding for sending
+#   only changed parts of a file to client
+#   that already has an older version of it.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+from itertools import accumulate
+import hashlib
+import struct
+import time
+
+DEFAULT_BLOCK_SIZE = 16384
+
+# Block sizes accepted in signatures. Tiny blocks would make
+# matching slow and large ones need large read buffers.
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 1048576
+
+# Largest amount of literal data in single instruction
+MAX_LITERAL = 65536
+
+# Signature header: block size, block count.
+# Each block: weak checksum, strong checksum.
+SIGNATURE_HEADER = struct.Struct(">II")
+SIGNATURE_BLOCK = struct.Struct(">I16s")
+
+# Delta instructions: copy block by index or literal data of given length.
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+COPY = struct.Struct(">cI")
+LITERAL = struct.Struct(">cI")
+
+
+def weak_checksum(block):
+    """ Rsync style weak checksum of block split into its two 16-bit halves.
+
+    :param block:   Bytes to compute checksum of.
+    :return:        Tuple of sum of bytes and sum of prefix sums, both modulo 2^16.
+    """
+    return sum(block) & 0xffff, sum(accumulate(block)) & 0xffff
+
+
+def strong_checksum(block):
+    """ Strong checksum used for confirming matches of weak checksum """
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def create_signature(file, block_size=DEFAULT_BLOCK_SIZE):
+    """ Create block signatures of file content.
+
+    :param file:        File object opened for reading.
+    :param block_size:  Size of single block.
+    :return:            Signature as bytes.
+    """
+    blocks = []
+    block = file.read(block_size)
+    while block:
+        a, b = weak_checksum(block)
+        blocks.append(SIGNATURE_BLOCK.pack(a | b << 16, strong_checksum(block)))
+        block = file.read(block_size)
+    return SIGNATURE_HEADER.pack(block_size, len(blocks)) + b"".join(blocks)
+
+
+def parse_signature(data):
+    """ Parse signature created with create_signature().
+
+    :param data:    Signature bytes.
+    :return:        Tuple of block size and dictionary of weak checksum -> list of (block index, strong checksum).
+    :raises ValueError: If signature is malformed.
+    """
+    if len(data) < SIGNATURE_HEADER.size:
+        raise ValueError("Signature is too short.")
+    block_size, count = SIGNATURE_HEADER.unpack_from(data)
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE \
+            or len(data) != SIGNATURE_HEADER.size + count * SIGNATURE_BLOCK.size:
+        raise ValueError("Malformed signature.")
+
+    table = {}
+    for i in range(count):
+        weak, strong = SIGNATURE_BLOCK.unpack_from(data, SIGNATURE_HEADER.size + i * SIGNATURE_BLOCK.size)
+        table.setdefault(weak, []).append((i, strong))
+    return block_size, table
+
+
+class DeltaEncoder:
+    """ Creates delta instructions for rebuilding server file
+    from client's older version of the file and literal data.
+
+    Matching blocks are found with rolling weak checksum at every byte
+    offset and confirmed with strong checksum. Once a block matches,
+    search continues from the end of it, so unchanged and appended
+    files are encoded at block speed. Changed regions are rolled
+    through byte by byte.
+    """
+
+    __file = None
+    __block_size = 0
+    __table = None
+    __read_size = 0
+
+    def __init__(self, signature, file, read_size=1048576):
+        """
+        :param signature:   Signature bytes sent by client.
+        :param file:        Server file opened for reading.
+        :param read_size:   Amount of bytes to read from file at a time.
+        :raises ValueError: If signature is malformed.
+        """
+        self.__block_size, self.__table = parse_signature(signature)
+        self.__file = file
+        self.__read_size = max(read_size, self.__block_size)
+
+    def basis_size(self):
+        """ Size of client's file the signature describes, at most """
+        return self.__block_size * sum(len(blocks) for blocks in self.__table.values())
+
+    def encode(self, output):
+        """ Write all delta instructions to a file. Encoding is CPU bound,
+        so this is meant to be run in a worker thread. GIL is given up after
+        every instruction, which is at most MAX_LITERAL bytes of rolling,
+        so event loop thread is not kept waiting for long.
+
+        :param output:  File opened for writing.
+        :return:        Amount of bytes written.
+        """
+        written = 0
+        for instruction in self.instructions():
+            output.write(instruction)
+            written += len(instruction)
+            time.sleep(0)
+        return written
+
+    def instructions(self):
+        """ Generate delta instructions as bytes """
+        bs = self.__block_size
+        table = self.__table
+
+        # Nothing can match, no need to roll through the file.
+        if not table:
+            data = self.__file.read(self.__read_size)
+            while data:
+                yield from self.__literal(data, 0, len(data))
+                data = self.__file.read(self.__read_size)
+            return
+        data = bytearray()
+        pos = 0
+        literal = 0
+        eof = False
+        a = b = None
+
+        while True:
+            # Keep at least one block and the byte after it in buffer for rolling.
+            if not eof and len(data) - pos <= bs:
+                # Drop data already handled from the beginning of buffer.
+                if literal > 0:
+                    del data[:literal]
+                    pos -= literal
+                    literal = 0
+                more = self.__file.read(self.__read_size)
+                if more:
+                    data += more
+                else:
+                    eof = True
+
+            if len(data) - pos < bs:
+                break
+
+            if a is None:
+                a, b = weak_checksum(data[pos:pos + bs])
+
+            match = table.get(a | b << 16)
+            if match:
+                strong = strong_checksum(data[pos:pos + bs])
+                index = next((i for i, s in match if s == strong), None)
+                if index is not None:
+                    if pos > literal:
+                        yield from self.__literal(data, literal, pos)
+                    yield COPY.pack(OP_COPY, index)
+                    pos += bs
+                    literal = pos
+                    a = None
+                    continue
+
+            # No match, roll window one byte forward.
+            if pos + bs < len(data):
+                out = data[pos]
+                a = (a - out + data[pos + bs]) & 0xffff
+                b = (b - bs * out + a) & 0xffff
+            else:
+                a = None
+            pos += 1
+
+            if pos - literal >= MAX_LITERAL:
+                yield from self.__literal(data, literal, pos)
+                literal = pos
+
+        # Remaining tail shorter than a block.
+        if len(data) > literal:
+            yield from self.__literal(data, literal, len(data))
+
+    @staticmethod
+    def __literal(data, start, end):
+        """ Generate literal instructions for data between start and end """
+        while start < end:
+            stop = min(end, start + MAX_LITERAL)
+            yield LITERAL.pack(OP_LITERAL, stop - start) + bytes(data[start:stop])
+            start = stop
+
+
+class DeltaApplier:
+    """ Rebuilds file from older version of it and delta instructions
+    received in arbitrarily sized pieces.
+    """
+
+    __basis = None
+    __output = None
+    __block_size = 0
+    __buffer = None
+    __written = 0
+
+    def __init__(self, basis, output, block_size):
+        """
+        :param basis:       Older version of file opened for reading.
+        :param output:      File opened for writing new version to.
+        :param block_size:  Block size signature was created with.
+        """
+        self.__basis = basis
+        self.__output = output
+        self.__block_size = block_size
+        self.__buffer = bytearray()
+
+    def feed(self, data):
+        """ Apply all complete instructions in received data.
+
+        :param data:    Next piece of delta instruction stream.
+        :raises ValueError: If instruction stream is malformed.
+        """
+        self.__buffer += data
+        buf = self.__buffer
+        pos = 0
+        while len(buf) - pos >= COPY.size:
+            op, value = COPY.unpack_from(buf, pos)
+            if op == OP_COPY:
+                self.__basis.seek(value * self.__block_size)
+                block = self.__basis.read(self.__block_size)
+                if not block:
+                    raise ValueError("Delta refers to block outside of local file.")
+                self.__output.write(block)
+                self.__written += len(block)
+                pos += COPY.size
+            elif op == OP_LITERAL:
+                if len(buf) - pos - LITERAL.size < value:
+                    break
+                start = pos + LITERAL.size
+                self.__output.write(buf[start:start + value])
+                self.__written += value
+                pos = start + value
+            else:
+                raise ValueError("Malformed delta instruction.")
+        del buf[:pos]
+
+    def written(self):
+        """ Return amount of bytes written to new version """
+        return self.__written
+
+    def finish(self):
+        """ Check that instruction stream ended cleanly.
+
+        :raises ValueError: If stream ended in the middle of an instruction.
+        """
+        if self.__buffer:
+            raise ValueError("Delta stream ended unexpectedly.")
@@ -0,0 +1,304 @@
+#   --- Turms ---
+#   Queue for running several downloads
+#   concurrently with priorities, pausing,
+#   cancelling and retrying.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import asyncio
+import heapq
+import itertools
+
+from tornado.httputil import HTTPHeaders
+
+from logger import TurmsLogger as Logger
+from config import Config as Cfg
+from downloader import Downloader
+
+# States of a transfer
+QUEUED = "queued"
+ACTIVE = "active"
+PAUSED = "paused"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# States transfer stays in until it is queued again.
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class DownloadAborted(Exception):
+    """ Raised in streaming callback to drop connection of a download
+    that was paused or cancelled while response was being received. """
+
+
+class Transfer:
+    """ State of a single download. Each transfer has its own downloader
+    and response headers, so that concurrent downloads don't share state.
+    """
+
+    __filename = None
+    __location = None
+    __priority = 0
+    __state = QUEUED
+    __downloader = None
+    __headers = None
+
+    # Offset paused download continues from, whether it was paused
+    # while active and state requested while transfer is active.
+    __offset = 0
+    __resumable = False
+    __stop = None
+
+    __attempts = 0
+
+    # Set while transfer is finished, created once someone waits for it.
+    __finished = None
+
+    def __init__(self, filename, location, priority=0):
+        """
+        :param filename:    Path of the file on server relative to content root.
+        :param location:    Download location. Raises pathvalidate.ValidationError
+                            if it is not a valid path.
+        :param priority:    Transfers with higher priority are started first.
+        """
+        self.__filename = filename
+        self.__location = location
+        self.__priority = priority
+        self.__downloader = Downloader(location)
+
+    def get_filename(self):
+        """ Return path of the file on server """
+        return self.__filename
+
+    def get_location(self):
+        """ Return download location """
+        return self.__location
+
+    def get_priority(self):
+        """ Return priority of the transfer """
+        return self.__priority
+
+    def get_state(self):
+        """ Return current state of the transfer """
+        return self.__state
+
+    def set_state(self, state):
+        """ Change state of the transfer """
+        if state == PAUSED and self.__state == ACTIVE:
+            self.__resumable = True
+        self.__state = state
+        self.__stop = None
+        if self.__finished:
+            if state in FINISHED:
+                self.__finished.set()
+            else:
+                self.__finished.clear()
+
+    async def wait(self):
+        """ Wait until transfer is done, has failed or was cancelled.
+        Paused transfer is waited for until it is resumed and finished. """
+        if self.__finished is None:
+            self.__finished = asyncio.Event()
+            if self.__state in FINISHED:
+                self.__finished.set()
+        await self.__finished.wait()
+
+    def get_downloader(self):
+        """ Return downloader of the transfer """
+        return self.__downloader
+
+    def get_attempts(self):
+        """ Return how many times transfer has been started """
+        return self.__attempts
+
+    def get_offset(self):
+        """ Return offset download continues from, 0 for whole file """
+        return self.__offset
+
+    def start(self):
+        """ Mark transfer active. Download paused while active continues
+        from where it was left, others start over. """
+        if self.__resumable:
+            self.__offset = self.__downloader.resume_offset()
+            self.__downloader.resume_at(self.__offset)
+        else:
+            self.__offset = 0
+            if self.__attempts:
+                self.__downloader = Downloader(self.__location)
+        self.__resumable = False
+        self.__attempts += 1
+        self.set_state(ACTIVE)
+
+    def reset_headers(self):
+        """ Prepare for receiving headers of a new response """
+        self.__headers = HTTPHeaders()
+        return self.__headers
+
+    def get_headers(self):
+        """ Return headers of the response being received """
+        return self.__headers
+
+    def request_stop(self, state):
+        """ Ask active transfer to stop receiving response.
+
+        :param state:   PAUSED or CANCELLED.
+        """
+        self.__stop = state
+
+    def stop_requested(self):
+        """ Return state requested for active transfer or None """
+        return self.__stop
+
+    def check_stop(self):
+        """ Abort response being received if transfer has been asked to stop.
+
+        :raises DownloadAborted:    If stop was requested.
+        """
+        if self.__stop:
+            raise DownloadAborted("Download %s %s." % (self.__filename, self.__stop))
+
+
+class DownloadManager:
+    """ Queue of downloads run concurrently up to configured limit.
+    Queued transfers are started in order of priority and then in
+    order they were added.
+    """
+
+    __conn_handler = None
+    __controller = None
+    __queue = None
+    __transfers = None
+    __active = None
+    __counter = None
+
+    def __init__(self, conn_handler, controller):
+        """
+        :param conn_handler:    ConnectionHandler used to download files.
+        :param controller:      Controller object instance for callbacks.
+        """
+        self.__conn_handler = conn_handler
+        self.__controller = controller
+        self.__queue = []
+        self.__transfers = []
+        self.__active = set()
+        self.__counter = itertools.count()
+
+        # Tornado logs exceptions raised in streaming callback as errors,
+        # even though stopping a transfer raises one on purpose.
+        Logger.ignore_exceptions("tornado.application", DownloadAborted)
+
+    def enqueue(self, filename, location, priority=0):
+        """ Add file to download queue.
+
+        :param filename:    Path of the file on server relative to content root.
+        :param location:    Download location.
+        :param priority:    Transfers with higher priority are started first.
+        :return:            Transfer object of the download.
+        """
+        transfer = Transfer(filename, location, priority)
+        self.__transfers.append(transfer)
+        Logger.info("Queued file %s." % filename)
+        self.__push(transfer)
+        return transfer
+
+    def transfers(self):
+        """ Return all transfers in order they were added """
+        return list(self.__transfers)
+
+    def active(self):
+        """ Return transfers currently downloading """
+        return [t for t in self.__transfers if t.get_state() == ACTIVE]
+
+    def find(self, filename):
+        """ Find latest transfer of a file.
+
+        :param filename:    Path of the file on server.
+        :return:            Transfer or None if file hasn't been queued.
+        """
+        for transfer in reversed(self.__transfers):
+            if transfer.get_filename() == filename:
+                return transfer
+        return None
+
+    def pause(self, transfer):
+        """ Pause queued or active transfer. Active transfer continues
+        from where it was left when resumed. """
+        if transfer.get_state() == QUEUED:
+            transfer.set_state(PAUSED)
+            Logger.info("Paused download of %s." % transfer.get_filename())
+        elif transfer.get_state() == ACTIVE:
+            transfer.request_stop(PAUSED)
+
+    def resume(self, transfer):
+        """ Queue paused transfer again """
+        if transfer.get_state() == PAUSED:
+            Logger.info("Resuming download of %s." % transfer.get_filename())
+            self.__push(transfer)
+
+    def retry(self, transfer):
+        """ Queue failed or cancelled transfer again from the beginning """
+        if transfer.get_state() in (FAILED, CANCELLED):
+            Logger.info("Retrying download of %s." % transfer.get_filename())
+            self.__push(transfer)
+
+    def cancel(self, transfer):
+        """ Cancel transfer and remove partially downloaded file """
+        state = transfer.get_state()
+        if state in (QUEUED, PAUSED):
+            transfer.get_downloader().discard()
+            transfer.set_state(CANCELLED)
+            Logger.info("Cancelled download of %s." % transfer.get_filename())
+        elif state == ACTIVE:
+            transfer.request_stop(CANCELLED)
+
+    def cancel_all(self):
+        """ Cancel every transfer not finished yet """
+        for transfer in self.__transfers:
+            self.cancel(transfer)
+
+    def __push(self, transfer):
+        """ Put transfer in queue and start transfers if there is room """
+        transfer.set_state(QUEUED)
+        heapq.heappush(self.__queue, (-transfer.get_priority(), next(self.__counter), transfer))
+        self.__pump()
+
+    def __pump(self):
+        """ Start queued transfers until concurrency limit is reached """
+        limit = max(1, int(Cfg.get_turms_val("MaxDownloads", 3)))
+        while self.__queue and len(self.__active) < limit:
+            _, _, transfer = heapq.heappop(self.__queue)
+
+            # Paused and cancelled transfers are left in queue until popped.
+            # Transfer queued again may have an older entry too.
+            if transfer in self.__active or transfer.get_state() != QUEUED:
+                continue
+
+            self.__active.add(transfer)
+            asyncio.get_event_loop().create_task(self.__run(transfer))
+
+    async def __run(self, transfer):
+        """ Download a single transfer and update its state """
+        transfer.start()
+        try:
+            done = await self.__conn_handler.fetch_file_from_server(transfer, self.__controller)
+        except Exception as e:
+            Logger.error("Download of %s failed: %s" % (transfer.get_filename(), e))
+            done = False
+        finally:
+            self.__active.discard(transfer)
+
+        stop = transfer.stop_requested()
+        if done:
+            transfer.set_state(DONE)
+        elif stop == PAUSED:
+            transfer.set_state(PAUSED)
+            Logger.info("Paused download of %s." % transfer.get_filename())
+        elif stop == CANCELLED:
+            transfer.get_downloader().discard()
+            transfer.set_state(CANCELLED)
+            Logger.info("Cancelled download of %s." % transfer.get_filename())
+        else:
+            transfer.set_state(FAILED)
+            Logger.warning("Download of %s failed. It can be retried." % transfer.get_filename())
+        self.__pump()
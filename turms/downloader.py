@@ -10,32 +10,89 @@ DEFAULT_DL_DIRECTORY = "./downloads"
 from request_handler import CHUNK_SIZE
 from logger import TurmsLogger as Logger
 from config import Config as cfg
-from os.path import exists
-from os import remove, mkdir
+from os.path import exists, basename
+from os import remove, mkdir, replace
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 
+import delta
 import encrypt
+import merkle
+from telemetry import TransferStats
 from pathvalidate import sanitize_filepath, validate_filepath
 
 
+# Keys of decryptors are derived in these threads, so that
+# event loop can continue other transfers meanwhile.
+KEY_POOL = ThreadPoolExecutor(thread_name_prefix="turms-key")
+
+# Most of response body held while key of its decryptor is being derived.
+# Receiving waits for key after that, instead of holding more in memory.
+MAX_HELD = 8388608
+
+
+class WrongPassword(ValueError):
+    """ Raised in header callback to drop connection of a download
+    when key check sent by server doesn't match the derived key. """
+
+
+class FileChanged(ValueError):
+    """ Raised when file changed on server after part of it was
+    downloaded, so received part can't be continued. """
+
+
 class Downloader:
     __path = None
     __decryptor = None
     __filesize = 0
     __written = 0
     __checksum = None
+    __changed = False
+
+    # Whether anything has been written to the file yet
+    # and where next chunk is written to.
+    __started = False
+    __position = 0
+
+    # File kept open while chunks are received and buffer
+    # chunks are decrypted into, reused for every chunk.
+    __file = None
+    __buffer = None
+
+    # Verifying received data against block hashes published by server.
+    __verifier = None
+    __root = None
+
+    # Whether all received content was authenticated by decryptor
+    # and error that stopped decrypting.
+    __authenticated = None
+    __failed = None
+
+    # Rebuilding file from local copy and delta instructions.
+    __delta = None
+    __delta_files = None
 
-    # For mitigating unnecessary
-    # progress prints
+    # Chunks received and throughput statistics.
     __count = 0
+    __stats = None
 
     # Collect decryptor parameters from
     # headers as they are received to
     # initialize decryptor
-    __decryptor_params = {"password": None,
-                          "salt": None,
-                          "iv": None}
+    __decryptor_params = None
+
+    # Key of decryptor is derived in a thread, chunks
+    # received meanwhile are held until it is ready.
+    __job = None
+    __check = None
+    __held = None
+    __held_size = 0
 
     def __init__(self, path):
+        self.__decryptor_params = {"password": None,
+                                   "salt": None,
+                                   "iv": None,
+                                   "cipher": encrypt.CIPHER_CFB}
         self.assign_file(path)
 
     def assign_file(self, path):
@@ -64,13 +121,154 @@ class Downloader:
         validate_filepath(san_location, "auto")
         self.__path = san_location
 
-        # Delete original file at location if it exists. Done before starting
-        # download so that writing can open file in append mode and doesn't have
-        # to differentiate between downloaded chunks and existing file.
-        if self.file_exists():
-            remove(self.__path)
+        # Original file at location is kept until first chunk is written,
+        # so that it can be used as basis for delta transfer.
+        self.__started = False
+        self.__position = 0
+        self.__written = 0
+        self.__count = 0
+        self.__authenticated = None
+        self.__failed = None
+        self.__stats = TransferStats(basename(san_location))
+        return
+
+    def set_block_hashes(self, block_size, hashes, root):
+        """ Verify received data block by block against hashes published by server.
+
+        :param block_size:  Size of single block.
+        :param hashes:      List of block digests.
+        :param root:        Merkle root digest of the block digests.
+        :raises ValueError: If block digests don't match the root.
+        """
+        if merkle.merkle_root(hashes) != root:
+            raise ValueError("Block hashes don't match their Merkle root.")
+        self.__verifier = merkle.BlockVerifier(block_size, hashes)
+        self.__root = root
+        return
+
+    def check_root(self, root):
+        """ Check that block hashes are for the version of file being sent.
+        Block verification is dropped if file has changed in between, whole
+        file checksum is still compared after download.
+
+        :param root:    Merkle root of the file being sent.
+        """
+        if self.__verifier and root != self.__root:
+            Logger.warning("File changed on server after block hashes were fetched. "
+                           "Block verification disabled for this download.")
+            self.__verifier = None
         return
 
+    def failed_ranges(self):
+        """ Byte ranges of blocks that failed verification since last call.
+
+        :return:    List of tuples of offset and length.
+        """
+        return self.__verifier.failed_ranges() if self.__verifier else []
+
+    def refetch_range(self, offset, length):
+        """ Prepare for receiving given range of the file again in a new response.
+
+        :param offset:  Block aligned offset of the range.
+        :param length:  Length of the range.
+        """
+        self.__close_file()
+        self.__reset_decryptor()
+        self.__position = offset
+        self.__written -= min(length, self.__filesize - offset)
+        if self.__verifier:
+            self.__verifier.start_at(offset)
+        return
+
+    def resume_offset(self):
+        """ Offset paused download can be continued from. Block verification
+        continues from the start of a block, so offset is aligned to blocks
+        when file is verified. Delta transfer can't be continued and starts over.
+
+        :return:    Byte offset, 0 if download has to start over.
+        """
+        if self.__delta or not self.__started or self.__failed:
+            return 0
+        offset = self.__position
+        if self.__verifier:
+            offset -= offset % self.__verifier.block_size()
+        if offset >= self.__filesize:
+            return 0
+        return offset
+
+    def resume_at(self, offset):
+        """ Prepare for receiving rest of the file from given offset in a new response.
+        Partially written file is removed when download starts over from 0.
+
+        :param offset:  Offset returned by resume_offset().
+        """
+        self.__close_file()
+        self.__reset_decryptor()
+        if not offset and self.__started:
+            self.remove_file()
+            self.__started = False
+        self.__position = offset
+        self.__written = offset
+        self.__failed = None
+        self.__changed = False
+        if self.__verifier:
+            self.__verifier.start_at(offset)
+        return
+
+    def delta_path(self):
+        """ Path new version of the file is rebuilt in during delta transfer """
+        return self.__path + ".turms-delta"
+
+    def create_signature(self, block_size=delta.DEFAULT_BLOCK_SIZE):
+        """ Create block signatures of existing file at assigned path for
+        requesting delta transfer.
+
+        :return:    Signature bytes.
+        """
+        with open(self.__path, "rb") as f:
+            return delta.create_signature(f, block_size)
+
+    def set_delta(self, block_size=delta.DEFAULT_BLOCK_SIZE):
+        """ Switch to rebuilding file from existing file at assigned path and
+        delta instructions received in response body.
+
+        :param block_size:  Block size used for creating signature.
+        """
+        basis = open(self.__path, "rb")
+        output = open(self.delta_path(), "wb")
+        self.__delta_files = (basis, output)
+        self.__delta = delta.DeltaApplier(basis, output, block_size)
+        self.__written = 0
+
+        # Delta instructions are not the file content, rebuilt
+        # file is verified with whole file checksum instead.
+        self.__verifier = None
+        self.__authenticated = False
+        return
+
+    def is_delta(self):
+        """ Whether this downloader is doing a delta transfer """
+        return self.__delta is not None
+
+    def is_authenticated(self):
+        """ Whether whole file was received through authenticated encryption,
+        which makes comparing checksum of the file unnecessary. Files rebuilt
+        from delta are never considered authenticated, since they are partly
+        made of local data. """
+        return bool(self.__authenticated) and not self.__failed
+
+    def get_path(self):
+        """ Return assigned download location """
+        return self.__path
+
+    def get_stats(self):
+        """ Return throughput and progress statistics of the download """
+        return self.__stats
+
+    def get_checksum(self):
+        """ Return checksum server gave for the file """
+        return self.__checksum
+
     def file_exists(self):
         """ Does assigned path exist? Can be used to check if download was completed or
         if there is a file of such name before downloading.
@@ -90,91 +288,248 @@ class Downloader:
             Logger.warning("No filepath specified for download.")
             return
         else:
-            # Should close file automatically in case of error.
-            with open(self.__path, "ab") as f:
-                f.write(chunk)
-                f.close()
-
-    def create_decryptor(self):
-        """ Create decryptor object for decrypting data based on set parameters."""
+            # Truncate existing file on first write. File is kept open
+            # until download finishes, pauses or moves to another range.
+            if not self.__file:
+                self.__file = open(self.__path, "r+b" if self.__started else "wb")
+                self.__file.seek(self.__position)
+            self.__file.write(chunk)
+            self.__position += len(chunk)
+            self.__started = True
+
+    def __close_file(self):
+        """ Close file chunks are written to """
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+    def derive_decryptor(self, check=None):
+        """ Create decryptor in a thread based on set parameters, since key
+        derivation takes a while. Chunks received meanwhile are held and
+        decrypted once decryptor is ready.
+
+        :param check:   Key check value sent by server to verify password with.
+        :return:        Future done once key has been derived.
+        """
+        self.__held = []
+        self.__held_size = 0
+        self.__check = check
+        job = KEY_POOL.submit(self.__build_decryptor, dict(self.__decryptor_params))
+        self.__job = job
+        future = asyncio.wrap_future(job)
+        future.add_done_callback(lambda f: self.__derived(job))
+        return future
+
+    async def decryptor_derived(self):
+        """ Wait until decryptor being derived is ready and held chunks are decrypted """
+        job = self.__job
+        if job and self.__held is not None:
+            await asyncio.wait([asyncio.wrap_future(job)])
+            self.__derived(job)
+
+    def __derived(self, job):
+        """ Take decryptor derived in a thread into use and decrypt chunks held meanwhile """
+        # Already taken into use, or download has been paused or
+        # moved on to another response since.
+        if job is not self.__job or self.__held is None:
+            return
+        held, self.__held = self.__held, None
+        try:
+            self.__set_decryptor(job.result())
+            if self.__check and self.__decryptor and not self.__decryptor.verify_key(self.__check):
+                raise WrongPassword("Wrong decryption password.")
+            for chunk in held:
+                self.chunk_decrypt_and_write(chunk)
+        except ValueError as e:
+            self.__failed = e
 
-        password = self.__decryptor_params["password"]
-        salt = self.__decryptor_params["salt"]
-        iv = self.__decryptor_params["iv"]
+    @staticmethod
+    def __build_decryptor(params):
+        """ Create decryptor of given parameters, None if they are missing """
+        password = params.get("password")
+        salt = params.get("salt")
+        iv = params.get("iv")
+        cipher = params.get("cipher", encrypt.CIPHER_CFB)
 
         if not password or not salt or not iv:
             Logger.warning("Missing parameters. Cannot create decryptor.")
+            return None
+        return encrypt.new_decryptor(password, salt, iv, cipher)
+
+    def __set_decryptor(self, decryptor):
+        """ Take decryptor into use """
+        if not decryptor:
             return
-        self.__decryptor = encrypt.Decryptor(password, salt, iv)
+        self.__decryptor = decryptor
 
-        # Not needed after decryptor is created
-        self.__decryptor_params = {}
-        return
+        # Salt, iv and cipher are not needed after decryptor is created. Password
+        # is kept until download finishes in case rest of the file has to be
+        # requested again.
+        self.__decryptor_params = {"password": self.__decryptor_params.get("password")}
+
+    def __reset_decryptor(self):
+        """ Forget decryptor of previous response and one being derived """
+        self.__decryptor = None
+        self.__job = None
+        self.__held = None
 
     def set_filesize(self, size: int):
         """ Set expected file size for downloaded content. """
         self.__filesize = int(size)
-
-        # Initialize already received data here too
-        self.__written = 0
-        self.__count = 0
+        self.__stats.set_total(self.__filesize)
         return
 
     def set_checksum(self, chksum: bytes):
-        """ Set server given checksum that should match downloaded file. """
+        """ Set server given checksum that should match downloaded file.
+
+        :raises FileChanged:    If part of another version of the file has already been received.
+        """
+        if self.__started and self.__checksum and chksum != self.__checksum:
+            self.__changed = True
+            raise FileChanged("File changed on server during download.")
         self.__checksum = chksum
         return
 
+    def is_partial(self):
+        """ Whether part of the file has been received already and
+        response is expected to continue it. """
+        return self.__started
+
+    def has_changed(self):
+        """ Whether response was dropped because file changed on server """
+        return self.__changed
+
     def decrypt_param(self, key, value):
         """ Set up parameters for creating decryptor. """
         self.__decryptor_params[key] = value
 
     def decryptor_ready(self):
-        """ Whether this downloader has decryptor set up."""
-        if self.__decryptor:
+        """ Whether this downloader has decryptor set up or being derived."""
+        if self.__decryptor or self.__job:
             return True
         else:
             return False
 
+    def wrong_password(self):
+        """ Whether key check sent by server showed password is wrong """
+        return isinstance(self.__failed, WrongPassword)
+
     def chunk_decrypt_and_write(self, data):
         """ Decrypt and write single chunk of data from received response body.
-        Should be used for streaming callback function for tornado.httpclient.HTTPRequest."""
+        Should be used for streaming callback function for tornado.httpclient.HTTPRequest.
+        """
+
+        # Decryptor is not ready yet, keep chunk until it is
+        # or wait for it if there is too much to keep.
+        if self.__held is not None:
+            self.__held.append(bytes(data))
+            self.__held_size += len(data)
+            if self.__held_size > MAX_HELD:
+                self.__job.exception()
+                self.__derived(self.__job)
+            return
 
         chunk = data
-        chk_size = int(cfg.get_turms_val("ChunkSize", CHUNK_SIZE))
         self.__count += 1
+        received = len(data)
 
-        if not self.__decryptor:
+        # Nothing after content that failed authentication is trusted.
+        if self.__failed:
+            return
+
+        if not self.__decryptor and self.__count == 1:
             Logger.info("No decryptor instance created. Parsing data as unecrypted.")
 
-        if self.__filesize - self.__written > chk_size:
-            # While size greater than one chunk size remains to be
-            if self.__decryptor:
-                chunk = self.__decryptor.decrypt(chunk)
-            self.__written += len(chunk)
+        if self.__decryptor:
+            # Buffer grows to fit largest chunk and is reused after that.
+            size = self.__decryptor.output_size(len(data))
+            if not self.__buffer or len(self.__buffer) < size:
+                self.__buffer = bytearray(size)
+            try:
+                count = self.__decryptor.decrypt_into(data, self.__buffer)
+            except ValueError as e:
+                self.__failed = e
+                raise
+            chunk = memoryview(self.__buffer)[:count]
+
+        if self.__delta:
+            self.__delta.feed(chunk)
+            self.__written = self.__delta.written()
+        else:
+            if self.__verifier:
+                self.__verifier.update(chunk)
             self.write_to_file(chunk)
-            del chunk
+            self.__written += len(chunk)
+        del chunk
 
-            # Progress bar with every 20th chunk
-            if self.__count == 1 or self.__count % 20 == 0:
-                self.progress()
-            return
+        self.__stats.update(received, self.__written,
+                            self.__decryptor.pending() if self.__decryptor else 0)
+        return
 
-        # (Less than or) one chunk
-        else:
-            # Decrypt
-            if self.__decryptor:
-                chunk = self.__decryptor.decrypt(chunk)
-                chunk += self.__decryptor.finalize()
+    def finish(self):
+        """ Finish download after whole response has been received.
+        Finalizes decryptor and completes rebuilding file in delta transfer.
 
-            self.__written += len(chunk)
-            self.write_to_file(chunk)
-            del chunk
+        :raises ValueError: If content failed authentication or delta stream was incomplete.
+        """
+        if self.__failed:
+            raise self.__failed
+
+        final = self.__decryptor.finalize() if self.__decryptor else b""
+        authenticated = self.__decryptor is not None and self.__decryptor.is_authenticated()
+        self.__authenticated = authenticated and self.__authenticated is not False
+        self.__decryptor = None
+
+        if not self.__delta:
+            if final:
+                if self.__verifier:
+                    self.__verifier.update(final)
+                self.write_to_file(final)
+                self.__written += len(final)
+            if self.__verifier:
+                self.__verifier.finish()
+            self.__close_file()
+            self.__stats.update(0, self.__written)
+            self.__stats.stop()
+            return
 
-            # Progress bar with last chunk.
-            self.progress()
+        try:
+            self.__delta.feed(final)
+            self.__delta.finish()
+            self.__written = self.__delta.written()
+        finally:
+            for f in self.__delta_files:
+                f.close()
+            self.__delta = None
+            self.__delta_files = None
 
+        # Replace old version with the rebuilt one.
+        replace(self.delta_path(), self.__path)
+        self.__stats.update(0, self.__written)
+        self.__stats.stop()
 
+    def has_password(self):
+        """ Whether decryption password has been given for this download """
+        return self.__decryptor_params.get("password") is not None
+
+    def abort(self):
+        """ Forget password and clean up unfinished delta transfer """
+        self.__decryptor_params = {}
+        self.pause()
+
+    def pause(self):
+        """ Clean up unfinished delta transfer but keep password
+        so that download can be continued later. """
+        self.__stats.stop()
+        self.__close_file()
+        self.__reset_decryptor()
+        if self.__delta_files:
+            for f in self.__delta_files:
+                f.close()
+            self.__delta = None
+            self.__delta_files = None
+        if exists(self.delta_path()):
+            remove(self.delta_path())
 
     def compare_checksum(self):
         """ Compares given checksum to file in path defined for this instance
@@ -190,7 +545,7 @@ class Downloader:
         else:
             # Should close file automatically in case of error.
             with open(self.__path, "rb") as f:
-                ref_sum = encrypt.get_checksum(f.read())
+                ref_sum = encrypt.get_file_checksum(f)
                 return self.__checksum == ref_sum
 
     def remove_file(self):
@@ -199,12 +554,17 @@ class Downloader:
             remove(self.__path)
         return
 
-    def progress(self):
-        """ Print out progress bar """
+    def discard(self):
+        """ Abort download and remove partially written file. File that was
+        at download location before download started is left in place. """
+        self.abort()
+        if self.__started:
+            self.remove_file()
+        return
 
-        perc = self.__written / self.__filesize * 100
-        bar = "Progress %0.2f%s" % (perc, "%")
-        Logger.info(bar)
+    def progress(self):
+        """ Done part of the file between 0 and 1, None if file size is not known """
+        return self.__stats.fraction()
 
     @staticmethod
     def create_default_dir():
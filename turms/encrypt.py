@@ -4,13 +4,20 @@
 #
 #   Sipi Ylä-Nojonen, 2022
 
-from os import urandom, path, mkdir
+from os import urandom, path, mkdir, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from hmac import compare_digest
 import datetime
+import struct
 import ssl
+import threading
 
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography import x509
@@ -18,6 +25,45 @@ from cryptography.x509.oid import NameOID
 
 from config import Config as cfg
 
+# Ciphers for encrypting transferred content. AES-CFB is the original
+# unauthenticated stream, others are authenticated record streams.
+CIPHER_CFB = "aes-cfb"
+CIPHER_GCM = "aes-gcm"
+CIPHER_CHACHA = "chacha20-poly1305"
+AEAD_CIPHERS = {CIPHER_GCM: AESGCM, CIPHER_CHACHA: ChaCha20Poly1305}
+
+# Record stream: each record is a header holding length of record plaintext,
+# highest bit marking the final record, followed by ciphertext and tag.
+RECORD_SIZE = 65536
+# Longest record accepted from the other end. Record is buffered whole
+# before it can be authenticated, so a larger length in a header fails
+# the stream right away instead of buffering up to 2 GiB for it.
+MAX_RECORD_SIZE = 1048576
+RECORD_HEADER = struct.Struct(">I")
+RECORD_FINAL = 0x80000000
+TAG_SIZE = 16
+NONCE_SIZE = 12
+RECORD_OVERHEAD = RECORD_HEADER.size + TAG_SIZE
+
+# Label of the key check subkey derived from the content key. Receiver
+# compares its own value to one sent in headers, so that wrong password is
+# noticed right after key derivation instead of after the whole transfer.
+KEY_CHECK_LABEL = b"turms key check v2"
+KEY_CHECK_SIZE = 16
+
+# cryptography's update_into() needs room for one block
+# more than the data even with stream modes.
+BLOCK_SLACK = 15
+
+# Threads sealing and opening records of a single stream, created
+# on first use. Records are encrypted independently of each other
+# and cryptography releases the GIL while encrypting, so records of
+# one large file are encrypted on all CPU cores at once.
+CIPHER_WORKERS = None
+CIPHER_POOL = None
+CIPHER_POOL_LOCK = threading.Lock()
+
+
 def get_checksum(bts):
     """ Get SHA256 hash for bytestring object. """
     digest = hashes.Hash(hashes.SHA256())
@@ -26,6 +72,150 @@ def get_checksum(bts):
     return cs
 
 
+def get_file_checksum(file, chunk_size=65536):
+    """ Get SHA256 hash for content of opened file object
+    without reading whole file into memory at once. """
+    digest = hashes.Hash(hashes.SHA256())
+    chunk = file.read(chunk_size)
+    while chunk:
+        digest.update(chunk)
+        chunk = file.read(chunk_size)
+    return digest.finalize()
+
+
+def derive_key(bpass, salt):
+    """ Derive 32 byte content key from password bytes and salt with PBKDF2 """
+    # 390000 iterations of SHA256 is used by Django framework (noted in cryptography's example),
+    # which is a very popular and a framework also widely used in production.
+    # https://github.com/django/django/blob/main/django/contrib/auth/hashers.py
+    # We can expect for our server couple of connections at a time, so we can
+    # use 10 times the iterations easily without major performance drop.
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=1200000)
+    return kdf.derive(bpass)
+
+
+def key_check(key):
+    """ Key check value of content key. Value is a subkey derived from content key
+    with HKDF under its own label, so content key is never used for anything but
+    content. Reveals nothing of the key, but tells whether two keys are the same. """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=KEY_CHECK_SIZE, salt=None, info=KEY_CHECK_LABEL)
+    return hkdf.derive(key)
+
+
+def has_aes_acceleration():
+    """ Whether CPU has AES instructions. Only detected on Linux,
+    elsewhere acceleration is assumed. """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                # x86 lists 'flags', ARM 'Features'.
+                if line.startswith(("flags", "Features")):
+                    return "aes" in line.split(":", 1)[1].split()
+    except OSError:
+        pass
+    return True
+
+
+def allowed_ciphers():
+    """ Ciphers allowed in configuration, in order of preference """
+    value = cfg.get_turms_val("Ciphers", ",".join((CIPHER_GCM, CIPHER_CHACHA, CIPHER_CFB)))
+    return [c.strip() for c in value.split(",") if c.strip() in AEAD_CIPHERS or c.strip() == CIPHER_CFB]
+
+
+def preferred_ciphers(allowed):
+    """ Order ciphers by speed on this host. AES-GCM is fastest with AES
+    instructions, without them ChaCha20-Poly1305 is.
+
+    :param allowed: Ciphers to order.
+    :return:        List of ciphers, fastest first.
+    """
+    fast = [CIPHER_GCM, CIPHER_CHACHA] if has_aes_acceleration() else [CIPHER_CHACHA, CIPHER_GCM]
+    return [c for c in fast if c in allowed] + [c for c in allowed if c not in fast]
+
+
+def negotiate_cipher(offer, allowed):
+    """ Choose cipher for a transfer from ciphers offered by client.
+
+    :param offer:   Value of 'Accept-Cipher' header, comma separated ciphers in order
+                    of client preference. Clients not offering any only know AES-CFB.
+    :param allowed: Ciphers allowed by server.
+    :return:        Chosen cipher or None if there is no common cipher.
+    """
+    offered = [c.strip() for c in offer.split(",")] if offer else [CIPHER_CFB]
+    for cipher in offered:
+        if cipher in allowed:
+            return cipher
+    return None
+
+
+def cipher_workers():
+    """ Number of threads records of a single stream are encrypted with.
+    'CipherThreads' 0 uses one thread per CPU core. """
+    global CIPHER_WORKERS
+    if CIPHER_WORKERS is None:
+        workers = int(cfg.get_turms_val("CipherThreads", 0))
+        CIPHER_WORKERS = workers if workers > 0 else (cpu_count() or 1)
+    return CIPHER_WORKERS
+
+
+def cipher_pool():
+    """ Shared thread pool for records, None if there is only one cipher thread """
+    global CIPHER_POOL
+    if cipher_workers() < 2:
+        return None
+    with CIPHER_POOL_LOCK:
+        if CIPHER_POOL is None:
+            CIPHER_POOL = ThreadPoolExecutor(max_workers=cipher_workers(), thread_name_prefix="turms-cipher")
+    return CIPHER_POOL
+
+
+def run_records(func, jobs):
+    """ Call function for arguments of each job. Several jobs are run in
+    cipher thread pool, single one in calling thread.
+
+    :param func:    Function sealing or opening a single record.
+    :param jobs:    List of argument tuples.
+    :return:        List of results in order of jobs. Error of
+                    first failed job in order is raised.
+    """
+    pool = cipher_pool() if len(jobs) > 1 else None
+    if pool is None:
+        return [func(*job) for job in jobs]
+    return list(pool.map(func, *zip(*jobs)))
+
+
+def stream_size(size, cipher, record_size=RECORD_SIZE):
+    """ Size of encrypted stream of content of given size """
+    if cipher not in AEAD_CIPHERS:
+        return size
+    records = max(1, -(-size // record_size))
+    return size + records * RECORD_OVERHEAD
+
+
+def new_encryptor(bpass, cipher=CIPHER_CFB):
+    """ Create encryptor for given cipher.
+
+    :raises ValueError: If cipher is not known.
+    """
+    if cipher == CIPHER_CFB:
+        return Encryptor(bpass)
+    if cipher in AEAD_CIPHERS:
+        return StreamEncryptor(bpass, cipher)
+    raise ValueError("Unknown cipher %s." % cipher)
+
+
+def new_decryptor(password, salt, iv, cipher=CIPHER_CFB):
+    """ Create decryptor for given cipher.
+
+    :raises ValueError: If cipher is not known.
+    """
+    if cipher == CIPHER_CFB:
+        return Decryptor(password, salt, iv)
+    if cipher in AEAD_CIPHERS:
+        return StreamDecryptor(password, salt, iv, cipher)
+    raise ValueError("Unknown cipher %s." % cipher)
+
+
 class KeyHolder:
     # No get method to not expose this outside through calls
     __pass = None
@@ -38,8 +228,15 @@ class KeyHolder:
         """ Class to hold user password and create new encryption devices derived from it """
         self.__pass = bytes(password, "utf-8")
 
-    def create_encryptor(self):
-        """ Create new Encryptor with password """
+    def has_password(self):
+        """ Whether a password for encryption is defined """
+        return len(self.__pass) > 0
+
+    def create_encryptor(self, cipher=CIPHER_CFB):
+        """ Create new Encryptor with password
+
+        :param cipher:  Cipher to encrypt with.
+        """
 
         # Unencrypted file transfer not allowed but is attempted
         if not cfg.get_bool("TURMS", "AllowUnencrypted", False) and (len(self.__pass) == 0):
@@ -50,7 +247,24 @@ class KeyHolder:
         elif len(self.__pass) == 0:
             return None
         else:
-            return Encryptor(self.__pass)
+            return new_encryptor(self.__pass, cipher)
+
+    def create_decryptor(self, salt, iv, cipher=CIPHER_CFB):
+        """ Create new Decryptor with password for data encrypted by client
+
+        :param salt:    Salt client used for deriving the key.
+        :param iv:      Initialization vector client used for encryption.
+        :param cipher:  Cipher client used for encryption.
+        """
+
+        # Unencrypted file transfer not allowed but is attempted
+        if not cfg.get_bool("TURMS", "AllowUnencrypted", False) and (len(self.__pass) == 0):
+            raise ValueError("Unencrypted file transfer is not allowed, but no password is defined.")
+
+        elif len(self.__pass) == 0:
+            return None
+        else:
+            return new_decryptor(self.__pass, salt, iv, cipher)
 
 
 class Encryptor:
@@ -58,6 +272,7 @@ class Encryptor:
     __salt = None
     __iv = None
     __encryptor = None
+    __key_check = None
 
     def __init__(self, bpass):
         """ Class wrapper for encrypting data with python cryptography
@@ -74,18 +289,7 @@ class Encryptor:
         # enough to be suitable for cryptography.
         # https://docs.python.org/3/library/os.htmlx
         self.__salt = urandom(32)
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=self.__salt,
-            # 390000 iterations of SHA256 is used by Django framework (noted in cryptography's example),
-            # which is a very popular and a framework also widely used in production.
-            # https://github.com/django/django/blob/main/django/contrib/auth/hashers.py
-            # We can expect for our server couple of connections at a time, so we can
-            # use 10 times the iterations easily without major performance drop.
-            iterations=1200000
-        )
-        key = kdf.derive(bpass)
+        key = derive_key(bpass, self.__salt)
 
         # Initialize AES cipher with generated key and iv.
         # https://cryptography.io/en/latestl/hazmat/primitives/symmetric-encryption/
@@ -97,11 +301,26 @@ class Encryptor:
 
         cipher = Cipher(algorithms.AES(key), modes.CFB(self.__iv))
         self.__encryptor = cipher.encryptor()
+        self.__key_check = key_check(key)
 
     def encrypt(self, content):
         """ Encrypt given content and return encrypted """
         return self.__encryptor.update(content)
 
+    def encrypt_into(self, content, buf):
+        """ Encrypt given content into preallocated buffer.
+
+        :param content: Bytes-like plaintext.
+        :param buf:     Writable buffer of at least output_size(len(content)) bytes.
+        :return:        Amount of bytes written to buffer.
+        """
+        return self.__encryptor.update_into(content, buf)
+
+    @staticmethod
+    def output_size(length):
+        """ Buffer size encrypt_into() needs for given amount of content """
+        return length + BLOCK_SLACK
+
     def finalize(self):
         """ Finalize encryption """
         return self.__encryptor.finalize()
@@ -114,12 +333,22 @@ class Encryptor:
         """ Get initialization vector """
         return self.__iv
 
+    def get_key_check(self):
+        """ Return key check value of the encryption key """
+        return self.__key_check
+
+    @staticmethod
+    def get_cipher():
+        """ Name of the cipher used """
+        return CIPHER_CFB
+
 
 class Decryptor:
 
     __decryptor = None
     __salt = None
     __iv = None
+    __key_check = None
 
     def __init__(self, password, salt, iv):
         """ Class wrapper for decrypting data with python cryptography
@@ -127,7 +356,7 @@ class Decryptor:
         uses predefined salt to with user input password to determine correct key,
         so it should only be used for decryption.
 
-        :param password:   Password to use for key derivation.
+        :param password:   Password to use for key derivation, string or bytes.
         :param salt:       Salt supplied by encryptor.
         :param iv:         Initialization vector supplied by encryptor.
         """
@@ -135,18 +364,12 @@ class Decryptor:
         # Create decryption key based on user input password as known salt.
         # Based on cryptography module documentation and example.
         # https://cryptography.io/en/latest/fernet/#using-passwords-with-fernet
-        bpass = bytes(password, "utf-8")
-
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            # 390000 iterations of SHA256 is used by Django framework (noted in cryptography's example),
-            # which is a very popular and a framework also widely used in production.
-            # https://github.com/django/django/blob/main/django/contrib/auth/hashers.py
-            iterations=1200000,
-        )
-        key = kdf.derive(bpass)
+        if isinstance(password, bytes):
+            bpass = password
+        else:
+            bpass = bytes(password, "utf-8")
+
+        key = derive_key(bpass, salt)
 
         # Initialize AES cipher with generated key and iv.
         # https://cryptography.io/en/latestl/hazmat/primitives/symmetric-encryption/
@@ -157,16 +380,370 @@ class Decryptor:
 
         cipher = Cipher(algorithms.AES(key), modes.CFB(self.__iv))
         self.__decryptor = cipher.decryptor()
+        self.__key_check = key_check(key)
         return
 
+    def verify_key(self, check):
+        """ Whether key check value sent by encryptor matches the key
+        derived here, i.e. whether the password is right. """
+        return compare_digest(self.__key_check, check)
+
     def decrypt(self, content):
         """ Decrypt given content and return decrypted """
         return self.__decryptor.update(content)
 
+    def decrypt_into(self, content, buf):
+        """ Decrypt given content into preallocated buffer.
+
+        :param content: Bytes-like ciphertext.
+        :param buf:     Writable buffer of at least output_size(len(content)) bytes.
+        :return:        Amount of bytes written to buffer.
+        """
+        return self.__decryptor.update_into(content, buf)
+
+    @staticmethod
+    def output_size(length):
+        """ Buffer size decrypt_into() needs for given amount of content """
+        return length + BLOCK_SLACK
+
     def finalize(self):
         """ Finalize decryptor context """
         return self.__decryptor.finalize()
 
+    @staticmethod
+    def is_authenticated():
+        """ Whether decrypted data has been authenticated. CFB stream is not. """
+        return False
+
+    @staticmethod
+    def pending():
+        """ Bytes received but not decrypted yet. CFB decrypts every byte right away. """
+        return 0
+
+
+def record_nonce(base, counter):
+    """ Nonce of record with given sequence number. Counter is XORed into
+    nonce base, so that no nonce is repeated within a stream. """
+    return (int.from_bytes(base, "big") ^ counter).to_bytes(NONCE_SIZE, "big")
+
+
+class RecordCipher:
+    """ Seals and opens single records of a record stream into caller's buffers.
+    AES-GCM goes through cipher contexts, which can write into a buffer with
+    every supported cryptography version. ChaCha20-Poly1305 writes into buffer
+    when cryptography supports it and is copied there otherwise.
+    """
+
+    __key = None
+    __aead = None
+    __gcm = False
+
+    def __init__(self, key, cipher):
+        """
+        :param key:     Derived key.
+        :param cipher:  One of AEAD_CIPHERS.
+        """
+        self.__key = key
+        self.__aead = AEAD_CIPHERS[cipher](key)
+        self.__gcm = cipher == CIPHER_GCM
+
+    def seal_into(self, nonce, data, header, buf):
+        """ Encrypt record plaintext into buffer.
+
+        :param nonce:   Nonce of the record.
+        :param data:    Plaintext of the record.
+        :param header:  Record header, authenticated with the record.
+        :param buf:     Writable buffer of at least len(data) + TAG_SIZE + BLOCK_SLACK bytes.
+        :return:        Amount of bytes written, ciphertext followed by tag.
+        """
+        length = len(data)
+        if self.__gcm:
+            encryptor = Cipher(algorithms.AES(self.__key), modes.GCM(nonce)).encryptor()
+            encryptor.authenticate_additional_data(header)
+            encryptor.update_into(data, buf)
+            encryptor.finalize()
+            buf[length:length + TAG_SIZE] = encryptor.tag
+        elif hasattr(self.__aead, "encrypt_into"):
+            self.__aead.encrypt_into(nonce, data, header, buf[:length + TAG_SIZE])
+        else:
+            buf[:length + TAG_SIZE] = self.__aead.encrypt(nonce, bytes(data), header)
+        return length + TAG_SIZE
+
+    def open_into(self, nonce, data, header, buf):
+        """ Decrypt and authenticate record into buffer.
+
+        :param nonce:   Nonce of the record.
+        :param data:    Ciphertext followed by tag.
+        :param header:  Record header.
+        :param buf:     Writable buffer of at least len(data) + BLOCK_SLACK bytes.
+        :return:        Amount of plaintext bytes written.
+        :raises InvalidTag: If record fails authentication. Buffer then
+                            holds unauthenticated data that must not be used.
+        """
+        length = len(data) - TAG_SIZE
+        if length < 0:
+            raise InvalidTag()
+        if self.__gcm:
+            decryptor = Cipher(algorithms.AES(self.__key), modes.GCM(nonce, bytes(data[length:]))).decryptor()
+            decryptor.authenticate_additional_data(header)
+            decryptor.update_into(data[:length], buf)
+            decryptor.finalize()
+        elif hasattr(self.__aead, "decrypt_into"):
+            self.__aead.decrypt_into(nonce, data, header, buf[:length])
+        else:
+            buf[:length] = self.__aead.decrypt(nonce, bytes(data), header)
+        return length
+
+
+class StreamEncryptor:
+    """ Encrypts content into stream of independently authenticated records
+    with AES-GCM or ChaCha20-Poly1305. Record header is authenticated with
+    the record, so records can't be reordered, truncated or cut short
+    without decryption failing.
+
+    Each record has its own nonce and position in output, so records
+    completed by the same content are sealed in parallel in cipher threads.
+    """
+
+    __records = None
+    __cipher = None
+    __salt = None
+    __iv = None
+    __record_size = 0
+    __buffer = None
+    __counter = 0
+    __key_check = None
+
+    def __init__(self, bpass, cipher=CIPHER_GCM, record_size=RECORD_SIZE):
+        """
+        :param bpass:       Password bytes to derive key from.
+        :param cipher:      One of AEAD_CIPHERS.
+        :param record_size: Maximum amount of plaintext in single record, at most MAX_RECORD_SIZE.
+        """
+        if not 0 < record_size <= MAX_RECORD_SIZE:
+            raise ValueError("Invalid record size %i." % record_size)
+        self.__salt = urandom(32)
+        self.__iv = urandom(NONCE_SIZE)
+        key = derive_key(bpass, self.__salt)
+        self.__records = RecordCipher(key, cipher)
+        self.__key_check = key_check(key)
+        self.__cipher = cipher
+        self.__record_size = record_size
+        self.__buffer = bytearray()
+
+    def encrypt(self, content):
+        """ Encrypt given content and return complete records. Last record is
+        held back until finalize() so that it can be marked as final. """
+        out = bytearray(self.output_size(len(content)))
+        written = self.encrypt_into(content, out)
+        return bytes(memoryview(out)[:written])
+
+    def encrypt_into(self, content, buf):
+        """ Encrypt given content into preallocated buffer as complete records.
+        Last record is held back until finalize() so that it can be marked as final.
+
+        :param content: Bytes-like plaintext.
+        :param buf:     Writable buffer of at least output_size(len(content)) bytes.
+        :return:        Amount of bytes written to buffer.
+        """
+        self.__buffer += content
+        size = self.__record_size
+        pos = 0
+        written = 0
+        jobs = []
+        with memoryview(self.__buffer) as data, memoryview(buf) as out:
+            try:
+                while len(data) - pos > size:
+                    jobs.append((data[pos:pos + size], False, out[written:], self.__counter + len(jobs)))
+                    written += size + RECORD_OVERHEAD
+                    pos += size
+                run_records(self.__record_into, jobs)
+            finally:
+                # Views have to be gone before buffers are released.
+                count = len(jobs)
+                jobs.clear()
+        self.__counter += count
+        del self.__buffer[:pos]
+        return written
+
+    def output_size(self, length):
+        """ Buffer size encrypt_into() needs for given amount of content.
+        Held back plaintext is at most one record, so content completes
+        at most one record more than it fills. """
+        records = length // self.__record_size + 1
+        return records * (self.__record_size + RECORD_OVERHEAD) + BLOCK_SLACK
+
+    def finalize(self):
+        """ Encrypt rest of the content as final record """
+        out = bytearray(len(self.__buffer) + RECORD_OVERHEAD + BLOCK_SLACK)
+        written = self.__record_into(self.__buffer, True, memoryview(out), self.__counter)
+        self.__counter += 1
+        self.__buffer = bytearray()
+        return bytes(out[:written])
+
+    def __record_into(self, data, final, out, counter):
+        """ Create single record of given plaintext into buffer and return its size.
+
+        :param counter: Sequence number of the record.
+        """
+        header_size = RECORD_HEADER.size
+        RECORD_HEADER.pack_into(out, 0, len(data) | (RECORD_FINAL if final else 0))
+        header = bytes(out[:header_size])
+        written = self.__records.seal_into(record_nonce(self.__iv, counter),
+                                           data, header, out[header_size:])
+        return header_size + written
+
+    def get_salt(self):
+        """ Return salt used for encryption key """
+        return self.__salt
+
+    def get_iv(self):
+        """ Get base of record nonces """
+        return self.__iv
+
+    def get_key_check(self):
+        """ Return key check value of the encryption key """
+        return self.__key_check
+
+    def get_cipher(self):
+        """ Name of the cipher used """
+        return self.__cipher
+
+
+class StreamDecryptor:
+    """ Decrypts record stream created by StreamEncryptor. Data of a record
+    is returned only after the record has been authenticated.
+
+    Complete records are held until a batch of them has been received and
+    the batch is then opened in parallel in cipher threads.
+    """
+
+    __records = None
+    __iv = None
+    __buffer = None
+    __counter = 0
+    __final = False
+    __batch = 1
+    __key_check = None
+
+    def __init__(self, password, salt, iv, cipher=CIPHER_GCM, batch=0):
+        """
+        :param password:    Password to use for key derivation, string or bytes.
+        :param salt:        Salt supplied by encryptor.
+        :param iv:          Base of record nonces supplied by encryptor.
+        :param cipher:      One of AEAD_CIPHERS.
+        :param batch:       Records opened at a time, 0 for one per cipher thread.
+        """
+        bpass = password if isinstance(password, bytes) else bytes(password, "utf-8")
+        if len(iv) != NONCE_SIZE:
+            raise ValueError("Invalid nonce for record stream.")
+        key = derive_key(bpass, salt)
+        self.__records = RecordCipher(key, cipher)
+        self.__key_check = key_check(key)
+        self.__iv = iv
+        self.__buffer = bytearray()
+        self.__batch = batch or cipher_workers()
+
+    def verify_key(self, check):
+        """ Whether key check value sent by encryptor matches the key
+        derived here, i.e. whether the password is right. """
+        return compare_digest(self.__key_check, check)
+
+    def decrypt(self, content):
+        """ Decrypt all complete records in given content.
+
+        :return:            Authenticated plaintext.
+        :raises ValueError: If a record fails authentication or data follows final record.
+        """
+        out = bytearray(self.output_size(len(content)))
+        written = self.decrypt_into(content, out)
+        return bytes(memoryview(out)[:written])
+
+    def decrypt_into(self, content, buf):
+        """ Decrypt all complete records in given content into preallocated buffer.
+
+        :param content:     Bytes-like part of record stream.
+        :param buf:         Writable buffer of at least output_size(len(content)) bytes.
+        :return:            Amount of authenticated plaintext bytes written to buffer.
+        :raises ValueError: If a record fails authentication or data follows final record.
+        """
+        self.__buffer += content
+        return self.__open_records(buf, False)
+
+    def output_size(self, length):
+        """ Buffer size decrypt_into() needs for given amount of content """
+        return len(self.__buffer) + length + BLOCK_SLACK
+
+    def finalize(self):
+        """ Open records still waiting for a batch and check that
+        stream ended with final record.
+
+        :return:            Authenticated plaintext of the remaining records.
+        :raises ValueError: If a record fails authentication or stream was cut short.
+        """
+        out = bytearray(self.output_size(0))
+        written = self.__open_records(out, True)
+        if not self.__final or self.__buffer:
+            raise ValueError("Encrypted stream ended unexpectedly.")
+        return bytes(out[:written])
+
+    def __open_records(self, buf, force):
+        """ Open complete records in buffer once there is a batch of them,
+        final record has been received or opening is forced. """
+        pos = 0
+        written = 0
+        final = self.__final
+        jobs = []
+        with memoryview(self.__buffer) as data, memoryview(buf) as out:
+            try:
+                while len(data) - pos >= RECORD_HEADER.size:
+                    if final:
+                        raise ValueError("Data after final record.")
+                    value, = RECORD_HEADER.unpack_from(data, pos)
+                    start = pos + RECORD_HEADER.size
+                    length = value & ~RECORD_FINAL
+                    if length > MAX_RECORD_SIZE:
+                        raise ValueError("Record %i is too long." % (self.__counter + len(jobs)))
+                    end = start + length + TAG_SIZE
+                    if len(data) < end:
+                        break
+                    jobs.append((data[start:end], bytes(data[pos:start]), out[written:], self.__counter + len(jobs)))
+                    written += length
+                    final = bool(value & RECORD_FINAL)
+                    pos = end
+
+                if len(jobs) < self.__batch and not final and not force:
+                    return 0
+                run_records(self.__open_record, jobs)
+            finally:
+                # Views have to be gone before buffers are released.
+                count = len(jobs)
+                jobs.clear()
+        self.__counter += count
+        self.__final = final
+        del self.__buffer[:pos]
+        return written
+
+    def __open_record(self, data, header, out, counter):
+        """ Open single record into buffer and return length of its plaintext.
+
+        :param counter:     Sequence number of the record.
+        :raises ValueError: If record fails authentication.
+        """
+        try:
+            return self.__records.open_into(record_nonce(self.__iv, counter), data, header, out)
+        except InvalidTag:
+            raise ValueError("Record %i failed authentication." % counter)
+
+    @staticmethod
+    def is_authenticated():
+        """ Whether decrypted data has been authenticated """
+        return True
+
+    def pending(self):
+        """ Bytes of incomplete record and records waiting for a batch """
+        return len(self.__buffer)
+
 
 class KeyGen:
 
@@ -0,0 +1,40 @@
+#   --- Turms ---
+#   Choosing event loop implementation
+#   application and server run on.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import asyncio
+
+from config import Config as Cfg
+
+# uvloop is optional. Default asyncio loop is used when it is not installed.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+LOOP_ASYNCIO = "asyncio"
+LOOP_UVLOOP = "uvloop"
+
+
+def available_loops():
+    """ Event loop implementations that can be used on this host """
+    return [LOOP_ASYNCIO, LOOP_UVLOOP] if uvloop else [LOOP_ASYNCIO]
+
+
+def install_event_loop(name=None):
+    """ Make event loops created after this call use given implementation.
+    Has to be called before any event loop is created. Falls back to asyncio
+    loop when requested implementation is not available.
+
+    :param name:    'asyncio' or 'uvloop', by default 'EventLoop' in configuration.
+    :return:        Name of the implementation in use.
+    """
+    if name is None:
+        name = Cfg.get_turms_val("EventLoop", LOOP_ASYNCIO)
+    if name.strip().lower() == LOOP_UVLOOP and uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return LOOP_UVLOOP
+    asyncio.set_event_loop_policy(None)
+    return LOOP_ASYNCIO
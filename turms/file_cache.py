@@ -0,0 +1,215 @@
+#   --- Turms ---
+#   Memory cache of small popular content
+#   files with popularity tracking and
+#   prefetching at startup.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+from collections import OrderedDict
+from os import fstat, stat, makedirs, replace
+from os.path import join, exists, dirname
+import io
+import json
+import tempfile
+
+import encrypt
+from logger import TurmsLogger as Logger
+
+# Popularity counts are halved after every AGING_PERIOD requests,
+# so that files no longer requested lose their place over time.
+AGING_PERIOD = 1000
+
+
+class CachedFile:
+    """ Content, checksum and version of a single cached file """
+
+    __slots__ = ("data", "checksum", "size", "mtime")
+
+    def __init__(self, data, checksum, size, mtime):
+        self.data = data
+        self.checksum = checksum
+        self.size = size
+        self.mtime = mtime
+
+
+class FileCache:
+    """ Size bounded LRU cache of plaintext content of small files.
+
+    Cached file is served from memory as long as size and modification
+    time of the file on disk stay the same, otherwise it is read again.
+    Checksum is computed once when file is read into cache.
+
+    Requests of every file are counted. Counts are aged so that they
+    follow recent popularity and saved to disk, so that the most popular
+    files can be read into cache already when server starts.
+    """
+
+    __content_path = None
+    __popularity_path = None
+    __capacity = 0
+    __max_file = 0
+
+    # Path -> CachedFile, least recently used first.
+    __entries = None
+    __used = 0
+
+    # Path -> aged request count and requests since last aging.
+    __popularity = None
+    __requests = 0
+
+    def __init__(self, content_path, popularity_path, capacity, max_file):
+        """
+        :param content_path:        Directory of shared files.
+        :param popularity_path:     File to keep request counts in.
+        :param capacity:            Maximum amount of cached content in bytes, 0 disables caching.
+        :param max_file:            Largest file to cache in bytes.
+        """
+        self.__content_path = content_path
+        self.__popularity_path = popularity_path
+        self.__capacity = max(0, capacity)
+        self.__max_file = min(max(0, max_file), self.__capacity)
+        self.__entries = OrderedDict()
+        self.__popularity = {}
+        self.load_popularity()
+
+    def load_popularity(self):
+        """ Read request counts from disk """
+        try:
+            with open(self.__popularity_path, "r") as f:
+                self.__popularity = {str(k): float(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            self.__popularity = {}
+
+    def save_popularity(self):
+        """ Write request counts to disk atomically """
+        try:
+            if not exists(dirname(self.__popularity_path)):
+                makedirs(dirname(self.__popularity_path))
+            handle, path = tempfile.mkstemp(suffix=".tmp", dir=dirname(self.__popularity_path))
+            with open(handle, "w") as f:
+                json.dump(self.__popularity, f)
+            replace(path, self.__popularity_path)
+        except OSError as e:
+            Logger.warning("Failed to save file popularity: %s" % e, "turms.server")
+
+    def popularity(self, san_path):
+        """ Return aged request count of a file """
+        return self.__popularity.get(san_path, 0)
+
+    def used(self):
+        """ Return amount of cached content in bytes """
+        return self.__used
+
+    def open(self, san_path):
+        """ Open content file, from cache if it has current version of it.
+        Counts the request towards popularity of the file.
+
+        :param san_path:    Sanitized path of the file.
+        :return:            Tuple of file object opened for reading and size
+                            of the file, or None, None if file is not found.
+        """
+        self.__count(san_path)
+        path = self.__path(san_path)
+
+        entry = self.__lookup(san_path, path)
+        if entry:
+            return io.BytesIO(entry.data), entry.size
+
+        try:
+            file = open(path, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            return None, None
+        st = fstat(file.fileno())
+        if self.__cacheable(st.st_size):
+            entry = self.__read(san_path, file, st)
+            if entry:
+                file.close()
+                return io.BytesIO(entry.data), entry.size
+            file.seek(0, 0)
+        return file, st.st_size
+
+    def checksum(self, san_path):
+        """ Return SHA256 checksum of cached file.
+
+        :return:    Checksum as bytes or None if current version of file is not cached.
+        """
+        entry = self.__lookup(san_path, self.__path(san_path))
+        return entry.checksum if entry else None
+
+    def invalidate(self, san_path):
+        """ Drop file from cache, f.e. when it has been replaced """
+        entry = self.__entries.pop(san_path, None)
+        if entry:
+            self.__used -= entry.size
+
+    def prefetch(self):
+        """ Read most popular files into cache, until cache is full """
+        if not self.__capacity:
+            return
+        count = 0
+        for san_path in sorted(self.__popularity, key=self.__popularity.get, reverse=True):
+            if san_path in self.__entries:
+                continue
+            try:
+                with open(self.__path(san_path), "rb") as file:
+                    st = fstat(file.fileno())
+                    if not self.__cacheable(st.st_size) or self.__used + st.st_size > self.__capacity:
+                        continue
+                    if self.__read(san_path, file, st):
+                        count += 1
+            except OSError:
+                # Removed since it was last requested.
+                continue
+        if count:
+            Logger.info("Prefetched %i popular files into memory." % count, "turms.server")
+
+    def __path(self, san_path):
+        """ Path of content file on disk """
+        return join(self.__content_path, *san_path.split("/"))
+
+    def __cacheable(self, size):
+        """ Whether file of given size fits in cache """
+        return 0 < size <= self.__max_file
+
+    def __lookup(self, san_path, path):
+        """ Return cached entry if file on disk hasn't changed since it was cached """
+        entry = self.__entries.get(san_path)
+        if entry is None:
+            return None
+        try:
+            st = stat(path)
+        except OSError:
+            st = None
+        if st is None or st.st_size != entry.size or st.st_mtime_ns != entry.mtime:
+            self.invalidate(san_path)
+            return None
+        self.__entries.move_to_end(san_path)
+        return entry
+
+    def __read(self, san_path, file, st):
+        """ Read opened file into cache, evicting least recently used files.
+
+        :return:    New entry or None if file changed while it was read.
+        """
+        data = file.read()
+        if len(data) != st.st_size:
+            return None
+        entry = CachedFile(data, encrypt.get_checksum(data), st.st_size, st.st_mtime_ns)
+
+        self.invalidate(san_path)
+        while self.__entries and self.__used + entry.size > self.__capacity:
+            _, evicted = self.__entries.popitem(last=False)
+            self.__used -= evicted.size
+        self.__entries[san_path] = entry
+        self.__used += entry.size
+        return entry
+
+    def __count(self, san_path):
+        """ Count request of a file and age counts periodically """
+        self.__popularity[san_path] = self.__popularity.get(san_path, 0) + 1
+        self.__requests += 1
+        if self.__requests < AGING_PERIOD:
+            return
+        self.__requests = 0
+        self.__popularity = {k: v / 2 for k, v in self.__popularity.items() if v >= 1}
+        self.save_popularity()
@@ -0,0 +1,143 @@
+#   --- Turms ---
+#   Tkinter file tree widget that inserts
+#   rows lazily and updates them in place
+#
+#   Sipi Ylä-Nojonen
+
+import tkinter as tk
+import tkinter.ttk as ttk
+
+import pathvalidate
+from pathvalidate import validate_filename
+
+from logger import TurmsLogger as Logger
+
+# Rows inserted at a time when view is scrolled near the end.
+PAGE_SIZE = 200
+
+# Names validated between UI updates.
+VALIDATE_BATCH = 1000
+
+
+class FileTree(ttk.Frame):
+    """ Treeview of file names with a scrollbar.
+
+    Only rows scrolled into view are inserted into Treeview. Next page is
+    inserted once view is scrolled near the end of inserted rows. New
+    listings are validated in batches between UI updates and applied as
+    a diff to rows already shown instead of rebuilding all of them.
+    Row ids are the names themselves, names are unique within a listing.
+    """
+
+    __tree = None
+    __scrollbar = None
+
+    # Validated names in listing order and how many
+    # of them from the beginning are inserted as rows.
+    __items = None
+    __rendered = 0
+
+    # Pending validation job scheduled with after()
+    __job = None
+
+    def __init__(self, master, **kwargs):
+        super().__init__(master, **kwargs)
+        self.__items = []
+
+        self.__tree = ttk.Treeview(self, columns=["filename", "filesize"], selectmode="extended")
+        self.__tree.heading("filename", text="File name")
+        self.__tree.heading("filesize", text="File size")
+
+        self.__scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.__tree.yview)
+        self.__tree.configure(yscrollcommand=self.__on_scroll)
+
+        self.__tree.grid(row=0, column=0, sticky="NSEW")
+        self.__scrollbar.grid(row=0, column=1, sticky="NS")
+
+    def bind_rows(self, sequence, func):
+        """ Bind event of the row view to function """
+        self.__tree.bind(sequence, func)
+
+    def update_items(self, names):
+        """ Show new listing. Names are validated in batches and
+        changes are applied once whole listing has been validated.
+
+        :param names:   List of names. Directory names end with '/' and
+                        '../' is the parent directory.
+        """
+        # Newer listing replaces one still being validated.
+        if self.__job:
+            self.after_cancel(self.__job)
+        self.__job = self.after_idle(self.__validate, list(names), 0, [], set())
+
+    def focused(self):
+        """ Name of focused row or empty string if there is none """
+        return self.__tree.focus()
+
+    def selected(self):
+        """ Names of selected rows in listing order """
+        return list(self.__tree.selection())
+
+    def __validate(self, names, start, valid, seen):
+        """ Validate one batch of names and schedule next one """
+        end = start + VALIDATE_BATCH
+        for name in names[start:end]:
+            if name in seen:
+                continue
+            try:
+                if name != "../":
+                    validate_filename(name.rstrip("/"))     # Check that print is a valid filename
+                valid.append(name)
+                seen.add(name)
+            except pathvalidate.ValidationError:
+                Logger.warning("Ignoring invalid filename in response.")
+
+        if end < len(names):
+            # Let window update before next batch.
+            self.__job = self.after(1, self.__validate, names, end, valid, seen)
+        else:
+            self.__job = None
+            self.__apply(valid)
+
+    def __apply(self, items):
+        """ Change inserted rows to match new listing.
+
+        :param items:   Validated, unique names in listing order.
+        """
+        tree = self.__tree
+        listed = set(items)
+
+        # Rows no longer in listing
+        removed = [iid for iid in tree.get_children() if iid not in listed]
+        if removed:
+            tree.delete(*removed)
+
+        # Keep as many rows inserted as there were, at least one page.
+        count = min(len(items), max(self.__rendered, PAGE_SIZE))
+        for index, name in enumerate(items[:count]):
+            if not tree.exists(name):
+                tree.insert("", index, iid=name, values=(name,))
+            elif tree.index(name) != index:
+                tree.move(name, "", index)
+
+        # Rows that moved past inserted part of listing
+        extra = tree.get_children()[count:]
+        if extra:
+            tree.delete(*extra)
+
+        self.__items = items
+        self.__rendered = count
+
+    def __on_scroll(self, first, last):
+        """ Scroll command of the row view. Inserts next page of
+        rows when view is near the end of inserted rows. """
+        self.__scrollbar.set(first, last)
+        if float(last) > 0.9 and self.__rendered < len(self.__items):
+            self.after_idle(self.__render_more)
+
+    def __render_more(self):
+        """ Insert next page of rows """
+        end = min(len(self.__items), self.__rendered + PAGE_SIZE)
+        for name in self.__items[self.__rendered:end]:
+            self.__tree.insert("", tk.END, iid=name, values=(name,))
+        self.__rendered = end
@@ -0,0 +1,404 @@
+#   --- Turms ---
+#   Load generator measuring how many
+#   concurrent clients a local server
+#   can sustain.
+#
+#   Sipi Ylä-Nojonen, 2022
+#
+#   Usage: python loadgen.py [--clients 16] [--duration 30] [--files 100]
+#                            [--sizes 4K:60,256K:30,4M:10] [--mix list:1,head:1,download:2]
+#
+#   Server is run in its own process in a temporary directory on a generated
+#   dataset, so that clients don't share event loop with it. Each simulated
+#   client connects with its own ConnectionHandler and downloads files with
+#   the same code as the application, including decryption and verification.
+#   Results are printed as JSON.
+
+import argparse
+import asyncio
+import collections
+import configparser
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import eventloop
+from watchdog import percentile
+
+# Fraction of file count to size class, as 'size:weight' pairs.
+DEFAULT_SIZES = "4K:60,256K:30,4M:10"
+# Operations simulated clients do, as 'operation:weight' pairs.
+DEFAULT_MIX = "list:1,head:1,download:2"
+
+OP_LIST = "list"
+OP_HEAD = "head"
+OP_DOWNLOAD = "download"
+OPERATIONS = (OP_LIST, OP_HEAD, OP_DOWNLOAD)
+
+PERCENTILES = (50, 95, 99)
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# Seconds to wait for server process to start listening.
+STARTUP_TIMEOUT = 60
+# Errors raised by each operation printed as they happen, and
+# most common ones listed in results.
+LOGGED_ERRORS = 5
+
+
+def parse_size(text):
+    """ Size in bytes from f.e. '256K' or '4M' """
+    text = text.strip().upper()
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_weights(text, parse_key=str):
+    """ List of (key, weight) from comma separated 'key:weight' pairs """
+    weights = []
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        key, _, weight = item.partition(":")
+        weights.append((parse_key(key), float(weight or 1)))
+    if not weights or sum(w for _, w in weights) <= 0:
+        raise ValueError("No positive weights in '%s'." % text)
+    return weights
+
+
+def generate_dataset(count, sizes, rng):
+    """ Write content files with random data of sizes drawn from given distribution.
+
+    :return:    List of (name, size) of the files.
+    """
+    os.makedirs("content", exist_ok=True)
+    choices = rng.choices([s for s, _ in sizes], [w for _, w in sizes], k=count)
+    files = []
+    for i, size in enumerate(choices):
+        name = "file%04i.bin" % i
+        with open(os.path.join("content", name), "wb") as f:
+            f.write(os.urandom(size))
+        files.append((name, size))
+    return files
+
+
+def free_port():
+    """ Port on loopback interface nothing listens on """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(port, overrides):
+    """ Write configuration shared by server and clients in working directory.
+
+    :param port:        HTTPS port of the server.
+    :param overrides:   List of 'Key=Value' strings of other settings.
+    """
+    from config import Config as Cfg, CFG_FILE_NAME
+
+    Cfg.create_config()
+    parser = configparser.ConfigParser()
+    parser.read(CFG_FILE_NAME)
+    settings = parser["TURMS"]
+    settings["Ip-Address"] = "127.0.0.1"
+    settings["SSLPort"] = str(port)
+    settings["UseTLS"] = "True"
+    # Every download should reach the server.
+    settings["LocalCache"] = "False"
+    settings["DeltaTransfer"] = "False"
+    # All simulated clients share loopback address.
+    settings["RequestRate"] = "0"
+    settings["MaxClientRequests"] = "0"
+    for item in overrides:
+        key, _, value = item.partition("=")
+        settings[key.strip()] = value.strip()
+    with open(CFG_FILE_NAME, "w") as f:
+        parser.write(f)
+
+
+def wait_for_port(port, process):
+    """ Block until server accepts connections.
+
+    :raises RuntimeError:   If server process exits or doesn't start in time.
+    """
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server process exited with code %i." % process.returncode)
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start in %i seconds." % STARTUP_TIMEOUT)
+
+
+def serve(password, timeout=24 * 3600, setup=None):
+    """ Run server in this process until terminated
+
+    :param password:    Encryption password of the server.
+    :param timeout:     Seconds after which server stops by itself.
+    :param setup:       Called in event loop before server starts, f.e. to start monitoring.
+    """
+    # Same import order as in application, modules import each other.
+    import download_manager
+    import server
+
+    eventloop.install_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = server.TurmsApp(password)
+
+    # Stop server cleanly when terminated, so that it saves its state.
+    def terminate():
+        app.stop()
+        loop.call_later(0.1, loop.stop)
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+
+    if setup:
+        setup()
+    app.run(timeout=timeout)
+    loop.run_forever()
+
+
+class NullController:
+    """ Controller callbacks of ConnectionHandler without a view """
+
+    def update_filetree(self, names):
+        pass
+
+    def state_to_disconnect(self):
+        pass
+
+
+def timed_connection():
+    """ Create ConnectionHandler recording time to first byte of responses.
+
+    :return:    Tuple of connection handler and Transfer class.
+    """
+    # Same import order as in application, modules import each other.
+    import download_manager
+    from connection_handler import ConnectionHandler
+
+    class TimedConnection(ConnectionHandler):
+        """ Records time until status line of first response to a path
+        with given prefix is received, since the request was made. """
+
+        ttfb = None
+        __prefix = ""
+
+        def begin(self, prefix):
+            """ Start timing next request to path starting with prefix """
+            self.__prefix = prefix
+            self.ttfb = None
+
+        def __timed(self, path, header_cb):
+            """ Wrap header callback to record first byte of the response """
+            if self.ttfb is not None or not path.startswith(self.__prefix):
+                return header_cb
+            start = time.perf_counter()
+
+            def on_header(line):
+                if self.ttfb is None:
+                    self.ttfb = time.perf_counter() - start
+                if header_cb:
+                    header_cb(line)
+            return on_header
+
+        async def get_request(self, path="/", timeout=10, header_cb=None, streaming_cb=None, headers=None):
+            return await super().get_request(path, timeout, self.__timed(path, header_cb), streaming_cb, headers)
+
+        @staticmethod
+        def create_session():
+            """ Own HTTP client for every simulated client, so that a client
+            disconnecting doesn't close the client others still use. """
+            import tornado.httpclient
+            return tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    return TimedConnection(), download_manager.Transfer
+
+
+class Results:
+    """ Latencies and errors of operations of all clients """
+
+    def __init__(self, window=None):
+        """
+        :param window:  Latencies of this many latest operations are kept, all by default.
+        """
+        self.completion = {op: collections.deque(maxlen=window) for op in OPERATIONS}
+        self.ttfb = {op: collections.deque(maxlen=window) for op in OPERATIONS}
+        self.count = {op: 0 for op in OPERATIONS}
+        self.errors = {op: 0 for op in OPERATIONS}
+        self.failures = {op: collections.Counter() for op in OPERATIONS}
+        self.bytes = 0
+
+    def record(self, op, ok, completion, ttfb, size=0):
+        if not ok:
+            self.errors[op] += 1
+            return
+        self.count[op] += 1
+        self.completion[op].append(completion)
+        if ttfb is not None:
+            self.ttfb[op].append(ttfb)
+        self.bytes += size
+
+    def record_error(self, op, error):
+        """ Count operation that raised an error. First errors of each operation
+        are printed, since application logging is disabled while measuring. """
+        self.errors[op] += 1
+        message = "%s: %s" % (type(error).__name__, error)
+        self.failures[op][message] += 1
+        if self.errors[op] <= LOGGED_ERRORS:
+            print("%s failed with %s" % (op, message), file=sys.stderr)
+
+    def summary(self, elapsed, clients):
+        """ Results as a dictionary, times in milliseconds """
+        def stats(samples):
+            samples = sorted(samples)
+            return {"p%i" % pct: round(percentile(samples, pct) * 1000, 3) for pct in PERCENTILES}
+
+        requests = sum(self.count.values())
+        return {"clients": clients,
+                "duration": round(elapsed, 3),
+                "requests": requests,
+                "errors": sum(self.errors.values()),
+                "requests_per_second": round(requests / elapsed, 3),
+                "bytes": self.bytes,
+                "throughput": round(self.bytes / elapsed, 1),
+                "operations": {op: {"count": self.count[op],
+                                    "errors": self.errors[op],
+                                    "failures": dict(self.failures[op].most_common(LOGGED_ERRORS)),
+                                    "ttfb_ms": stats(self.ttfb[op]),
+                                    "completion_ms": stats(self.completion[op])}
+                               for op in OPERATIONS}}
+
+
+async def client(index, port, password, files, mix, deadline, requests, results, rng):
+    """ Run operations drawn from mix until deadline or request count is reached """
+    controller = NullController()
+    conn, Transfer = timed_connection()
+    if not await conn.connect_to_server("127.0.0.1", port, controller):
+        raise RuntimeError("Client %i could not connect to server." % index)
+
+    download_dir = os.path.abspath(os.path.join("downloads", "client%i" % index))
+    os.makedirs(download_dir, exist_ok=True)
+    ops = [op for op, _ in mix]
+    weights = [w for _, w in mix]
+    done = 0
+    try:
+        while time.monotonic() < deadline and (not requests or done < requests):
+            op = rng.choices(ops, weights)[0]
+            name, size = rng.choice(files)
+            start = time.perf_counter()
+            try:
+                if op == OP_LIST:
+                    conn.begin("/dir/")
+                    ok = await conn.fetch_server_content(controller, "")
+                    results.record(op, ok, time.perf_counter() - start, conn.ttfb)
+                elif op == OP_HEAD:
+                    response = await conn.head_request("/download/%s" % name)
+                    elapsed = time.perf_counter() - start
+                    # Response of HEAD has no body, so first byte is all of it.
+                    results.record(op, response is not None, elapsed, elapsed)
+                else:
+                    location = os.path.join(download_dir, name)
+                    transfer = Transfer(name, location)
+                    transfer.get_downloader().decrypt_param("password", password)
+                    transfer.start()
+                    conn.begin("/download/")
+                    ok = await conn.fetch_file_from_server(transfer, controller)
+                    results.record(op, ok, time.perf_counter() - start, conn.ttfb, size)
+                    if os.path.exists(location):
+                        os.remove(location)
+            except Exception as e:
+                results.record_error(op, e)
+            done += 1
+    finally:
+        conn.disconnect_from_server(controller)
+
+
+async def run_clients(args, port, files, mix):
+    """ Run all clients concurrently and return results. Every client
+    has its own HTTP client, so their requests don't queue for connections. """
+    results = Results()
+    start = time.monotonic()
+    deadline = start + args.duration if args.duration else float("inf")
+    await asyncio.gather(*(client(i, port, args.password, files, mix, deadline, args.requests, results,
+                                  random.Random("%s-%i" % (args.seed, i)))
+                           for i in range(args.clients)))
+    return results.summary(time.monotonic() - start, args.clients)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how many concurrent clients a local server sustains.")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent simulated clients.")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="Seconds to run, 0 to run until every client has done --requests.")
+    parser.add_argument("--requests", type=int, default=0, help="Operations per client, 0 for no limit.")
+    parser.add_argument("--files", type=int, default=100, help="Files in generated dataset.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="File size distribution as size:weight pairs.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Operation mix as operation:weight pairs of %s."
+                                                           % ", ".join(OPERATIONS))
+    parser.add_argument("--password", default="loadgen", help="Encryption password of the server.")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override configuration value of server and clients, can be repeated.")
+    parser.add_argument("--seed", default="turms", help="Seed of dataset and operation choices.")
+    parser.add_argument("--output", help="Write results to file instead of standard output.")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        logging.disable(logging.CRITICAL)
+        serve(args.password)
+        return
+
+    if not args.duration and not args.requests:
+        parser.error("Either --duration or --requests has to be given.")
+    sizes = parse_weights(args.sizes, parse_size)
+    mix = parse_weights(args.mix)
+    for op, _ in mix:
+        if op not in OPERATIONS:
+            parser.error("Unknown operation '%s'." % op)
+
+    output = os.path.abspath(args.output) if args.output else None
+    here = os.path.dirname(os.path.abspath(__file__))
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        port = free_port()
+        write_config(port, args.set)
+        files = generate_dataset(args.files, sizes, random.Random(args.seed))
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([here, os.environ.get("PYTHONPATH", "")]))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve",
+                                    "--password", args.password], cwd=workdir, env=env)
+        try:
+            wait_for_port(port, process)
+            used = eventloop.install_event_loop()
+            result = asyncio.run(run_clients(args, port, files, mix))
+        finally:
+            process.terminate()
+            process.wait()
+            os.chdir(here)
+
+    result["files"] = len(files)
+    result["dataset_bytes"] = sum(size for _, size in files)
+    result["event_loop"] = used
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,30 @@ DEFAULT_SERVER_LOG = "./logs/turms-server-latest.log"
 DEFAULT_TORNADO_LOG = "./logs/tornado-latest.log"
 
 
+class ExceptionFilter(logging.Filter):
+    """ Drop log records of given exception types. Exception is looked up
+    from the whole chain of exceptions raised while handling another one,
+    since f.e. tornado wraps exceptions raised in callbacks. """
+
+    def __init__(self, types):
+        super().__init__()
+        self.__types = tuple(types)
+
+    def filter_types(self):
+        """ Exception types this filter drops """
+        return self.__types
+
+    def filter(self, record):
+        exc = record.exc_info[1] if record.exc_info else None
+        seen = set()
+        while exc is not None and id(exc) not in seen:
+            if isinstance(exc, self.__types):
+                return False
+            seen.add(id(exc))
+            exc = exc.__cause__ or exc.__context__
+        return True
+
+
 class TurmsLogger:
 
     @staticmethod
@@ -105,6 +129,20 @@ class TurmsLogger:
         except ValueError:
             TurmsLogger.warning("Undefined level for logger.")
 
+    @staticmethod
+    def ignore_exceptions(name, *types):
+        """
+        Stop logger from logging records of exceptions that are raised on purpose.
+
+        :param name:    Name of the logger.
+        :param types:   Exception classes to ignore.
+        """
+        logger = logging.getLogger(name)
+        for f in logger.filters:
+            if isinstance(f, ExceptionFilter) and f.filter_types() == tuple(types):
+                return
+        logger.addFilter(ExceptionFilter(types))
+
     # Shortcuts for different levels of logging
     # with 'getLogger(name).method(msg)'
 
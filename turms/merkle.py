@@ -0,0 +1,125 @@
+#   --- Turms ---
+#   Per block hashes and Merkle tree root
+#   for verifying downloaded files block
+#   by block.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+from cryptography.hazmat.primitives import hashes
+
+DEFAULT_BLOCK_SIZE = 1048576
+
+
+def sha256(data):
+    """ SHA256 digest of bytes """
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(data)
+    return digest.finalize()
+
+
+def block_hashes(file, block_size=DEFAULT_BLOCK_SIZE):
+    """ Compute hash of every block of file content.
+
+    :param file:        File object opened for reading.
+    :param block_size:  Size of single block. Last block may be shorter.
+    :return:            List of block digests.
+    """
+    result = []
+    block = file.read(block_size)
+    while block:
+        result.append(sha256(block))
+        block = file.read(block_size)
+    return result
+
+
+def merkle_root(leaves):
+    """ Compute Merkle tree root of block hashes. Odd node
+    at the end of a level is paired with itself.
+
+    :param leaves:  List of block digests.
+    :return:        Root digest.
+    """
+    if not leaves:
+        return sha256(b"")
+
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [sha256(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class BlockVerifier:
+    """ Verifies stream of data block by block against known block hashes.
+    Verification goes on past failed blocks, so that all of them can be
+    requested again afterwards.
+    """
+
+    __block_size = 0
+    __hashes = None
+    __digest = None
+    __block = 0
+    __filled = 0
+    __failed = None
+
+    def __init__(self, block_size, hashes_):
+        """
+        :param block_size:  Size of single block.
+        :param hashes_:     List of expected block digests.
+        """
+        self.__block_size = block_size
+        self.__hashes = hashes_
+        self.__failed = []
+        self.start_at(0)
+
+    def block_size(self):
+        """ Size of single verified block """
+        return self.__block_size
+
+    def start_at(self, offset):
+        """ Start verifying from given block aligned byte offset """
+        self.__block = offset // self.__block_size
+        self.__filled = 0
+        self.__digest = hashes.Hash(hashes.SHA256())
+
+    def update(self, data):
+        """ Add received data and verify every block it completes """
+        view = memoryview(data)
+        while len(view) > 0:
+            take = min(len(view), self.__block_size - self.__filled)
+            self.__digest.update(view[:take])
+            self.__filled += take
+            view = view[take:]
+            if self.__filled == self.__block_size:
+                self.__verify()
+
+    def finish(self):
+        """ Verify last, possibly partial, block """
+        if self.__filled > 0:
+            self.__verify()
+
+    def failed_ranges(self):
+        """ Return byte ranges of blocks that failed verification and forget them.
+        Adjacent blocks are merged into single range.
+
+        :return:    List of tuples of offset and length.
+        """
+        ranges = []
+        for block in sorted(self.__failed):
+            offset = block * self.__block_size
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + self.__block_size)
+            else:
+                ranges.append((offset, self.__block_size))
+        self.__failed = []
+        return ranges
+
+    def __verify(self):
+        """ Compare finished block to its hash and move on to next block """
+        index = self.__block
+        if index >= len(self.__hashes) or self.__digest.finalize() != self.__hashes[index]:
+            self.__failed.append(index)
+        self.__block += 1
+        self.__filled = 0
+        self.__digest = hashes.Hash(hashes.SHA256())
@@ -0,0 +1,51 @@
+#   --- Turms ---
+#   Tkinter widget showing progress,
+#   throughput and ETA of downloads
+#
+#   Sipi Ylä-Nojonen
+
+import tkinter as tk
+import tkinter.ttk as ttk
+
+from telemetry import format_size
+
+
+class TransferProgress(ttk.Frame):
+    """ Progress bar of all active downloads together and
+    a status line of each of them below it. """
+
+    __bar = None
+    __text = None
+
+    def __init__(self, master, **kwargs):
+        super().__init__(master, **kwargs)
+        self.__text = tk.StringVar(value="No active downloads.")
+
+        self.__bar = ttk.Progressbar(self, orient=tk.HORIZONTAL, mode="determinate", maximum=100)
+        label = ttk.Label(self, textvariable=self.__text, justify=tk.LEFT)
+
+        self.__bar.grid(row=0, column=0, sticky="EW")
+        label.grid(row=1, column=0, sticky="W")
+        self.grid_columnconfigure(0, weight=1)
+
+    def show(self, stats):
+        """ Show progress of active downloads.
+
+        :param stats:   List of TransferStats of active downloads.
+        """
+        if not stats:
+            self.__bar["value"] = 0
+            self.__text.set("No active downloads.")
+            return
+
+        # Downloads of unknown size can't be shown in the bar.
+        sized = [s for s in stats if s.get_total()]
+        total = sum(s.get_total() for s in sized)
+        done = sum(min(s.get_done(), s.get_total()) for s in sized)
+        self.__bar["value"] = done / total * 100 if total else 0
+
+        lines = [s.status() for s in stats]
+        in_flight = sum(s.in_flight() for s in stats)
+        if in_flight:
+            lines.append("%s waiting for decryption" % format_size(in_flight))
+        self.__text.set("\n".join(lines))
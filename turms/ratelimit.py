@@ -0,0 +1,130 @@
+#   --- Turms ---
+#   Per address request rate limits and
+#   caps of requests in progress, checked
+#   before server does any work for them.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import math
+import time
+from collections import OrderedDict
+
+# Addresses tracked at most. Idle addresses are forgotten
+# first when table is full, so memory use stays bounded.
+MAX_CLIENTS = 65536
+
+
+class ClientState:
+    """ Request tokens and requests in progress of a single address """
+
+    __slots__ = ("tokens", "stamp", "active")
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+        self.active = 0
+
+
+class RateLimiter:
+    """ Limits rate of requests and amount of requests in progress per address.
+
+    Each address has a token bucket refilled at request rate up to burst.
+    Entry of an address is dropped once its bucket would be full again and
+    it has no requests in progress, since it is then no different from an
+    address not seen before. Table is roughly ordered by last use, so
+    expired entries are found from its beginning.
+    """
+
+    __rate = 0.0
+    __burst = 0.0
+    __max_active = 0
+    __max_clients = MAX_CLIENTS
+    __clients = None
+
+    def __init__(self, rate, burst, max_active, max_clients=MAX_CLIENTS):
+        """
+        :param rate:        Requests per second allowed from an address, 0 for no limit.
+        :param burst:       Requests address may send at once after being idle.
+        :param max_active:  Requests address may have in progress, 0 for no limit.
+        :param max_clients: Addresses tracked at most.
+        """
+        self.__rate = max(0.0, float(rate))
+        self.__burst = max(1.0, float(burst), self.__rate)
+        self.__max_active = max(0, int(max_active))
+        self.__max_clients = max(1, max_clients)
+        self.__clients = OrderedDict()
+
+    def enabled(self):
+        """ Whether any limit is set """
+        return bool(self.__rate or self.__max_active)
+
+    def tracked(self):
+        """ Return amount of addresses in table """
+        return len(self.__clients)
+
+    def acquire(self, address):
+        """ Admit request from address if it is within limits.
+        Admitted request has to be released once it is finished.
+
+        :param address: Remote address of the request.
+        :return:        0 if request was admitted, otherwise seconds
+                        after which client should try again.
+        """
+        if not self.enabled():
+            return 0
+        now = time.monotonic()
+        self.__expire(now)
+
+        state = self.__clients.get(address)
+        if state is None:
+            self.__evict()
+            state = ClientState(self.__burst, now)
+            self.__clients[address] = state
+        else:
+            self.__clients.move_to_end(address)
+            if self.__rate:
+                state.tokens = min(self.__burst, state.tokens + (now - state.stamp) * self.__rate)
+            state.stamp = now
+
+        if self.__max_active and state.active >= self.__max_active:
+            return 1
+        if self.__rate:
+            if state.tokens < 1:
+                return max(1, math.ceil((1 - state.tokens) / self.__rate))
+            state.tokens -= 1
+        state.active += 1
+        return 0
+
+    def release(self, address):
+        """ Mark admitted request from address finished """
+        state = self.__clients.get(address)
+        if state and state.active:
+            state.active -= 1
+
+    def __idle_time(self):
+        """ Seconds after which empty bucket is full again """
+        return self.__burst / self.__rate if self.__rate else 0
+
+    def __expire(self, now):
+        """ Drop least recently used entries that have expired """
+        idle = self.__idle_time()
+        for _ in range(len(self.__clients)):
+            address, state = next(iter(self.__clients.items()))
+            if state.active:
+                # Requests still in progress, look at it again later.
+                self.__clients.move_to_end(address)
+            elif now - state.stamp >= idle:
+                del self.__clients[address]
+            else:
+                break
+
+    def __evict(self):
+        """ Drop least recently used idle entries to make room for a new one """
+        for _ in range(len(self.__clients)):
+            if len(self.__clients) < self.__max_clients:
+                break
+            address, state = next(iter(self.__clients.items()))
+            if state.active:
+                self.__clients.move_to_end(address)
+            else:
+                del self.__clients[address]
@@ -0,0 +1,257 @@
+#   --- Turms ---
+#   Replaying captured server traffic
+#   against a local server at recorded
+#   or accelerated speed.
+#
+#   Sipi Ylä-Nojonen, 2022
+#
+#   Usage: python replay.py TRACE [--speed 1] [--set KEY=VALUE] [--output FILE]
+#
+#   Capture traffic by setting 'TraceFile' in server configuration. Replay
+#   runs a server in its own process in a temporary directory with content
+#   files of the sizes seen in the trace. Requests are sent at the times they
+#   started in the trace, divided by speed, whether earlier ones have finished
+#   or not, so that concurrency follows the trace as long as server keeps up.
+#   Only GET and HEAD requests are replayed since other requests need bodies
+#   that are not captured. Results are printed as JSON.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+import eventloop
+import loadgen
+import traffic
+from watchdog import percentile
+
+REPLAYED_METHODS = ("GET", "HEAD")
+# Paths that name a content file after their first component.
+FILE_PATHS = ("download", "blocks", "delta")
+# Paths that name a content directory.
+DIRECTORY_PATHS = ("dir", "manifest")
+
+
+def category(path):
+    """ First component of request path, f.e. 'download' or 'dir' """
+    return path.strip("/").split("/", 1)[0] or "index"
+
+
+def content_path(path):
+    """ Path of content file or directory request refers to, relative
+    to content directory, or None if it doesn't refer to one. """
+    _, _, rest = path.lstrip("/").partition("/")
+    parts = [p for p in unquote(rest).split("/") if p]
+    if any(p in (".", "..") for p in parts):
+        return None
+    return os.path.join(*parts) if parts else ""
+
+
+def build_content(entries):
+    """ Create content directories and files with random data for paths
+    in trace, files as large as the largest size recorded for them.
+
+    :return:    Amount of files created.
+    """
+    sizes = {}
+    for entry in entries:
+        path = content_path(entry.path)
+        if path is None:
+            continue
+        if category(entry.path) in DIRECTORY_PATHS:
+            os.makedirs(os.path.join("content", path), exist_ok=True)
+        elif category(entry.path) in FILE_PATHS and entry.filesize is not None and path:
+            sizes[path] = max(sizes.get(path, 0), entry.filesize)
+
+    for path, size in sizes.items():
+        target = os.path.join("content", path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(os.urandom(size))
+    return len(sizes)
+
+
+class Replayer:
+    """ Sends requests of a trace at their scheduled times and collects results """
+
+    def __init__(self, port, speed, headers):
+        """
+        :param port:    HTTPS port of local server.
+        :param speed:   Factor to speed up replay with, 1 for recorded speed.
+        :param headers: Headers sent with every request.
+        """
+        import tornado.httpclient
+
+        self.url = "https://127.0.0.1:%i" % port
+        self.speed = speed
+        self.headers = headers
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.active = 0
+        self.peak = 0
+        self.lateness = []
+        self.bytes = 0
+        self.skipped = 0
+        self.results = {}
+
+    def result(self, name):
+        """ Results of a request category """
+        return self.results.setdefault(name, {"count": 0, "errors": 0, "status_mismatches": 0,
+                                              "ttfb": [], "completion": [], "recorded": []})
+
+    async def replay(self, entries):
+        """ Replay entries and return elapsed seconds """
+        start = time.monotonic()
+        await asyncio.gather(*(self.send(entry, start) for entry in entries))
+        return time.monotonic() - start
+
+    async def send(self, entry, start):
+        """ Send request of a trace entry once its time has come """
+        import tornado.httpclient
+
+        if entry.method not in REPLAYED_METHODS:
+            self.skipped += 1
+            return
+
+        scheduled = start + entry.start / 1000 / self.speed
+        await asyncio.sleep(max(0.0, scheduled - time.monotonic()))
+        self.lateness.append(max(0.0, time.monotonic() - scheduled))
+
+        result = self.result(category(entry.path))
+        headers = dict(self.headers)
+        if entry.range:
+            headers["Range"] = entry.range
+
+        first_byte = []
+        received = []
+
+        def on_header(line):
+            if not first_byte:
+                first_byte.append(time.perf_counter())
+
+        request = tornado.httpclient.HTTPRequest(self.url + entry.path, entry.method, headers=headers,
+                                                 validate_cert=False, request_timeout=300,
+                                                 header_callback=on_header,
+                                                 streaming_callback=lambda chunk: received.append(len(chunk)))
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        began = time.perf_counter()
+        try:
+            response = await self.client.fetch(request, raise_error=False)
+        finally:
+            self.active -= 1
+        completion = time.perf_counter() - began
+
+        result["count"] += 1
+        if response.code == 599:
+            result["errors"] += 1
+            return
+        if entry.status and response.code != entry.status:
+            result["status_mismatches"] += 1
+        result["completion"].append(completion)
+        if first_byte:
+            result["ttfb"].append(first_byte[0] - began)
+        if entry.duration is not None:
+            result["recorded"].append(entry.duration / 1000)
+        self.bytes += sum(received)
+
+    def summary(self, entries, elapsed):
+        """ Results as a dictionary, times in milliseconds """
+        def stats(samples):
+            samples = sorted(samples)
+            return {"p%i" % pct: round(percentile(samples, pct) * 1000, 3) for pct in loadgen.PERCENTILES}
+
+        requests = sum(r["count"] for r in self.results.values())
+        return {"trace_requests": len(entries),
+                "requests": requests,
+                "skipped": self.skipped,
+                "errors": sum(r["errors"] for r in self.results.values()),
+                "speed": self.speed,
+                "duration": round(elapsed, 3),
+                "requests_per_second": round(requests / elapsed, 3) if elapsed else 0.0,
+                "bytes": self.bytes,
+                "throughput": round(self.bytes / elapsed, 1) if elapsed else 0.0,
+                "recorded_peak_concurrency": max((e.concurrency for e in entries), default=0),
+                "peak_concurrency": self.peak,
+                "lateness_ms": stats(self.lateness),
+                "categories": {name: {"count": r["count"],
+                                      "errors": r["errors"],
+                                      "status_mismatches": r["status_mismatches"],
+                                      "ttfb_ms": stats(r["ttfb"]),
+                                      "completion_ms": stats(r["completion"]),
+                                      "recorded_ms": stats(r["recorded"])}
+                               for name, r in sorted(self.results.items())}}
+
+
+async def run_replay(entries, port, speed):
+    """ Replay trace against server and return results """
+    import tornado.httpclient
+    # Same import order as in application, modules import each other.
+    import download_manager
+    from connection_handler import ConnectionHandler
+
+    # Requests are not queued behind connection limit of the client,
+    # server should see as many concurrent requests as in the trace.
+    peak = max((e.concurrency for e in entries), default=0)
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=max(10, 2 * peak))
+
+    replayer = Replayer(port, speed, ConnectionHandler.cipher_headers())
+    elapsed = await replayer.replay(entries)
+    return replayer.summary(entries, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a local server.")
+    parser.add_argument("trace", help="Trace file captured by server.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, f.e. 10 for ten times faster.")
+    parser.add_argument("--password", default="replay", help="Encryption password of the server.")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override configuration value of server, can be repeated.")
+    parser.add_argument("--output", help="Write results to file instead of standard output.")
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error("Speed has to be positive.")
+    try:
+        entries = traffic.read_trace(args.trace)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    output = os.path.abspath(args.output) if args.output else None
+    here = os.path.dirname(os.path.abspath(__file__))
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        port = loadgen.free_port()
+        loadgen.write_config(port, args.set)
+        files = build_content(entries)
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([here, os.environ.get("PYTHONPATH", "")]))
+        process = subprocess.Popen([sys.executable, os.path.join(here, "loadgen.py"), "--serve",
+                                    "--password", args.password], cwd=workdir, env=env)
+        try:
+            loadgen.wait_for_port(port, process)
+            used = eventloop.install_event_loop()
+            result = asyncio.run(run_replay(entries, port, args.speed))
+        finally:
+            process.terminate()
+            process.wait()
+            os.chdir(here)
+
+    result["files"] = files
+    result["event_loop"] = used
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,38 @@
 #
 #   Sipi Ylä-Nojonen, 2022
 
+import asyncio
 import pathvalidate
-from tornado import web, iostream, gen
+from tornado import web, iostream
 import tornado.httputil as tutil
 import base64
+import json
+import tempfile
 
+import admission
+import delta
 import encrypt
 import server
+import traffic
 
 CHUNK_SIZE = 4096
 
 from logger import TurmsLogger as Logger
 from server_file_handler import ServerFileHandler as Sfh
+from send_pipeline import SendPipeline, CHUNK_SIZE as PIPELINE_CHUNK_SIZE
 from config import Config as Cfg
+from cryptography.hazmat.primitives import hashes
+
+
+def file_chunks(file, size):
+    """ Generate chunks of file from its current position and close it once read """
+    try:
+        chunk = file.read(size)
+        while chunk:
+            yield chunk
+            chunk = file.read(size)
+    finally:
+        file.close()
 
 
 class TurmsRequestHandler(web.RequestHandler):
@@ -33,6 +52,15 @@ class TurmsRequestHandler(web.RequestHandler):
     # content by not accepting any other methods.
     SUPPORTED_METHODS = ("GET", "HEAD")
 
+    # Trace recorder request was captured with, value returned
+    # by its begin() and bytes of response body streamed.
+    __trace = None
+    __traced = None
+    __sent = 0
+
+    # Rate limiter that admitted the request, until request is released.
+    __limiter = None
+
     def set_default_headers(self):
         pass
 
@@ -41,6 +69,56 @@ class TurmsRequestHandler(web.RequestHandler):
         Logger.warning("User requested path '%s' with %s, from %s." % (self.request.path,
                                                                        self.request.method,
                                                                        self.request.remote_ip), "turms.server")
+        self.__trace = traffic.recorder()
+        if self.__trace:
+            self.__traced = self.__trace.begin()
+
+        # Refuse addresses sending too many requests before doing any
+        # work for them, such as key derivation or hashing files.
+        limiter = self.application.get_limiter()
+        if limiter:
+            retry_after = limiter.acquire(self.request.remote_ip)
+            if retry_after:
+                self.too_many_requests(retry_after)
+                return
+            self.__limiter = limiter
+
+    def count_sent(self, size):
+        """ Count bytes of response body written straight to connection """
+        self.__sent += size
+
+    def flush(self, include_footers=False):
+        """ Count buffered response body before it is sent """
+        self.__sent += sum(len(chunk) for chunk in self._write_buffer)
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        """ Capture finished request into trace and release its rate limit """
+        self.end_trace(self.get_status())
+        self.release_limit()
+
+    def on_connection_close(self):
+        """ Capture request client gave up on into trace and release its rate limit """
+        super().on_connection_close()
+        self.end_trace(0)
+        self.release_limit()
+
+    def release_limit(self):
+        """ Stop counting request as in progress, only once per request """
+        if self.__limiter:
+            self.__limiter.release(self.request.remote_ip)
+            self.__limiter = None
+
+    def end_trace(self, status):
+        """ Write request into trace if it is being captured, only once per request.
+
+        :param status:  Response status, 0 if response was not finished.
+        """
+        if not self.__traced:
+            return
+        filesize = self._headers.get("filesize")
+        self.__trace.end(self.__traced, self.request, status, self.__sent, int(filesize) if filesize else None)
+        self.__traced = None
     # Unsupported methods
     def post(self):
         """ Default response for method 'POST' - not allowed """
@@ -104,6 +182,120 @@ class TurmsRequestHandler(web.RequestHandler):
 
         self.set_status(200, tutil.responses[200])
 
+    def not_modified(self):
+        """ Construct basic response with status '304 Not modified' """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        304, tutil.responses[304]),
+                       "turms.server")
+
+        self.set_status(304, tutil.responses[304])
+        self.finish()
+
+    def partial_content(self, offset, length, size):
+        """ Construct basic response with status '206 Partial content'
+
+        :param offset:  Start of the sent range.
+        :param length:  Length of the sent range.
+        :param size:    Size of the whole file.
+        """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        206, tutil.responses[206]),
+                       "turms.server")
+
+        self.set_status(206, tutil.responses[206])
+        self.set_header("Content-Range", "bytes %i-%i/%i" % (offset, offset + length - 1, size))
+
+    def range_not_satisfiable(self, size):
+        """ Construct basic response with status '416 Range not satisfiable'
+
+        :param size:    Size of the whole file.
+        """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        416, tutil.responses[416]),
+                       "turms.server")
+
+        self.set_status(416, tutil.responses[416])
+        self.set_header("Content-Range", "bytes */%i" % size)
+        self.flush()
+        self.finish()
+
+    def created(self):
+        """ Construct basic response with status '201 Created' """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        201, tutil.responses[201]),
+                       "turms.server")
+
+        self.set_status(201, tutil.responses[201])
+        self.flush()
+        self.finish()
+
+    def not_acceptable(self):
+        """ Construct basic response with status '406 Not acceptable' """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        406, tutil.responses[406]),
+                       "turms.server")
+
+        self.set_status(406, tutil.responses[406])
+        self.flush()
+        self.finish()
+
+    def conflict(self):
+        """ Construct basic response with status '409 Conflict' """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        409, tutil.responses[409]),
+                       "turms.server")
+
+        self.set_status(409, tutil.responses[409])
+        self.flush()
+        self.finish()
+
+    def payload_too_large(self):
+        """ Construct basic response with status '413 Payload too large' """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        413, tutil.responses[413]),
+                       "turms.server")
+
+        self.set_status(413, tutil.responses[413])
+        self.flush()
+        self.finish()
+
+    def service_unavailable(self, retry_after):
+        """ Construct basic response with status '503 Service unavailable'
+
+        :param retry_after: Seconds after which client may try again.
+        """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        503, tutil.responses[503]),
+                       "turms.server")
+
+        self.set_status(503, tutil.responses[503])
+        self.set_header("Retry-After", str(int(retry_after)))
+        self.flush()
+        self.finish()
+
+    def too_many_requests(self, retry_after):
+        """ Construct basic response with status '429 Too many requests'
+
+        :param retry_after: Seconds after which client may try again.
+        """
+        Logger.warning("Responding user %s with %s %s" %
+                       (self.request.remote_ip,
+                        429, tutil.responses[429]),
+                       "turms.server")
+
+        self.set_status(429, tutil.responses[429])
+        self.set_header("Retry-After", str(int(retry_after)))
+        self.flush()
+        self.finish()
+
     def internal_server_error(self):
         Logger.warning("Responding user %s with %s %s" %
                        (self.request.remote_ip,
@@ -123,7 +315,11 @@ class TurmsRequestHandler(web.RequestHandler):
 # Path specific request handlers for different request paths
 # eg.   --> IndexRequestHandler for "/"
 #       --> DirectoryRequestHandler for "/dir/"
+#       --> ManifestRequestHandler for "/manifest/"
 #       --> FileRequestHandler for "/download/*"
+#       --> BlockHashRequestHandler for "/blocks/*"
+#       --> DeltaRequestHandler for "/delta/*"
+#       --> UploadRequestHandler for "/upload/*"
 class IndexRequestHandler(TurmsRequestHandler):
 
     def head(self):
@@ -147,22 +343,71 @@ class IndexRequestHandler(TurmsRequestHandler):
 
 class DirectoryRequestHandler(TurmsRequestHandler):
 
-    def head(self):
-        """ Create response for 'HEAD' method request in path '/dir/' """
+    def head(self, path):
+        """ Create response for 'HEAD' method request in path '/dir/<path to directory>' """
         self.ok()
 
-    def get(self):
-        """ Create response for 'GET' method request in path '/dir/' """
+    async def get(self, path):
+        """ Create response for 'GET' method request in path '/dir/<path to directory>'.
+        Whole subtree is listed with query argument 'recursive=1'.
+
+        :param path:    Path of the directory in content, empty for root, decoded from url.
+        """
+        await Sfh.refresh_storage()
+        try:
+            # Write list of available files and directories as json object
+            files = Sfh.fetch_server_content(Sfh.resolve_path(path),
+                                             self.get_query_argument("recursive", "0") == "1")
+        except pathvalidate.ValidationError:
+            self.bad_request()
+            return
+
+        if files is None:
+            self.not_found()
+            return
 
         self.set_status(200)
-        # Write list of available files for download as json object
-        files = Sfh.fetch_server_content()
         self.write(files)
 
         self.flush()
         self.finish()
 
 
+class ManifestRequestHandler(TurmsRequestHandler):
+
+    def head(self, path):
+        """ Create response for 'HEAD' method request in path '/manifest/<path to directory>' """
+        self.ok()
+
+    async def get(self, path):
+        """ Create response for 'GET' method request in path '/manifest/<path to directory>'.
+        Manifest is compressed with gzip when client accepts it.
+
+        :param path:    Path of the directory in content, empty for root, decoded from url.
+        """
+        compress = "gzip" in self.request.headers.get("Accept-Encoding", "")
+        await Sfh.refresh_storage()
+        try:
+            manifest = Sfh.fetch_manifest(Sfh.resolve_path(path), compress)
+        except pathvalidate.ValidationError:
+            self.bad_request()
+            return
+
+        if manifest is None:
+            self.not_found()
+            return
+
+        self.set_status(200)
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Vary", "Accept-Encoding")
+        if compress:
+            self.set_header("Content-Encoding", "gzip")
+        self.write(manifest)
+
+        self.flush()
+        self.finish()
+
+
 class FileRequestHandler(TurmsRequestHandler):
 
     __encryptor = None
@@ -173,61 +418,134 @@ class FileRequestHandler(TurmsRequestHandler):
     application: server.TurmsApp
 
     def prepare(self):
-        """ Prepare before handling request. Create encryption device where necessary. """
+        """ Prepare before handling request. """
+        super().prepare()
         self.__allow_unencrypted = Cfg.get_bool("TURMS", "AllowUnencrypted", False)
 
-        # Create encryptor for this user request.
+    async def create_encryptor(self):
+        """ Create encryption device for this user request. Key derivation
+        is expensive so it is done only once request is about to be served,
+        and in a thread so that other transfers continue meanwhile.
+
+        :return:    Whether request can be continued.
+        """
+        # Use fastest cipher both client and server support.
+        cipher = encrypt.negotiate_cipher(self.request.headers.get("Accept-Cipher"), encrypt.allowed_ciphers())
+        if not cipher:
+            self.set_header("Accept-Cipher", ", ".join(encrypt.allowed_ciphers()))
+            self.not_acceptable()
+            return False
+
         # If unencrypted transfer is not allowed and no password is defined raises ValueError.
         try:
-            self.__encryptor = self.application.get_encryptor()
-            return
+            loop = asyncio.get_event_loop()
+            self.__encryptor = await loop.run_in_executor(None, self.application.get_encryptor, cipher)
+            return True
         except ValueError as e:
             self.internal_server_error()
             Logger.error(e, "turms.server")
-            return
+            return False
 
-    def head(self):
-        """ Create response for 'HEAD' method request in path '/download/*.*' """
-        try:
-            # Split to: "" ,  "download", [path to file]
-            # If <path to file> is not file name refuse download since we only serve files
-            # inside the root content directory. List should only have one item, the filename.
-            splitpath = self.request.path.split("/")
-            splitpath.pop(0)    # Empty string created by split before leading dash
-            splitpath.pop(0)    # "download"
-            if len(splitpath) > 1:
-                self.bad_request()
-                return
+    @staticmethod
+    def file_checksum(filename, file):
+        """ Return checksum of content file. Uses checksum cached by storage when
+        available, otherwise file is read through and rewound to the beginning.
+
+        :param filename:    Sanitized path of the file in content.
+        :param file:        File object opened for reading.
+        """
+        checksum = Sfh.get_checksum(filename)
+        if checksum is None:
+            checksum = encrypt.get_file_checksum(file)
+            file.seek(0, 0)
+        return checksum
+
+    @staticmethod
+    def etag(checksum):
+        """ Entity tag of file version identified by its checksum """
+        return '"%s"' % base64.urlsafe_b64encode(checksum).decode()
+
+    def matches_etag(self, checksum):
+        """ Set entity tag header and check whether it matches the
+        version client has, given in 'If-None-Match' header. """
+        self.set_header("Etag", self.etag(checksum))
+        return self.check_etag_header()
+
+    def check_not_modified(self, filename, file):
+        """ Respond with '304 Not modified' if client sent 'If-None-Match'
+        header matching current version of the file. Check is done before
+        any expensive work such as key derivation. Closes file if responded.
+
+        :param filename:    Sanitized path of the file in content.
+        :param file:        File object opened for reading.
+        :return:            Checksum of the file if it was computed for the check.
+        """
+        if not self.request.headers.get("If-None-Match"):
+            return None
 
-            # File name could be fetched as the last part of url directly without
-            # above checks but since we want to return error for malformed request if path
-            # is not filename instead of "404, page not found"
-            filename = splitpath[-1]
+        checksum = self.file_checksum(filename, file)
+        if self.matches_etag(checksum):
+            file.close()
+            self.not_modified()
+        return checksum
 
-            # ServerFileHandler does sanitation and filename validation internally.
+    def range_applies(self, filename, file, checksum=None):
+        """ Whether requested range should be sent. Client continuing a download
+        sends entity tag of the version it has part of in 'If-Range' header.
+        Range of another version is of no use, so whole file is sent instead
+        if file has changed since.
+
+        :param filename:    Sanitized path of the file in content.
+        :param file:        File object opened for reading.
+        :param checksum:    Checksum of the file if already computed.
+        :return:            Tuple of whether range applies and checksum of the file if computed.
+        """
+        if not self.request.headers.get("Range"):
+            return False, checksum
+        if not self.request.headers.get("If-Range"):
+            return True, checksum
+
+        if checksum is None:
+            checksum = self.file_checksum(filename, file)
+        return self.request.headers.get("If-Range") == self.etag(checksum), checksum
+
+    def head(self, path):
+        """ Create response for 'HEAD' method request in path '/download/<path to file>'
+
+        :param path:    Path of the file in content, decoded from url.
+        """
+        try:
+            # Every component of path is sanitized and validated and path is
+            # checked to stay inside content directory.
             # Raises pathvalidate.ValidationError if validation fails.
+            filename = Sfh.resolve_path(path)
             file, size = Sfh.get_file_object(filename)
 
             if file is None:
                 self.not_found()
                 return
             else:
-                checksum = encrypt.get_checksum(file.read())
+                # Not needed after checksum in HEAD response.
+                try:
+                    checksum = self.file_checksum(filename, file)
+                finally:
+                    file.close()
 
-                # Not needed after this in HEAD response.
-                file.close()
+                if self.matches_etag(checksum):
+                    self.not_modified()
+                    return
 
                 # Set encryption headers
-                if self.__allow_unencrypted and not self.__encryptor:
+                if self.__allow_unencrypted and not self.application.is_encrypted():
                     self.add_header("encrypted", "False")
                 else:
                     self.add_header("encrypted", "True")
 
                 # No point in returning salt and initialization vector
                 # in HEAD response when they change for each response.
-                self.add_header("salt", base64.urlsafe_b64encode(self.__encryptor.get_salt()))
-                self.add_header("iv", base64.urlsafe_b64encode(self.__encryptor.get_salt()))
+                # That way HEAD doesn't need expensive key derivation either.
                 self.add_header("checksum", base64.urlsafe_b64encode(checksum))
+                self.add_header("filesize", str(size))
                 self.ok()
                 self.finish()
 
@@ -236,88 +554,482 @@ class FileRequestHandler(TurmsRequestHandler):
             # malformed or not a valid filename.
             self.bad_request()
 
-    def get(self):
-        """ Create response for 'GET' method request in path '/download/*.*' """
+    async def get(self, path):
+        """ Create response for 'GET' method request in path '/download/<path to file>'
+
+        :param path:    Path of the file in content, decoded from url.
+        """
         try:
-            # Split to: "" ,  "download", [path to file]
-            # If <path to file> is not file name refuse download since we only serve files
-            # inside the root content directory. List should only have one item, the filename.
-            splitpath = self.request.path.split("/")
-            splitpath.pop(0)    # Empty string created by split before leading dash
-            splitpath.pop(0)    # "download"
-            if len(splitpath) > 1:
-                self.bad_request()
+            # Raises pathvalidate.ValidationError if validation fails.
+            filename = Sfh.resolve_path(path)
+            file, size = Sfh.get_file_object(filename)
+
+            if file is None:
+                self.not_found()
                 return
 
-            # File name could be fetched as the last part of url directly without
-            # above checks but since we want to return error for malformed request if path
-            # is not filename instead of "404, page not found"
-            filename = splitpath[-1]
+            # File is closed however response ends, f.e. when client disconnects
+            # while waiting for its turn. Send pipeline closes it once read too.
+            try:
+                # Client already has this version of the file.
+                checksum = self.check_not_modified(filename, file)
+                if self._finished:
+                    return
 
-            # ServerFileHandler does sanitation and filename validation internally.
-            # Raises pathvalidate.ValidationError if validation fails.
+                # Only part of the file was requested, f.e. to re-fetch damaged blocks.
+                offset, length = 0, size
+                applies, checksum = self.range_applies(filename, file, checksum)
+                if applies:
+                    requested = self.parse_range(self.request.headers.get("Range"), size)
+                    if not requested:
+                        self.range_not_satisfiable(size)
+                        return
+                    offset, length = requested
+
+                # Wait for turn to start transfer. Depending on scheduling smaller
+                # files may get their turn first. Refuse if server is too busy.
+                queue = self.application.get_admission()
+                try:
+                    await queue.acquire(size)
+                except (admission.AdmissionError, asyncio.TimeoutError):
+                    self.service_unavailable(queue.get_timeout())
+                    return
+
+                try:
+                    await self.send_file(filename, file, size, checksum=checksum, offset=offset, length=length)
+                finally:
+                    queue.release()
+            finally:
+                file.close()
+            return
+
+        except pathvalidate.ValidationError:
+            # Respond with 'Bad request' if filename is
+            # malformed or not a valid filename.
+            self.bad_request()
+
+    async def send_file(self, filename, file, size, source=None, checksum=None, offset=0, length=None):
+        """ Stream content of file to client in encrypted chunks.
+
+        :param filename:    Sanitized path of the file in content.
+        :param file:        File object opened for reading.
+        :param size:        Size of the file in bytes.
+        :param source:      Iterable of chunks to send instead of file content as is.
+        :param checksum:    Checksum of the file if already computed.
+        :param offset:      Start of requested range of file content.
+        :param length:      Length of requested range, rest of the file by default.
+        """
+        if not await self.create_encryptor():
+            file.close()
+            return
+
+        if checksum is None:
+            checksum = self.file_checksum(filename, file)
+        self.set_header("Etag", self.etag(checksum))
+
+        # Tie block hashes client may have fetched to this version of the file.
+        blocks = Sfh.get_block_hashes(filename, compute=False)
+        if blocks:
+            self.add_header("merkle-root", blocks["root"])
+
+        if length is None:
+            length = size - offset
+
+        if self.__allow_unencrypted and not self.__encryptor:
+            self.add_header("encrypted", "False")
+        else:
+            self.add_header("encrypted", "True")
+
+        if self.__encryptor:
+            self.add_header("cipher", self.__encryptor.get_cipher())
+            self.add_header("salt", base64.urlsafe_b64encode(self.__encryptor.get_salt()))
+            self.add_header("iv", base64.urlsafe_b64encode(self.__encryptor.get_iv()))
+            self.add_header("key-check", base64.urlsafe_b64encode(self.__encryptor.get_key_check()))
+        self.add_header("checksum", base64.urlsafe_b64encode(checksum))
+        self.add_header("filesize", str(size))
+        if source is None and (offset > 0 or length < size):
+            self.add_header("offset", str(offset))
+            self.partial_content(offset, length, size)
+        else:
+            self.ok()
+
+        # There should be encryptor when encryption is required.
+        if not self.__encryptor and not self.__allow_unencrypted:
+            Logger.error("Server", "turms.server")
+            self.internal_server_error()
+            file.close()
+            return
+        encryptor = None if self.__allow_unencrypted else self.__encryptor
+
+        # Length of file content is known beforehand, so response is sent
+        # with Content-Length instead of chunked encoding. Then chunks are
+        # written to socket straight from the buffers below without copying.
+        if source is None:
+            self.set_header("Content-Length", str(encrypt.stream_size(length, encryptor.get_cipher())
+                                                  if encryptor else length))
+        self.flush()
+
+        if source is None:
+            file.seek(offset, 0)
+
+        # Read ahead and encrypt in threads while this coroutine sends chunks
+        # that are ready. Pipeline closes file once it has been read. Chunk
+        # of record stream holds a record for each cipher thread to seal.
+        chunk_size = PIPELINE_CHUNK_SIZE
+        if encryptor and encryptor.get_cipher() in encrypt.AEAD_CIPHERS:
+            chunk_size = encrypt.RECORD_SIZE * encrypt.cipher_workers()
+        pipeline = SendPipeline(encryptor, int(Cfg.get_turms_val("ReadAhead", 4)), file, length, source,
+                                chunk_size)
+        pipeline.start()
+
+        # Throttle sending with server bandwidth limits.
+        transfer = self.application.get_shaper().open_transfer(self.request.remote_ip)
+
+        try:
+            async for chunk in pipeline.chunks():
+                # Wait asynchronously until bandwidth limits allow
+                # sending the chunk. Lets other tasks run meanwhile.
+                await transfer.throttle(len(chunk))
+
+                # Buffers are reused only after connection has written the chunk out.
+                await self.request.connection.write(chunk)
+                self.count_sent(len(chunk))
+                del chunk
+
+        except iostream.StreamClosedError as e:
+            Logger.warning(e, "turms.server")
+        finally:
+            pipeline.close()
+            transfer.close()
+        self.finish()
+        return
+
+    @staticmethod
+    def parse_range(header, size):
+        """ Parse single byte range from 'Range' header.
+
+        :param header:  Value of the header, f.e. 'bytes=1024-' or 'bytes=0-1023'.
+        :param size:    Size of the file.
+        :return:        Tuple of offset and length or None if range is invalid.
+        """
+        unit, _, spec = header.partition("=")
+        start, dash, end = spec.strip().partition("-")
+        if unit.strip() != "bytes" or not dash or "," in spec:
+            return None
+        try:
+            start = int(start)
+            end = int(end) + 1 if end else size
+        except ValueError:
+            return None
+        end = min(end, size)
+        if start < 0 or start >= end:
+            return None
+        return start, end - start
+
+
+class BlockHashRequestHandler(TurmsRequestHandler):
+    """ Publishes per block hashes and Merkle root of a file, so
+    client can verify download block by block as it arrives. """
+
+    def get(self, path):
+        """ Create response for 'GET' method request in path '/blocks/<path to file>'
+
+        :param path:    Path of the file in content, decoded from url.
+        """
+        try:
+            # Validates path and checks that file exists.
+            filename = Sfh.resolve_path(path)
             file, size = Sfh.get_file_object(filename)
+            if file is None:
+                self.not_found()
+                return
+            file.close()
 
+            blocks = Sfh.get_block_hashes(filename)
+            if not blocks:
+                self.not_found()
+                return
+
+            self.ok()
+            self.write(json.dumps({"block_size": blocks["block_size"],
+                                   "size": blocks["size"],
+                                   "root": blocks["root"],
+                                   "hashes": blocks["hashes"]}))
+            self.flush()
+            self.finish()
+
+        except pathvalidate.ValidationError:
+            self.bad_request()
+
+
+class DeltaRequestHandler(FileRequestHandler):
+    """ Sends changes to a file client already has an older version of.
+    Client posts block signatures of its local copy and response body
+    is encrypted stream of delta instructions for rebuilding the file.
+    """
+
+    SUPPORTED_METHODS = ("POST",)
+
+    async def post(self, path):
+        """ Create response for 'POST' method request in path '/delta/<path to file>'
+
+        :param path:    Path of the file in content, decoded from url.
+        """
+        try:
+            filename = Sfh.resolve_path(path)
+            file, size = Sfh.get_file_object(filename)
             if file is None:
                 self.not_found()
                 return
-            else:
-                # Read from file to response body in chunks until completed.
-                read = 0
-                checksum = encrypt.get_checksum(file.read())
-                file.seek(0, 0)
 
-                if self.__allow_unencrypted and not self.__encryptor:
-                    self.add_header("encrypted", "False")
-                else:
-                    self.add_header("encrypted", "True")
+            # File is closed however response ends.
+            try:
+                checksum = self.check_not_modified(filename, file)
+                if self._finished:
+                    return
 
-                if self.__encryptor:
-                    self.add_header("salt", base64.urlsafe_b64encode(self.__encryptor.get_salt()))
-                    self.add_header("iv", base64.urlsafe_b64encode(self.__encryptor.get_iv()))
-                self.add_header("checksum", base64.urlsafe_b64encode(checksum))
-                self.add_header("filesize", str(size))
-                self.ok()
-                self.flush()
-
-                # Data remains to be read
-                while size - read > 0:
-                    # While size greater than one chunk size remains to be
-                    if size - read > CHUNK_SIZE:
-                        chunk = file.read(CHUNK_SIZE)
-                        read += len(chunk)
-
-                    # Less than one chunk
-                    else:
-                        chunk = file.read(size - read)
-                        read += len(chunk)
+                # Matching runs byte by byte in Python, so limit the work a single
+                # request can cause. Client falls back to downloading whole file.
+                max_size = int(Cfg.get_turms_val("MaxDeltaSize", 4194304))
+                max_signature = delta.SIGNATURE_HEADER.size + \
+                    max_size // delta.MIN_BLOCK_SIZE * delta.SIGNATURE_BLOCK.size
+                if size > max_size or len(self.request.body) > max_signature:
+                    self.forbidden()
+                    return
+
+                try:
+                    encoder = delta.DeltaEncoder(self.request.body, file)
+                except ValueError as e:
+                    Logger.warning(e, "turms.server")
+                    self.bad_request()
+                    return
+
+                if encoder.basis_size() > max_size:
+                    self.forbidden()
+                    return
+
+                queue = self.application.get_admission()
+                try:
+                    await queue.acquire(size)
+                except (admission.AdmissionError, asyncio.TimeoutError):
+                    self.service_unavailable(queue.get_timeout())
+                    return
+
+                try:
+                    # Checksum is computed first, since encoder reads the file through.
+                    # Both run in a worker thread instead of event loop or send pipeline,
+                    # and instructions are sent from a temporary file.
+                    loop = asyncio.get_event_loop()
+                    if checksum is None:
+                        checksum = await loop.run_in_executor(None, self.file_checksum, filename, file)
+                    instructions = tempfile.TemporaryFile()
                     try:
-                        # There should be encryptor when encryption is required.
-                        if not self.__encryptor and not self.__allow_unencrypted:
-                            Logger.error("Server", "turms.server")
-                            self.internal_server_error()
-
-                        # Each chunk will be sent to client on flush.
-                        if self.__allow_unencrypted:
-                            final = chunk
-                        else:
-                            final = self.__encryptor.encrypt(chunk)
-                            if size == read:
-                                final += self.__encryptor.finalize()
-                        self.write(final)
-                        self.flush()
-                    except iostream.StreamClosedError as e:
-                        Logger.warning(e, "turms.server")
-                        break
-                    finally:
-                        del chunk
-                        # Sleep to not block and to let other tasks run
-                        gen.sleep(0.000001)
-                self.finish()
+                        await loop.run_in_executor(None, encoder.encode, instructions)
+                        instructions.seek(0)
+                    except BaseException:
+                        instructions.close()
+                        raise
+                    self.add_header("delta", "True")
+                    await self.send_file(filename, file, size, file_chunks(instructions, PIPELINE_CHUNK_SIZE),
+                                         checksum)
+                finally:
+                    queue.release()
+            finally:
                 file.close()
+
+        except pathvalidate.ValidationError:
+            self.bad_request()
+
+
+@web.stream_request_body
+class UploadRequestHandler(TurmsRequestHandler):
+    """ Receives file uploaded by client. Request body is decrypted and hashed
+    chunk by chunk as it arrives and written to a temporary file, which is moved
+    into content directory once the whole file has been received and verified.
+    """
+
+    # Only uploading new files is allowed, no
+    # modification of existing content.
+    SUPPORTED_METHODS = ("PUT",)
+
+    __filename = None
+    __decryptor = None
+    __digest = None
+    __partial = None
+    __partial_path = None
+    __expected = 0
+    __received = 0
+    __reserved = False
+    __closed = False
+
+    application: server.TurmsApp
+
+    async def prepare(self):
+        """ Validate upload and set up receiving before request body starts streaming.
+        Body is not read before key has been derived. """
+        super().prepare()
+        if self._finished:
+            return
+
+        if not Cfg.get_bool("TURMS", "AllowUpload", False):
+            self.forbidden()
+            return
+
+        try:
+            # Uploads are only allowed to root content directory.
+            name = self.path_args[0]
+            if "/" in name:
+                self.bad_request()
                 return
 
+            self.__filename = Sfh.validate_new_filename(name)
         except pathvalidate.ValidationError:
-            # Respond with 'Bad request' if filename is
-            # malformed or not a valid filename.
             self.bad_request()
+            return
+
+        # Refuse to overwrite any existing content.
+        if Sfh.file_exists(self.__filename):
+            self.conflict()
+            return
+
+        # Size of the upload has to be known beforehand.
+        max_size = int(Cfg.get_turms_val("MaxUploadSize", 1073741824))
+        try:
+            self.__expected = int(self.request.headers.get("Content-Length", ""))
+        except ValueError:
+            self.bad_request()
+            return
+        if self.__expected > max_size:
+            self.payload_too_large()
+            return
+        self.request.connection.set_max_body_size(max_size)
+
+        if not self.application.acquire_upload():
+            self.service_unavailable(30)
+            return
+        self.__reserved = True
+
+        try:
+            salt = self.request.headers.get("salt")
+            iv = self.request.headers.get("iv")
+            cipher = self.request.headers.get("cipher", encrypt.CIPHER_CFB)
+            if cipher not in encrypt.allowed_ciphers():
+                # Tell client which ciphers it can use instead.
+                self.set_header("Accept-Cipher", ", ".join(encrypt.allowed_ciphers()))
+                self.not_acceptable()
+                return
+            if salt and iv:
+                loop = asyncio.get_event_loop()
+                self.__decryptor = await loop.run_in_executor(None, self.application.get_decryptor,
+                                                              base64.urlsafe_b64decode(salt),
+                                                              base64.urlsafe_b64decode(iv), cipher)
+                # Refuse upload encrypted with another password before receiving it.
+                check = self.request.headers.get("key-check")
+                if check and self.__decryptor and not self.__decryptor.verify_key(base64.urlsafe_b64decode(check)):
+                    Logger.warning("Upload key check failed, client used wrong password.", "turms.server")
+                    self.bad_request()
+                    return
+            elif not Cfg.get_bool("TURMS", "AllowUnencrypted", False):
+                self.bad_request()
+                return
+        except ValueError as e:
+            Logger.error(e, "turms.server")
+            self.internal_server_error()
+            return
+
+        # Client may have given up while key was derived.
+        if self.__closed:
+            return
+        self.__digest = hashes.Hash(hashes.SHA256())
+        self.__partial, self.__partial_path = Sfh.create_partial_file()
+
+    def data_received(self, chunk: bytes):
+        """ Decrypt, hash and write single chunk of request body """
+        # Request has already been answered.
+        if not self.__partial:
+            return
+
+        self.__received += len(chunk)
+        if self.__received > self.__expected:
+            self.discard()
+            return
+
+        if self.__decryptor:
+            try:
+                chunk = self.__decryptor.decrypt(chunk)
+            except ValueError as e:
+                # Tampered or wrongly encrypted upload.
+                Logger.warning(e, "turms.server")
+                self.discard()
+                return
+        self.__digest.update(chunk)
+        self.__partial.write(chunk)
+
+    async def put(self, name):
+        """ Finish receiving uploaded file and move it into content.
+
+        :param name:    Name of the file, already validated in prepare().
+        """
+        if not self.__partial:
+            self.bad_request()
+            return
+
+        if self.__decryptor:
+            try:
+                chunk = self.__decryptor.finalize()
+            except ValueError as e:
+                Logger.warning(e, "turms.server")
+                self.discard()
+                self.bad_request()
+                return
+            self.__digest.update(chunk)
+            self.__partial.write(chunk)
+        self.__partial.close()
+        self.__partial = None
+
+        checksum = self.request.headers.get("checksum")
+        digest = self.__digest.finalize()
+        if not checksum or base64.urlsafe_b64decode(checksum) != digest:
+            Logger.warning("Uploaded file %s failed integrity check." % self.__filename, "turms.server")
+            self.discard()
+            self.bad_request()
+            return
+
+        try:
+            await Sfh.commit_partial_file(self.__partial_path, self.__filename, digest)
+            self.__partial_path = None
+        except FileExistsError:
+            self.discard()
+            self.conflict()
+            return
+
+        Logger.info("Received file %s from %s." % (self.__filename, self.request.remote_ip), "turms.server")
+        self.created()
+
+    def discard(self):
+        """ Stop receiving and remove unfinished upload """
+        if self.__partial:
+            self.__partial.close()
+            self.__partial = None
+        Sfh.discard_partial_file(self.__partial_path)
+        self.__partial_path = None
+
+    def clean_up(self):
+        """ Remove unfinished upload and free its slot, only once per request """
+        self.discard()
+        if self.__reserved:
+            self.__reserved = False
+            self.application.release_upload()
+
+    def on_finish(self):
+        """ Clean up after response has been sent """
+        self.clean_up()
+        super().on_finish()
+
+    def on_connection_close(self):
+        """ Clean up if client closes connection in the middle of upload. Base
+        class fails the wait for rest of the body, so that put() is not left
+        waiting for it. """
+        self.__closed = True
+        super().on_connection_close()
+        self.clean_up()
@@ -0,0 +1,191 @@
+#   --- Turms ---
+#   Pipeline reading file content ahead and
+#   encrypting it in threads while event loop
+#   sends chunks that are already done.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import asyncio
+import queue
+import threading
+
+# Size of chunks read from file. Much larger than CHUNK_SIZE, so that
+# handing a chunk from thread to another costs little compared to
+# reading and encrypting it.
+CHUNK_SIZE = 65536
+
+
+class Slot:
+    """ Buffers of one chunk moving through pipeline. Slots are
+    reused, so pipeline holds at most depth chunks at a time. """
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.out = bytearray(0)
+
+        # Chunk read and chunk to send, views of the buffers.
+        self.data = None
+        self.send = None
+
+
+class SendPipeline:
+    """ Sends content in three overlapping stages. Reader thread reads chunks
+    ahead from file, cipher thread encrypts them and event loop only writes
+    ready chunks to the connection. Disk reads and cryptography calls release
+    the GIL, so throughput of a transfer approaches the slowest of disk,
+    cipher and network instead of their sum.
+
+    Chunks move between stages in a fixed set of slots. Reader waits for a
+    slot to be freed once event loop has sent it, which bounds memory use
+    and stops reading ahead of a slow connection.
+    """
+
+    __file = None
+    __length = 0
+    __chunk_size = CHUNK_SIZE
+    __source = None
+    __encryptor = None
+
+    __loop = None
+    __free = None
+    __read = None
+    __ready = None
+    __stop = None
+    __threads = None
+
+    def __init__(self, encryptor, depth, file, length=0, source=None, chunk_size=CHUNK_SIZE):
+        """
+        :param encryptor:   Encryptor for content, None to send it as is.
+        :param depth:       Number of chunks in pipeline at a time.
+        :param file:        File object opened for reading. Pipeline closes it once done.
+        :param length:      Amount of bytes to read from current position of file.
+        :param source:      Iterable of chunks to send instead of reading file.
+        :param chunk_size:  Size of chunks read from file. Record stream encryptor
+                            seals records completed by a chunk in parallel.
+        """
+        self.__encryptor = encryptor
+        self.__file = file
+        self.__length = length
+        self.__source = iter(source) if source is not None else None
+        self.__chunk_size = chunk_size
+
+        self.__free = queue.Queue()
+        for _ in range(max(1, depth)):
+            self.__free.put(Slot(chunk_size))
+        self.__read = queue.Queue()
+        self.__stop = threading.Event()
+
+    def start(self):
+        """ Start reader and cipher threads. Has to be called in event loop. """
+        self.__loop = asyncio.get_event_loop()
+        self.__ready = asyncio.Queue()
+        self.__threads = [threading.Thread(target=self.__reader, daemon=True),
+                          threading.Thread(target=self.__cipher, daemon=True)]
+        for thread in self.__threads:
+            thread.start()
+
+    async def chunks(self):
+        """ Generate chunks ready to be sent. Chunk is valid until next one is
+        requested, after which its buffers are given back to the reader.
+
+        :raises Exception:  Error raised in reader or cipher thread.
+        """
+        while True:
+            slot, data = await self.__ready.get()
+            if isinstance(data, BaseException):
+                raise data
+            if data is None:
+                return
+            try:
+                yield data
+            finally:
+                if slot:
+                    self.__free.put(slot)
+
+    def close(self):
+        """ Stop reading and encrypting, f.e. when client disconnects. Doesn't
+        wait for threads, they finish after current chunk. """
+        self.__stop.set()
+        # Wake reader waiting for a free slot.
+        self.__free.put(None)
+
+    def __deliver(self, slot, data):
+        """ Hand chunk, error or end of content (None) to event loop """
+        try:
+            self.__loop.call_soon_threadsafe(self.__ready.put_nowait, (slot, data))
+        except RuntimeError:
+            # Event loop has been closed.
+            self.__stop.set()
+
+    def __reader(self):
+        """ Read chunks into free slots and pass them to cipher thread """
+        remaining = self.__length
+        try:
+            while not self.__stop.is_set():
+                slot = self.__free.get()
+                if slot is None or self.__stop.is_set():
+                    break
+
+                if self.__source is None:
+                    if remaining <= 0:
+                        break
+                    count = self.__file.readinto(slot.view[:min(self.__chunk_size, remaining)])
+                    if not count:
+                        break
+                    remaining -= count
+                    slot.data = slot.view[:count]
+                else:
+                    slot.data = next(self.__source, None)
+                    if slot.data is None:
+                        break
+                self.__read.put(slot)
+        except Exception as e:
+            self.__read.put(e)
+        finally:
+            self.__read.put(None)
+            self.__file.close()
+
+    def __cipher(self):
+        """ Encrypt read chunks and pass them to event loop """
+        encryptor = self.__encryptor
+        while True:
+            slot = self.__read.get()
+            if slot is None:
+                break
+            if isinstance(slot, BaseException):
+                self.__deliver(None, slot)
+                return
+            if self.__stop.is_set():
+                continue
+
+            try:
+                if encryptor:
+                    size = encryptor.output_size(len(slot.data))
+                    if len(slot.out) < size:
+                        slot.out = bytearray(size)
+                    slot.send = memoryview(slot.out)[:encryptor.encrypt_into(slot.data, slot.out)]
+                else:
+                    slot.send = slot.data
+            except Exception as e:
+                self.__stop.set()
+                self.__deliver(None, e)
+                return
+
+            # Record stream holds content until a record is complete.
+            if slot.send:
+                self.__deliver(slot, slot.send)
+            else:
+                self.__free.put(slot)
+
+        if self.__stop.is_set():
+            return
+        try:
+            if encryptor:
+                final = encryptor.finalize()
+                if final:
+                    self.__deliver(None, final)
+        except Exception as e:
+            self.__deliver(None, e)
+            return
+        self.__deliver(None, None)
@@ -7,10 +7,15 @@
 
 import socket
 
+import admission
+import bandwidth
 import encrypt
+import ratelimit
 import request_handler as rh
+import traffic
 from logger import TurmsLogger as Logger
 from config import Config as Cfg
+from server_file_handler import ServerFileHandler as Sfh
 from view import View
 
 import tornado.ioloop
@@ -41,12 +46,18 @@ class TurmsApp(tornado.web.Application):
     __port = DEFAULT_PORT
     __httpserver = None
     __keyhold = None
+    __shaper = None
+    __admission = None
+    __limiter = None
+    __uploads = 0
     running = False
 
-    def __init__(self):
+    def __init__(self, password=None):
         """
         Tornado web application initialized for delegating request handling through HTTPServer class
 
+        :param password:    Encryption password of served content, prompted from user if not given.
+
         --- SECURITY NOTE ---
         Omit default_host argument from tornado.web.Application.__init__() as well as use appropriate
         host patterns in defining paths for application request handlers instead of r'.*'
@@ -63,8 +74,15 @@ class TurmsApp(tornado.web.Application):
         # This is the tornado.routing format version.
         # https://www.tornadoweb.org/en/stable/guide/security.html#dns-rebinding
         handlers = [(HostMatches(self.__host), [(r"/", rh.IndexRequestHandler)]),
-                    (HostMatches(self.__host), [(r"/dir/", rh.DirectoryRequestHandler)]),
-                    (HostMatches(self.__host), [(r"/download/*.*", rh.FileRequestHandler)])]
+                    (HostMatches(self.__host), [(r"/dir/(.*)", rh.DirectoryRequestHandler)]),
+                    (HostMatches(self.__host), [(r"/manifest/(.*)", rh.ManifestRequestHandler)]),
+                    (HostMatches(self.__host), [(r"/download/(.+)", rh.FileRequestHandler)]),
+                    (HostMatches(self.__host), [(r"/blocks/(.+)", rh.BlockHashRequestHandler)]),
+                    (HostMatches(self.__host), [(r"/delta/(.+)", rh.DeltaRequestHandler)])]
+
+        # Uploading is opt-in, don't even route requests when not allowed.
+        if Cfg.get_bool("TURMS", "AllowUpload", False):
+            handlers.append((HostMatches(self.__host), [(r"/upload/(.+)", rh.UploadRequestHandler)]))
 
         settings = {
             "xsrf_cookies": True                        # Prevent Cross site request forgery,
@@ -77,12 +95,33 @@ class TurmsApp(tornado.web.Application):
 
         # Create encryption device factory
         if not Cfg.get_bool("TURMS", "AllowUnencrypted", False):
-            self.__keyhold = encrypt.KeyHolder(View.prompt_input("Please enter encryption password.", "*"))
+            if password is None:
+                password = View.prompt_input("Please enter encryption password.", "*")
+            self.__keyhold = encrypt.KeyHolder(password)
         # For unencrypted file transferring generate factory with
         # empty password. Rest is handled internally.
         else:
             self.__keyhold = encrypt.KeyHolder("")
 
+        # Set up content storage before serving anything.
+        Sfh.init_storage()
+
+        # Bandwidth limits shared by all transfers of this server.
+        self.__shaper = bandwidth.BandwidthShaper(int(Cfg.get_turms_val("MaxBandwidth", 0)),
+                                                  int(Cfg.get_turms_val("MaxClientBandwidth", 0)),
+                                                  int(Cfg.get_turms_val("MaxTransferBandwidth", 0)))
+
+        # Limit concurrent downloads, others wait in queue for their turn.
+        self.__admission = admission.AdmissionController(int(Cfg.get_turms_val("MaxTransfers", 8)),
+                                                         int(Cfg.get_turms_val("TransferQueueSize", 32)),
+                                                         float(Cfg.get_turms_val("TransferQueueTimeout", 30)),
+                                                         Cfg.get_turms_val("TransferScheduler", "sjf"))
+
+        # Per address limits checked before any work is done for a request.
+        self.__limiter = ratelimit.RateLimiter(float(Cfg.get_turms_val("RequestRate", 20)),
+                                               float(Cfg.get_turms_val("RequestBurst", 40)),
+                                               int(Cfg.get_turms_val("MaxClientRequests", 16)))
+
         super().__init__(handlers, default_host=None, **settings)
 
 
@@ -94,6 +133,15 @@ class TurmsApp(tornado.web.Application):
         :param timeout: Delay after which to shut down server.
         """
 
+        # Opt-in capture of requests for replaying them later.
+        trace = Cfg.get_turms_val("TraceFile", "")
+        if trace:
+            traffic.start_capture(trace)
+
+        # Import existing content into store in a worker thread,
+        # requests arriving meanwhile wait for it to finish.
+        asyncio.get_event_loop().create_task(Sfh.refresh_storage())
+
         # Set up TLS and start HTTPS server
         if Cfg.get_bool("TURMS", "UseTLS", True):
             # Load up SSL context to use for authenticating server
@@ -150,6 +198,8 @@ class TurmsApp(tornado.web.Application):
         if self.__httpserver:
             self.__httpserver.stop()
             asyncio.get_event_loop().create_task(self.__httpserver.close_all_connections())
+        Sfh.save_state()
+        traffic.stop_capture()
         Logger.info("Server stopped.")
         self.running = False
         return
@@ -165,9 +215,43 @@ class TurmsApp(tornado.web.Application):
         self.stop()
         return
 
-    def get_encryptor(self):
+    def get_encryptor(self, cipher=encrypt.CIPHER_CFB):
         # Recreate encryptor when new reference to it is made.
-        return self.__keyhold.create_encryptor()
+        return self.__keyhold.create_encryptor(cipher)
+
+    def is_encrypted(self):
+        """ Whether this server encrypts content it sends """
+        return self.__keyhold.has_password()
+
+    def get_decryptor(self, salt, iv, cipher=encrypt.CIPHER_CFB):
+        """ Create decryptor for content uploaded by client """
+        return self.__keyhold.create_decryptor(salt, iv, cipher)
+
+    def acquire_upload(self):
+        """ Reserve slot for an upload.
+
+        :return:    Whether maximum amount of concurrent uploads allows a new one.
+        """
+        if self.__uploads >= int(Cfg.get_turms_val("MaxUploads", 2)):
+            return False
+        self.__uploads += 1
+        return True
+
+    def release_upload(self):
+        """ Free slot reserved with acquire_upload() """
+        self.__uploads -= 1
+
+    def get_shaper(self):
+        """ Return bandwidth shaper shared by transfers of this server """
+        return self.__shaper
+
+    def get_admission(self):
+        """ Return admission controller limiting concurrent transfers of this server """
+        return self.__admission
+
+    def get_limiter(self):
+        """ Return rate limiter of requests per address, None if no limits are set """
+        return self.__limiter if self.__limiter.enabled() else None
 
 
 
@@ -8,23 +8,172 @@
 
 CONTENT_PATH = "./content"
 
-from os import listdir, mkdir
-from os.path import isfile, isdir, join, getsize, sep, abspath, exists
+# Server's own data inside content directory. Left out of
+# share index, so this directory is never shared.
+META_PATH = "./content/.turms"
+PARTIAL_PATH = "./content/.turms/partial"
+BLOB_PATH = "./content/.turms/blobs"
+BLOCKS_PATH = "./content/.turms/blocks"
+POPULARITY_PATH = "./content/.turms/popularity.json"
+
+from os import mkdir, makedirs, replace, remove, stat, fstat
+from os.path import isdir, join, sep, abspath, exists, basename, dirname
+import asyncio
+import base64
+import gzip
 import json
+import tempfile
+import time
 from pathvalidate import sanitize_filename, validate_filename, ValidationError
 
+from blob_store import BlobStore
+from config import Config as Cfg
+from file_cache import FileCache
+from share_index import ShareIndex
+import merkle
+
 
 class ServerFileHandler:
 
+    # Content addressed storage backend, None when
+    # content is served from flat directory as is.
+    __store = None
+
+    # Memory cache of small popular files, None when disabled.
+    __cache = None
+
+    # Import of changed content into content store running in a worker thread.
+    __refreshing = None
+
+    # Index of shared directory tree and monotonic time it was built at.
+    __index = None
+    __index_time = 0
+
+    # Manifests built from current index by directory and compression.
+    __manifests = {}
+
+    @staticmethod
+    def init_storage():
+        """ Set up storage backend chosen in configuration. Existing content
+        is imported into it by refresh_storage(), once event loop is running. """
+        if not exists(CONTENT_PATH):
+            mkdir(CONTENT_PATH)
+
+        if Cfg.get_turms_val("StorageBackend", "flat") == "cas":
+            ServerFileHandler.__store = BlobStore(CONTENT_PATH, BLOB_PATH,
+                                                  int(Cfg.get_turms_val("StorageWorkers", 4)))
+        else:
+            ServerFileHandler.__store = None
+
+        capacity = int(Cfg.get_turms_val("FileCacheSize", 67108864))
+        if capacity > 0:
+            ServerFileHandler.__cache = FileCache(CONTENT_PATH, POPULARITY_PATH, capacity,
+                                                  int(Cfg.get_turms_val("FileCacheMaxFile", 1048576)))
+            ServerFileHandler.__cache.prefetch()
+        else:
+            ServerFileHandler.__cache = None
+
+    @staticmethod
+    async def refresh_storage():
+        """ Keep content store up to date with top level files. Changed files are
+        hashed in a worker thread so that event loop isn't blocked, and requests
+        arriving meanwhile wait for the same import. """
+        store = ServerFileHandler.__store
+        if not store:
+            return
+        if ServerFileHandler.__refreshing:
+            await ServerFileHandler.__refreshing
+            return
+        ServerFileHandler.__refreshing = asyncio.get_event_loop().run_in_executor(None, store.refresh)
+        try:
+            await ServerFileHandler.__refreshing
+        finally:
+            ServerFileHandler.__refreshing = None
+
+    @staticmethod
+    def save_state():
+        """ Save file popularity, f.e. when server stops """
+        if ServerFileHandler.__cache:
+            ServerFileHandler.__cache.save_popularity()
+
+    @staticmethod
+    def get_checksum(san_name):
+        """ Return cached SHA256 checksum of content file.
+
+        :param san_name:    Sanitized path of the file.
+        :return:            Checksum as bytes or None if not cached.
+        """
+        if ServerFileHandler.__cache:
+            checksum = ServerFileHandler.__cache.checksum(san_name)
+            if checksum:
+                return checksum
+        if ServerFileHandler.__store:
+            return ServerFileHandler.__store.checksum(san_name)
+        return None
+
     @staticmethod
-    def raw_server_content():
+    def get_index():
+        """ Return index of shared directory tree. Index is rebuilt when
+        it is older than refresh interval in configuration.
+
+        :return:    ShareIndex of content directory.
         """
-        Get filenames in content directory
+        now = time.monotonic()
+        age = now - ServerFileHandler.__index_time
+        if ServerFileHandler.__index is None or age > float(Cfg.get_turms_val("IndexRefresh", 30)):
+            ServerFileHandler.__index = ShareIndex.build(CONTENT_PATH, exclude=(basename(META_PATH),))
+            ServerFileHandler.__index_time = now
+            ServerFileHandler.__manifests = {}
+        return ServerFileHandler.__index
+
+    @staticmethod
+    def invalidate_index():
+        """ Rebuild index on next use, f.e. after content has been added """
+        ServerFileHandler.__index = None
+        ServerFileHandler.__manifests = {}
+
+    @staticmethod
+    def resolve_path(path):
+        """ Sanitize and validate path of a file or directory in server content.
 
-        :return:    List of filenames present
+        :param path:    Path relative to content directory, components separated by '/'.
+        :return:        Sanitized path, empty for content root.
+        :raises ValidationError:    If a component is not a valid file name or path
+                                    would point outside of shared content.
         """
+        parts = []
+        for part in path.split("/"):
+            # Tolerate leading, trailing and repeated separators.
+            if not part:
+                continue
+
+            # Sanitize each name and remove any illegal characters
+            # to prevent f.e. directory traversal.
+            san_part = sanitize_filename(part)
+            validate_filename(san_part)
+            if san_part in (".", ".."):
+                raise ValidationError("Illegal filepath.")
+            parts.append(san_part)
 
-        # From content directory get files and not directories.
+        # Server's own data is never shared.
+        if parts and parts[0] == basename(META_PATH):
+            raise ValidationError("Illegal filepath.")
+
+        # Check that path is within content directory and has not been traversed.
+        if parts and not abspath(join(CONTENT_PATH, *parts)).startswith(abspath(CONTENT_PATH) + sep):
+            raise ValidationError("Illegal filepath.")
+        return "/".join(parts)
+
+    @staticmethod
+    def raw_server_content(san_path="", recursive=False):
+        """
+        Get names of files and directories in a directory of server content.
+        Directory names end with '/'.
+
+        :param san_path:    Sanitized path of the directory, empty for content root.
+        :param recursive:   List whole subtree with paths relative to the directory.
+        :return:            List of names or None if path is not a directory.
+        """
         try:
             # Create content directory if not present
             if not exists(CONTENT_PATH):
@@ -33,59 +182,200 @@ class ServerFileHandler:
             if not isdir(CONTENT_PATH):
                 return []
 
-
-            onlyfiles = [f for f in listdir(CONTENT_PATH) if isfile(join(CONTENT_PATH, f))]
-            return onlyfiles
+            index = ServerFileHandler.get_index()
+            entry = index.lookup(san_path)
+            if entry is None or not index.is_dir(entry):
+                return None
+            return index.listing(entry, recursive)
         except FileNotFoundError:
 
             return []
 
     @staticmethod
-    def fetch_server_content():
+    def fetch_server_content(san_path="", recursive=False):
         """
-        Fetch filenames in directory and create JSON from the data
+        Fetch names in directory and create JSON from the data
 
-        :return:    JSON of list of filenames in content directory
+        :param san_path:    Sanitized path of the directory, empty for content root.
+        :param recursive:   List whole subtree with paths relative to the directory.
+        :return:            JSON of list of names in directory or None if path is not a directory.
         """
-        # From content directory get files and not directories.
-        onlyfiles = ServerFileHandler.raw_server_content()
+        names = ServerFileHandler.raw_server_content(san_path, recursive)
+        if names is None:
+            return None
 
-        jsonStr = json.dumps(onlyfiles)
+        jsonStr = json.dumps(names)
         return jsonStr
 
     @staticmethod
-    def get_file_object(filename):
-        """ Sanitize passed filename and try to find server
-        content that corresponds to requested file. """
+    def fetch_manifest(san_path="", compress=True):
+        """
+        Create manifest of every file under a directory of server content, so that
+        client can compare whole directory tree to its own copy with one request.
+        Manifest is JSON object with list 'files' of objects with 'path' relative
+        to the directory, 'size' in bytes, 'mtime' in nanoseconds and base64 encoded
+        SHA256 'checksum', which is null unless storage has it cached. Manifests
+        are kept until index is rebuilt.
 
-        # Sanitize file name and remove any illegal
-        # characters to prevent f.e. directory traversal.
-        san_name = sanitize_filename(filename)
+        :param san_path:    Sanitized path of the directory, empty for content root.
+        :param compress:    Whether to compress manifest with gzip.
+        :return:            Manifest as bytes or None if path is not a directory.
+        """
+        index = ServerFileHandler.get_index()
+        manifest = ServerFileHandler.__manifests.get((san_path, compress))
+        if manifest is not None:
+            return manifest
 
-        # Validate filename
-        validate_filename(san_name)
+        entry = index.lookup(san_path)
+        if entry is None or not index.is_dir(entry):
+            return None
+
+        files = []
+        prefix = san_path + "/" if san_path else ""
+        for i, path in index.walk(entry):
+            if index.is_dir(i):
+                continue
+            checksum = ServerFileHandler.get_checksum(prefix + path)
+            files.append({"path": path,
+                          "size": index.size(i),
+                          "mtime": index.mtime(i),
+                          "checksum": base64.urlsafe_b64encode(checksum).decode() if checksum else None})
+
+        manifest = json.dumps({"files": files}, separators=(",", ":")).encode()
+        if compress:
+            manifest = gzip.compress(manifest, 6)
+        ServerFileHandler.__manifests[(san_path, compress)] = manifest
+        return manifest
+
+    @staticmethod
+    def get_file_object(san_path):
+        """ Find server content that corresponds to requested file and open it.
+        Small popular files are served from memory cache.
+
+        :param san_path:    Path of the file sanitized with resolve_path().
+        :return:            Tuple of file object opened for reading and size of the
+                            file, or None, None if there is no such file.
+        """
+        # Only files in share index are served.
+        index = ServerFileHandler.get_index()
+        entry = index.lookup(san_path)
+        if not san_path or entry is None or index.is_dir(entry):
+            return None, None
+
+        if ServerFileHandler.__cache:
+            return ServerFileHandler.__cache.open(san_path)
 
         # Open file to be read as bytes for server send to user
-        if not san_name in ServerFileHandler.raw_server_content():
+        try:
+            file = open(join(CONTENT_PATH, *san_path.split("/")), "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            # Removed after index was built.
             return None, None
-        else:
-            absolute_path = abspath(CONTENT_PATH) + sep
-            path = absolute_path + san_name
-            absolute_filepath = abspath(path)
+        return file, fstat(file.fileno()).st_size
 
-            # Check that file location is within given directory path
-            # and the path has not been traversed.
-            if not absolute_filepath.startswith(absolute_path):
-                raise ValidationError("Illegal filepath.")
+    @staticmethod
+    def validate_new_filename(filename):
+        """ Sanitize and validate name for a file to be added to server content.
 
-            # Open file for reading when path has been validated.
-            if isfile(path):
-                file = open(path, "rb")
-                return file, getsize(path)
-            else:
-                # Was a directory path
-                return None, None
+        :param filename:    Requested file name.
+        :return:            Sanitized file name.
+        :raises ValidationError:    If name is not a valid file name.
+        """
+        san_name = sanitize_filename(filename)
+        validate_filename(san_name)
 
+        path = abspath(join(CONTENT_PATH, san_name))
+        if not path.startswith(abspath(CONTENT_PATH) + sep):
+            raise ValidationError("Illegal filepath.")
+        return san_name
+
+    @staticmethod
+    def file_exists(san_name):
+        """ Whether server content already has file or directory with given name """
+        return exists(join(CONTENT_PATH, san_name))
+
+    @staticmethod
+    def create_partial_file():
+        """ Create temporary file for receiving content. Temporary file is
+        located in the same file system as content so that finished
+        file can be moved in place atomically.
+
+        :return:    Tuple of file object opened for writing and path of the file.
+        """
+        if not exists(PARTIAL_PATH):
+            makedirs(PARTIAL_PATH)
+        handle, path = tempfile.mkstemp(suffix=".part", dir=PARTIAL_PATH)
+        return open(handle, "wb"), path
+
+    @staticmethod
+    async def commit_partial_file(partial_path, san_name, checksum=None):
+        """ Move finished temporary file into content directory. Content store
+        copies it into a blob in a worker thread.
+
+        :param partial_path:    Path of temporary file created with create_partial_file().
+        :param san_name:        Sanitized name for the file in content.
+        :param checksum:        SHA256 checksum of the file if known.
+        :raises FileExistsError:    If content already has a file with given name.
+        """
+        if ServerFileHandler.file_exists(san_name):
+            raise FileExistsError("File %s already exists." % san_name)
+        replace(partial_path, join(CONTENT_PATH, san_name))
+        ServerFileHandler.invalidate_index()
+        if ServerFileHandler.__cache:
+            ServerFileHandler.__cache.invalidate(san_name)
+
+        if ServerFileHandler.__store and checksum:
+            await asyncio.get_event_loop().run_in_executor(None, ServerFileHandler.__store.add,
+                                                           san_name, checksum)
+
+    @staticmethod
+    def discard_partial_file(partial_path):
+        """ Remove unfinished temporary file """
+        if partial_path and exists(partial_path):
+            remove(partial_path)
+
+    @staticmethod
+    def get_block_hashes(san_name, compute=True):
+        """ Get per block hashes and Merkle root of content file. Hashes are
+        cached next to content and recomputed when file changes.
+
+        :param san_name:    Sanitized path of the file.
+        :param compute:     Whether to compute hashes if there are none cached.
+        :return:            Dictionary with 'block_size', 'size', 'root' and 'hashes'
+                            as hex strings, or None if file is not found or not cached.
+        """
+        path = join(CONTENT_PATH, san_name)
+        cache = join(BLOCKS_PATH, san_name + ".json")
+        try:
+            st = stat(path)
+        except OSError:
+            return None
+
+        block_size = int(Cfg.get_turms_val("MerkleBlockSize", merkle.DEFAULT_BLOCK_SIZE))
+        try:
+            with open(cache, "r") as f:
+                entry = json.load(f)
+            if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns \
+                    and entry["block_size"] == block_size:
+                return entry
+        except (OSError, ValueError, KeyError):
+            pass
 
+        if not compute:
+            return None
 
+        with open(path, "rb") as f:
+            leaves = merkle.block_hashes(f, block_size)
+        entry = {"block_size": block_size,
+                 "size": st.st_size,
+                 "mtime": st.st_mtime_ns,
+                 "root": merkle.merkle_root(leaves).hex(),
+                 "hashes": [leaf.hex() for leaf in leaves]}
 
+        if not exists(dirname(cache)):
+            makedirs(dirname(cache))
+        handle, tmp = tempfile.mkstemp(suffix=".tmp", dir=dirname(cache))
+        with open(handle, "w") as f:
+            json.dump(entry, f)
+        replace(tmp, cache)
+        return entry
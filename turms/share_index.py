@@ -0,0 +1,245 @@
+#   --- Turms ---
+#   Compact in-memory index of shared
+#   directory tree for resolving paths
+#   and listing directories.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+from array import array
+from os import scandir, stat
+
+# Size column value of directories
+DIRECTORY = -1
+
+
+class ShareIndex:
+    """ Index of every file and directory under share root.
+
+    Entries are kept in depth first order in columns of typed arrays instead
+    of an object per entry, so that millions of entries take some tens of
+    bytes each. Entry 0 is the share root. Descendants of entry i are entries
+    i + 1 ... subtree end of i, and children of each directory are kept
+    sorted by name in one flat array for binary search.
+
+    Path components are interned into single byte pool, so names repeated
+    in many directories are stored only once.
+    """
+
+    __parent = None
+    __name_id = None
+    __size = None
+    __mtime = None
+    __end = None
+
+    # Children of directory i are __children[__child_start[i]:__child_start[i + 1]]
+    __child_start = None
+    __children = None
+
+    # UTF-8 names, name n is __pool[__offsets[n]:__offsets[n + 1]]
+    __pool = None
+    __offsets = None
+
+    def __init__(self):
+        self.__parent = array("i")
+        self.__name_id = array("I")
+        self.__size = array("q")
+        self.__mtime = array("q")
+        self.__end = array("I")
+        self.__child_start = array("I")
+        self.__children = array("I")
+        self.__pool = bytearray()
+        self.__offsets = array("Q", [0])
+
+    @staticmethod
+    def build(root, exclude=()):
+        """ Walk directory tree and index it. Symbolic links are not followed
+        nor indexed, so nothing outside of root can be reached through index.
+
+        :param root:    Share root directory.
+        :param exclude: Names of top level entries to leave out.
+        :return:        New ShareIndex.
+        """
+        index = ShareIndex()
+        interned = {}
+        index.__append(interned, "", -1, DIRECTORY, stat(root).st_mtime_ns)
+
+        stack = [(0, iter(ShareIndex.__scan(root)))]
+        while stack:
+            parent, entries = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                index.__end[parent] = len(index.__size)
+                stack.pop()
+                continue
+
+            try:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if parent == 0 and entry.name in exclude:
+                        continue
+                    i = index.__append(interned, entry.name, parent, DIRECTORY,
+                                       entry.stat(follow_symlinks=False).st_mtime_ns)
+                    stack.append((i, iter(ShareIndex.__scan(entry.path))))
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    i = index.__append(interned, entry.name, parent, st.st_size, st.st_mtime_ns)
+                    index.__end[i] = i + 1
+            except OSError:
+                # Removed while walking.
+                continue
+
+        index.__link_children()
+        return index
+
+    @staticmethod
+    def __scan(path):
+        """ Directory entries sorted by name, none if directory can't be read """
+        try:
+            with scandir(path) as it:
+                return sorted(it, key=lambda e: e.name)
+        except OSError:
+            return []
+
+    def __append(self, interned, name, parent, size, mtime):
+        """ Add entry to the end of columns and return its index """
+        name_id = interned.get(name)
+        if name_id is None:
+            name_id = len(self.__offsets) - 1
+            interned[name] = name_id
+            self.__pool += name.encode("utf-8", "surrogateescape")
+            self.__offsets.append(len(self.__pool))
+
+        self.__parent.append(parent)
+        self.__name_id.append(name_id)
+        self.__size.append(size)
+        self.__mtime.append(mtime)
+        self.__end.append(0)
+        return len(self.__size) - 1
+
+    def __link_children(self):
+        """ Collect children of every directory into flat array. Entries are in
+        depth first order with sorted siblings, so children end up sorted too. """
+        count = len(self.__size)
+        start = array("I", bytes(4 * (count + 1)))
+        for i in range(1, count):
+            start[self.__parent[i] + 1] += 1
+        for i in range(count):
+            start[i + 1] += start[i]
+
+        children = array("I", bytes(4 * max(count - 1, 0)))
+        fill = array("I", start)
+        for i in range(1, count):
+            p = self.__parent[i]
+            children[fill[p]] = i
+            fill[p] += 1
+
+        self.__child_start = start
+        self.__children = children
+
+    def __len__(self):
+        return len(self.__size)
+
+    def name_bytes(self, i):
+        """ UTF-8 encoded name of entry """
+        name_id = self.__name_id[i]
+        return bytes(self.__pool[self.__offsets[name_id]:self.__offsets[name_id + 1]])
+
+    def name(self, i):
+        """ Name of entry """
+        return self.name_bytes(i).decode("utf-8", "surrogateescape")
+
+    def is_dir(self, i):
+        """ Whether entry is a directory """
+        return self.__size[i] == DIRECTORY
+
+    def size(self, i):
+        """ Size of file entry in bytes, DIRECTORY for directories """
+        return self.__size[i]
+
+    def mtime(self, i):
+        """ Modification time of entry in nanoseconds """
+        return self.__mtime[i]
+
+    def path(self, i):
+        """ Path of entry relative to share root, components separated by '/' """
+        parts = []
+        while i > 0:
+            parts.append(self.name(i))
+            i = self.__parent[i]
+        return "/".join(reversed(parts))
+
+    def children(self, i):
+        """ Indexes of children of directory entry in name order """
+        return self.__children[self.__child_start[i]:self.__child_start[i + 1]]
+
+    def child(self, i, name):
+        """ Find child of directory entry by name with binary search.
+
+        :return:    Index of child or None if there is none.
+        """
+        children = self.__children
+        key = name.encode("utf-8", "surrogateescape")
+
+        # UTF-8 bytes sort in the same order as the names.
+        low, high = self.__child_start[i], self.__child_start[i + 1]
+        end = high
+        while low < high:
+            mid = (low + high) // 2
+            if self.name_bytes(children[mid]) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < end and self.name_bytes(children[low]) == key:
+            return children[low]
+        return None
+
+    def lookup(self, path):
+        """ Find entry by path relative to share root.
+
+        :param path:    Path with components separated by '/', empty for root.
+        :return:        Index of entry or None if not found.
+        """
+        i = 0
+        for part in path.split("/"):
+            if not part:
+                continue
+            if not self.is_dir(i):
+                return None
+            i = self.child(i, part)
+            if i is None:
+                return None
+        return i
+
+    def subtree(self, i):
+        """ Indexes of all descendants of entry in depth first order """
+        return range(i + 1, self.__end[i])
+
+    def walk(self, i):
+        """ Descendants of directory entry with paths relative to it, in depth
+        first order. Directory paths end with '/'.
+
+        :param i:   Directory entry.
+        :return:    Iterator of tuples of entry index and path.
+        """
+        # Prefixes of directories being walked through and where their subtrees end.
+        prefixes = []
+        for c in self.subtree(i):
+            while prefixes and c >= prefixes[-1][0]:
+                prefixes.pop()
+            name = (prefixes[-1][1] if prefixes else "") + self.name(c)
+            if self.is_dir(c):
+                name += "/"
+                prefixes.append((self.__end[c], name))
+            yield c, name
+
+    def listing(self, i, recursive=False):
+        """ Names of entries in directory entry. Directories end with '/'.
+
+        :param i:           Directory entry.
+        :param recursive:   List whole subtree with paths relative to the directory.
+        :return:            List of names.
+        """
+        if not recursive:
+            return [self.name(c) + ("/" if self.is_dir(c) else "") for c in self.children(i)]
+        return [name for _, name in self.walk(i)]
@@ -0,0 +1,356 @@
+#   --- Turms ---
+#   Soak test running mixed traffic against
+#   a local server for hours and tracking
+#   growth of memory, file descriptors and
+#   connections.
+#
+#   Sipi Ylä-Nojonen, 2022
+#
+#   Usage: python soak.py [--hours 4] [--interval 60] [--warmup 600] [--clients 8]
+#                         [--samples FILE] [--output FILE]
+#
+#   Server runs in its own process in a temporary directory with its logger
+#   writing to files as in the application. Clients download with the same
+#   code as the application, see loadgen.py. Both processes sample their RSS,
+#   open file descriptors, sockets, threads, asyncio tasks and memory traced
+#   by tracemalloc every interval. Once warmup is over, samples are compared
+#   to those right after it and metrics that keep growing are reported as
+#   leaks, with allocation sites that have grown the most since warmup.
+#   Exits with status 1 if a leak was found.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import eventloop
+import loadgen
+
+# Frames of traceback stored for each allocation.
+TRACE_FRAMES = 5
+# Allocation sites reported per sample.
+TOP_ALLOCATORS = 10
+
+# Growth from the first to the last third of samples after
+# warmup that is reported as a leak, in units of the metric.
+LEAK_THRESHOLDS = {"rss": 32 * 1024 ** 2,
+                   "traced": 16 * 1024 ** 2,
+                   "fds": 16,
+                   "sockets": 16,
+                   "threads": 4,
+                   "tasks": 32}
+
+# Samples after warmup needed to tell trend from noise.
+MIN_TREND_SAMPLES = 6
+
+# Latencies of latest operations kept for percentiles, so
+# that results don't grow memory of the client process.
+RESULT_WINDOW = 10000
+
+
+def rss():
+    """ Resident set size of this process in bytes, None if not available """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def open_fds():
+    """ Tuple of open file descriptors and sockets among them, None if not available """
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None, None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(os.path.join("/proc/self/fd", fd)).startswith("socket:"):
+                sockets += 1
+        except OSError:
+            # Closed while listing.
+            continue
+    return len(fds), sockets
+
+
+class ResourceSampler:
+    """ Samples resource usage of this process in its event loop.
+
+    Memory allocations are traced from start. Snapshot taken once warmup
+    is over is the baseline later snapshots are compared to, so that
+    allocations of starting up are not counted as growth.
+    """
+
+    __interval = 60.0
+    __warmup = 600.0
+    __path = None
+    __start = 0.0
+    __baseline = None
+    __samples = None
+    __task = None
+
+    def __init__(self, interval, warmup, path=None):
+        """
+        :param interval:    Seconds between samples.
+        :param warmup:      Seconds before baseline is taken.
+        :param path:        File to append samples to as JSON lines.
+        """
+        self.__interval = interval
+        self.__warmup = warmup
+        self.__path = path
+        self.__samples = []
+
+    def start(self):
+        """ Start tracing allocations and sampling. Has to be called in event loop. """
+        tracemalloc.start(TRACE_FRAMES)
+        self.__start = time.monotonic()
+        self.__task = asyncio.get_event_loop().create_task(self.__run())
+
+    def stop(self):
+        """ Take final sample and stop """
+        if self.__task:
+            self.__task.cancel()
+            self.__task = None
+            self.sample()
+
+    def samples(self):
+        """ Return samples taken so far """
+        return list(self.__samples)
+
+    def sample(self):
+        """ Take a sample and write it to file.
+
+        :return:    Dictionary of metrics, with allocation sites grown
+                    most since warmup once it is over.
+        """
+        elapsed = time.monotonic() - self.__start
+        fds, sockets = open_fds()
+        sample = {"time": round(elapsed, 1),
+                  "rss": rss(),
+                  "fds": fds,
+                  "sockets": sockets,
+                  "threads": threading.active_count(),
+                  "tasks": len(asyncio.all_tasks()),
+                  "traced": tracemalloc.get_traced_memory()[0],
+                  "warm": elapsed >= self.__warmup}
+
+        if sample["warm"]:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),
+                 tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                 tracemalloc.Filter(False, "<unknown>")))
+            if self.__baseline is None:
+                self.__baseline = snapshot
+            stats = snapshot.compare_to(self.__baseline, "lineno")
+            sample["top"] = [{"where": "%s:%i" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                              "size_diff": stat.size_diff,
+                              "count_diff": stat.count_diff}
+                             for stat in stats[:TOP_ALLOCATORS] if stat.size_diff > 0]
+
+        self.__samples.append(sample)
+        if self.__path:
+            with open(self.__path, "a") as f:
+                f.write(json.dumps(sample) + "\n")
+        return sample
+
+    async def __run(self):
+        """ Sample every interval """
+        while True:
+            await asyncio.sleep(self.__interval)
+            self.sample()
+
+
+def read_samples(path):
+    """ Read samples written by ResourceSampler """
+    try:
+        with open(path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def trend(values, times):
+    """ Least squares slope of values over times, per hour """
+    n = len(values)
+    mean_t = sum(times) / n
+    mean_v = sum(values) / n
+    var = sum((t - mean_t) ** 2 for t in times)
+    if not var:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values)) / var * 3600
+
+
+def analyze(samples):
+    """ Find metrics that keep growing after warmup.
+
+    Metric is flagged when its average over the last third of samples is
+    higher than over the first third by more than its threshold and its
+    trend over all of them points up, so that a single spike doesn't count.
+
+    :return:    Dictionary of metric statistics, leaking metrics and
+                allocation sites grown most since warmup.
+    """
+    warm = [s for s in samples if s.get("warm")]
+    result = {"samples": len(samples), "metrics": {}, "leaks": [], "top_allocators": []}
+    if warm:
+        result["top_allocators"] = warm[-1].get("top", [])
+
+    for metric, threshold in LEAK_THRESHOLDS.items():
+        points = [(s["time"], s[metric]) for s in warm if s.get(metric) is not None]
+        if not points:
+            continue
+        times = [t for t, _ in points]
+        values = [v for _, v in points]
+        third = max(1, len(values) // 3)
+        growth = sum(values[-third:]) / third - sum(values[:third]) / third
+        per_hour = trend(values, times)
+        leak = len(values) >= MIN_TREND_SAMPLES and growth > threshold and per_hour > 0
+        result["metrics"][metric] = {"first": values[0], "last": values[-1], "max": max(values),
+                                     "growth": round(growth, 1), "per_hour": round(per_hour, 1),
+                                     "leak": leak}
+        if leak:
+            result["leaks"].append(metric)
+    return result
+
+
+def serve(password, timeout, interval, warmup, path):
+    """ Run server with logging and resource sampling in this process """
+    from logger import TurmsLogger as Logger
+
+    Logger.create_logger()
+    sampler = ResourceSampler(interval, warmup, path)
+    loadgen.serve(password, timeout, sampler.start)
+
+
+def progress(elapsed, results, client, server):
+    """ Print one line of progress to standard error """
+    def usage(sample):
+        if not sample:
+            return "-"
+        return "rss %.1f MB, %s fds, %s sockets, %i tasks" % ((sample["rss"] or 0) / 1024 ** 2, sample["fds"],
+                                                           sample["sockets"], sample["tasks"])
+
+    hours, rest = divmod(int(elapsed), 3600)
+    print("[%i:%02i:%02i] %i requests, %i errors | server %s | client %s"
+          % (hours, rest // 60, rest % 60, sum(results.count.values()), sum(results.errors.values()),
+             usage(server), usage(client)), file=sys.stderr)
+
+
+async def run_soak(args, port, files, mix, server_samples):
+    """ Run traffic until deadline while sampling this process """
+    sampler = ResourceSampler(args.interval, args.warmup)
+    sampler.start()
+    results = loadgen.Results(RESULT_WINDOW)
+    start = time.monotonic()
+    deadline = start + args.hours * 3600
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.interval)
+            samples = sampler.samples()
+            server = read_samples(server_samples)
+            progress(time.monotonic() - start, results, samples[-1] if samples else None,
+                     server[-1] if server else None)
+
+    reporter = asyncio.get_event_loop().create_task(report())
+    try:
+        await asyncio.gather(*(loadgen.client(i, port, args.password, files, mix, deadline, 0, results,
+                                              random.Random("%s-%i" % (args.seed, i)))
+                               for i in range(args.clients)))
+    finally:
+        reporter.cancel()
+        sampler.stop()
+    return results.summary(time.monotonic() - start, args.clients), sampler.samples()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run traffic against a local server for hours and report leaks.")
+    parser.add_argument("--hours", type=float, default=4.0, help="Hours to run.")
+    parser.add_argument("--interval", type=float, default=60.0, help="Seconds between resource samples.")
+    parser.add_argument("--warmup", type=float, default=600.0,
+                        help="Seconds before growth is measured, caches and pools fill up meanwhile.")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent simulated clients.")
+    parser.add_argument("--files", type=int, default=200, help="Files in generated dataset.")
+    parser.add_argument("--sizes", default=loadgen.DEFAULT_SIZES, help="File size distribution as size:weight pairs.")
+    parser.add_argument("--mix", default=loadgen.DEFAULT_MIX, help="Operation mix as operation:weight pairs.")
+    parser.add_argument("--password", default="soak", help="Encryption password of the server.")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override configuration value of server and clients, can be repeated.")
+    parser.add_argument("--seed", default="turms", help="Seed of dataset and operation choices.")
+    parser.add_argument("--samples", help="Write samples of both processes to file as JSON lines.")
+    parser.add_argument("--output", help="Write report to file instead of standard output.")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.password, args.hours * 3600 + 3600, args.interval, args.warmup, args.serve)
+        return
+
+    if args.hours <= 0 or args.interval <= 0:
+        parser.error("Duration and interval have to be positive.")
+    sizes = loadgen.parse_weights(args.sizes, loadgen.parse_size)
+    mix = loadgen.parse_weights(args.mix)
+    for op, _ in mix:
+        if op not in loadgen.OPERATIONS:
+            parser.error("Unknown operation '%s'." % op)
+
+    output = os.path.abspath(args.output) if args.output else None
+    samples_path = os.path.abspath(args.samples) if args.samples else None
+    here = os.path.dirname(os.path.abspath(__file__))
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        port = loadgen.free_port()
+        loadgen.write_config(port, args.set)
+        files = loadgen.generate_dataset(args.files, sizes, random.Random(args.seed))
+        server_samples = os.path.join(workdir, "server-samples.jsonl")
+
+        # Server logs to files in working directory, console output is not needed.
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([here, os.environ.get("PYTHONPATH", "")]))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", server_samples,
+                                    "--password", args.password, "--hours", str(args.hours),
+                                    "--interval", str(args.interval), "--warmup", str(args.warmup)],
+                                   cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            loadgen.wait_for_port(port, process)
+            used = eventloop.install_event_loop()
+            traffic, client_samples = asyncio.run(run_soak(args, port, files, mix, server_samples))
+        finally:
+            process.terminate()
+            process.wait()
+            os.chdir(here)
+        server_samples = read_samples(server_samples)
+
+    if samples_path:
+        with open(samples_path, "w") as f:
+            for name, samples in (("server", server_samples), ("client", client_samples)):
+                for sample in samples:
+                    f.write(json.dumps(dict(sample, process=name)) + "\n")
+
+    report = {"hours": args.hours,
+              "event_loop": used,
+              "traffic": traffic,
+              "server": analyze(server_samples),
+              "client": analyze(client_samples)}
+    report["leaks"] = ["server.%s" % m for m in report["server"]["leaks"]] + \
+                      ["client.%s" % m for m in report["client"]["leaks"]]
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if report["leaks"] else 0)
+
+
+if __name__ == "__main__":
+    main()
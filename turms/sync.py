@@ -0,0 +1,140 @@
+#   --- Turms ---
+#   Mirroring a directory of server content
+#   into a local directory by downloading
+#   only new and changed files.
+#
+#   Sipi Ylä-Nojonen, 2022
+#
+#   Server lists every file under the directory in a single manifest with
+#   sizes, modification times and checksums it has cached. Local file is up
+#   to date when catalog of downloads has the same checksum for it, or when
+#   there is no checksum to compare and its size and modification time are
+#   the same as on server. Synced files are given modification time of the
+#   server file for that reason. Local files missing from server are kept.
+
+from os import makedirs, stat, utime
+from os.path import abspath, dirname, join
+import json
+
+import pathvalidate
+from pathvalidate import sanitize_filename, validate_filename
+
+from logger import TurmsLogger as Logger
+
+
+class ManifestEntry:
+    """ File listed in manifest of a server directory """
+
+    __slots__ = ("path", "size", "mtime", "checksum")
+
+    def __init__(self, path, size, mtime, checksum):
+        """
+        :param path:        Path relative to the directory, components separated by '/'.
+        :param size:        Size in bytes.
+        :param mtime:       Modification time on server in nanoseconds.
+        :param checksum:    Base64 encoded checksum, None if server didn't have it cached.
+        """
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.checksum = checksum
+
+
+def parse_manifest(body):
+    """ Read files from manifest sent by server. Files with paths that
+    don't sanitize to themselves or with malformed fields are left out,
+    so that nothing is ever written outside of sync directory.
+
+    :param body:    Manifest as JSON, already decompressed.
+    :return:        List of ManifestEntry.
+    :raises ValueError: If body is not a manifest.
+    """
+    manifest = json.loads(body)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("files"), list):
+        raise ValueError("Response is not a manifest.")
+
+    entries = []
+    for item in manifest["files"]:
+        try:
+            parts = item["path"].split("/")
+            for part in parts:
+                validate_filename(part)
+                if part != sanitize_filename(part) or part in (".", ".."):
+                    raise pathvalidate.ValidationError("Illegal filepath.")
+            size, mtime, checksum = item["size"], item["mtime"], item["checksum"]
+            if not isinstance(size, int) or not isinstance(mtime, int) or size < 0 \
+                    or not (checksum is None or isinstance(checksum, str)):
+                raise TypeError("Malformed manifest entry.")
+        except (pathvalidate.ValidationError, AttributeError, KeyError, TypeError):
+            Logger.warning("Ignoring invalid file %s in manifest." % str(item)[:200])
+            continue
+        entries.append(ManifestEntry("/".join(parts), size, mtime, checksum))
+    return entries
+
+
+def local_location(directory, path):
+    """ Location of a manifest file in local sync directory """
+    return join(directory, *path.split("/"))
+
+
+def is_up_to_date(entry, location, recorded=None):
+    """ Whether local file at location is the same version as file on server.
+
+    :param entry:       ManifestEntry of the file.
+    :param location:    Local file.
+    :param recorded:    Files recorded in DownloadCatalog, from its recorded().
+    """
+    try:
+        st = stat(location)
+    except OSError:
+        return False
+    if st.st_size != entry.size:
+        return False
+
+    # Checksum of a verified download tells for sure, unless file
+    # has been modified after it was downloaded.
+    known = recorded.get(abspath(location)) if recorded and entry.checksum else None
+    if known and known[1:] == (st.st_size, st.st_mtime_ns):
+        return known[0] == entry.checksum
+    return st.st_mtime_ns == entry.mtime
+
+
+def plan_sync(entries, directory, catalog=None):
+    """ Find files that are new or changed on server.
+
+    :param entries:     List of ManifestEntry.
+    :param directory:   Local sync directory.
+    :param catalog:     DownloadCatalog to compare checksums with, if in use.
+    :return:            List of tuples of ManifestEntry and local location to download.
+    """
+    recorded = catalog.recorded() if catalog else None
+    planned = []
+    for entry in entries:
+        location = local_location(directory, entry.path)
+        if not is_up_to_date(entry, location, recorded):
+            planned.append((entry, location))
+    return planned
+
+
+def prepare_location(location):
+    """ Create directories of a local location to download into """
+    makedirs(dirname(location) or ".", exist_ok=True)
+
+
+def mark_synced(entry, location, catalog=None):
+    """ Give downloaded file modification time of the server file so that
+    it is found up to date next time, and keep its catalog entry valid.
+
+    :param entry:       ManifestEntry of the file.
+    :param location:    Local file.
+    :param catalog:     DownloadCatalog the download was recorded in, if in use.
+    """
+    # Checksum recorded on download is of the version actually received.
+    # Download was recorded through another catalog object, read it again.
+    checksum = None
+    if catalog:
+        catalog.load()
+        checksum = catalog.checksum_of(location)
+    utime(location, ns=(stat(location).st_atime_ns, entry.mtime))
+    if checksum:
+        catalog.record(checksum, location)
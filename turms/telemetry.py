@@ -0,0 +1,177 @@
+#   --- Turms ---
+#   Throughput, ETA and progress
+#   statistics of a single transfer.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import time
+
+# Seconds between throughput samples and weight
+# of the newest sample in the moving average.
+SAMPLE_INTERVAL = 0.5
+SMOOTHING = 0.3
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+
+def format_size(size):
+    """ Human readable size, f.e. '4.2 MB' """
+    size = float(size)
+    for unit in SIZE_UNITS[:-1]:
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f %s" % (size, SIZE_UNITS[-1])
+
+
+def format_duration(seconds):
+    """ Duration as 'h:mm:ss' or 'm:ss' """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "%i:%02i:%02i" % (hours, minutes, seconds)
+    return "%i:%02i" % (minutes, seconds)
+
+
+class TransferStats:
+    """ Statistics of a single transfer. Throughput is an exponentially
+    weighted moving average of rates sampled every SAMPLE_INTERVAL
+    seconds, so that it follows changes in speed without jumping
+    around with every chunk. Time transfer is paused is not counted.
+    """
+
+    __name = None
+    __clock = None
+
+    # Size of the file, bytes of it done, bytes received from
+    # network and bytes received but not yet written to file.
+    __total = 0
+    __done = 0
+    __received = 0
+    __in_flight = 0
+
+    # Seconds spent transferring before current run and
+    # clock time current run started at, None if stopped.
+    __elapsed = 0.0
+    __since = None
+
+    # Moving average in bytes per second and current sample window.
+    __rate = None
+    __window_start = 0.0
+    __window_bytes = 0
+
+    def __init__(self, name, clock=time.monotonic):
+        """
+        :param name:    Name of the transfer shown in status lines.
+        :param clock:   Function returning current time in seconds.
+        """
+        self.__name = name
+        self.__clock = clock
+
+    def start(self):
+        """ Start timing a run of the transfer. Moving average starts
+        over, since speed of earlier run doesn't tell much of this one. """
+        if self.__since is not None:
+            return
+        self.__since = self.__clock()
+        self.__window_start = self.__since
+        self.__window_bytes = 0
+        self.__rate = None
+        self.__in_flight = 0
+
+    def stop(self):
+        """ Stop timing, f.e. when transfer is paused or finished """
+        if self.__since is None:
+            return
+        self.__elapsed += self.__clock() - self.__since
+        self.__since = None
+        self.__in_flight = 0
+
+    def set_total(self, total):
+        """ Set size of the transferred file """
+        self.__total = max(0, int(total))
+
+    def update(self, received, done, in_flight=0):
+        """ Record a received chunk.
+
+        :param received:    Bytes received from network in the chunk.
+        :param done:        Bytes of the file done after the chunk.
+        :param in_flight:   Bytes received but not yet written to file.
+        """
+        self.start()
+        self.__received += received
+        self.__window_bytes += received
+        self.__done = done
+        self.__in_flight = in_flight
+        self.__sample(self.__clock())
+
+    def __sample(self, now):
+        """ Fold rate of the current window into moving average once window is long enough """
+        length = now - self.__window_start
+        if length < SAMPLE_INTERVAL:
+            return
+        rate = self.__window_bytes / length
+        if self.__rate is None:
+            self.__rate = rate
+        else:
+            self.__rate = SMOOTHING * rate + (1 - SMOOTHING) * self.__rate
+        self.__window_start = now
+        self.__window_bytes = 0
+
+    def get_name(self):
+        """ Return name of the transfer """
+        return self.__name
+
+    def get_total(self):
+        """ Return size of the file, 0 if not known """
+        return self.__total
+
+    def get_done(self):
+        """ Return bytes of the file done """
+        return self.__done
+
+    def in_flight(self):
+        """ Bytes received but not yet written to file """
+        return self.__in_flight
+
+    def elapsed(self):
+        """ Seconds spent transferring """
+        if self.__since is None:
+            return self.__elapsed
+        return self.__elapsed + self.__clock() - self.__since
+
+    def rate(self):
+        """ Moving average of throughput in bytes per second. Stalled
+        transfer slows average down even when no chunks arrive. """
+        if self.__since is not None:
+            self.__sample(self.__clock())
+        return self.__rate or 0.0
+
+    def fraction(self):
+        """ Done part of the file between 0 and 1, None if size is not known """
+        if not self.__total:
+            return None
+        return min(1.0, self.__done / self.__total)
+
+    def eta(self):
+        """ Estimated seconds until transfer finishes, None if it can't be estimated """
+        rate = self.rate()
+        if not self.__total or not rate:
+            return None
+        return max(0, self.__total - self.__done) / rate
+
+    def status(self):
+        """ One line status of transfer in progress """
+        fraction = self.fraction()
+        done = "%0.1f%%" % (fraction * 100) if fraction is not None else format_size(self.__done)
+        eta = self.eta()
+        return "%s %s %s/s ETA %s" % (self.__name, done, format_size(self.rate()),
+                                      format_duration(eta) if eta is not None else "-")
+
+    def summary(self):
+        """ One line summary of finished transfer """
+        elapsed = self.elapsed()
+        average = self.__received / elapsed if elapsed > 0 else 0
+        return "Downloaded %s: %s in %.1f s, average %s/s" % (self.__name, format_size(self.__done),
+                                                              elapsed, format_size(average))
@@ -0,0 +1,152 @@
+#   --- Turms ---
+#   Capturing timing, paths and sizes of
+#   server requests into a trace file
+#   for replaying them later.
+#
+#   Sipi Ylä-Nojonen, 2022
+#
+#   Trace is a text file with a header line and a line of tab separated
+#   fields for each request, in the order requests finished:
+#
+#       start  client  concurrency  method  status  duration  sent  filesize  range  path
+#
+#   Start is milliseconds since capture started and duration milliseconds
+#   the request took. Client is a number standing for remote address, so
+#   that addresses themselves are not stored. Concurrency is the amount of
+#   requests in progress when request started, including itself. Sizes are
+#   in bytes, status is 0 when client closed connection before response was
+#   finished and fields not known are '-'.
+
+import time
+from datetime import datetime
+
+from logger import TurmsLogger as Logger
+
+TRACE_VERSION = 1
+HEADER = "# turms-trace %i" % TRACE_VERSION
+FIELDS = ("start", "client", "concurrency", "method", "status", "duration", "sent", "filesize", "range", "path")
+
+# Trace is flushed to disk after this many requests, so that
+# little of it is lost if server is killed.
+FLUSH_INTERVAL = 100
+
+# Recorder requests are captured into, None when capture is off.
+RECORDER = None
+
+
+class TraceEntry:
+    """ Single request read from trace """
+
+    __slots__ = FIELDS
+
+    def __init__(self, line):
+        """
+        :param line:    Line of trace file.
+        :raises ValueError: If line is malformed.
+        """
+        values = line.rstrip("\n").split("\t")
+        if len(values) != len(FIELDS):
+            raise ValueError("Trace line has %i fields instead of %i." % (len(values), len(FIELDS)))
+        for name, value in zip(FIELDS, values):
+            if name in ("method", "range", "path"):
+                setattr(self, name, None if value == "-" else value)
+            else:
+                setattr(self, name, None if value == "-" else int(value))
+
+
+class TraceRecorder:
+    """ Writes a line to trace file for every finished request """
+
+    __file = None
+    __start = 0.0
+    __clients = None
+    __active = 0
+    __unflushed = 0
+
+    def __init__(self, path):
+        """
+        :param path:    Trace file, overwritten if it exists.
+        :raises OSError: If file can't be opened.
+        """
+        self.__file = open(path, "w", buffering=64 * 1024)
+        self.__file.write("%s %s\n" % (HEADER, datetime.now().isoformat(timespec="seconds")))
+        self.__file.flush()
+        self.__start = time.monotonic()
+        self.__clients = {}
+
+    def begin(self):
+        """ Mark request started.
+
+        :return:    Tuple of start time and concurrency to pass to end().
+        """
+        self.__active += 1
+        return time.monotonic(), self.__active
+
+    def end(self, begun, request, status, sent, filesize=None):
+        """ Write finished request to trace.
+
+        :param begun:       Value returned by begin() for the request.
+        :param request:     tornado.httputil.HTTPServerRequest.
+        :param status:      Response status, 0 if response wasn't finished.
+        :param sent:        Bytes of response body sent.
+        :param filesize:    Size of requested file, if any.
+        """
+        self.__active -= 1
+        if not self.__file:
+            return
+        started, concurrency = begun
+        client = self.__clients.setdefault(request.remote_ip, len(self.__clients))
+        values = (int((started - self.__start) * 1000), client, concurrency, request.method, status,
+                  int((time.monotonic() - started) * 1000), sent,
+                  "-" if filesize is None else filesize,
+                  request.headers.get("Range", "-").replace("\t", " "),
+                  request.path)
+        self.__file.write("\t".join(str(v) for v in values) + "\n")
+        self.__unflushed += 1
+        if self.__unflushed >= FLUSH_INTERVAL:
+            self.__file.flush()
+            self.__unflushed = 0
+
+    def close(self):
+        """ Flush and close trace file """
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+
+def start_capture(path):
+    """ Start capturing requests into trace file, replacing earlier capture. """
+    global RECORDER
+    stop_capture()
+    try:
+        RECORDER = TraceRecorder(path)
+        Logger.info("Capturing requests into %s." % path, "turms.server")
+    except OSError as e:
+        Logger.error("Cannot capture requests: %s" % e, "turms.server")
+
+
+def stop_capture():
+    """ Stop capturing and close trace file """
+    global RECORDER
+    if RECORDER:
+        RECORDER.close()
+        RECORDER = None
+
+
+def recorder():
+    """ Return active trace recorder or None """
+    return RECORDER
+
+
+def read_trace(path):
+    """ Read requests from trace file in order they started.
+
+    :raises ValueError: If file is not a trace or a line is malformed.
+    """
+    with open(path, "r") as f:
+        header = f.readline()
+        if not header.startswith(HEADER):
+            raise ValueError("%s is not a trace file of version %i." % (path, TRACE_VERSION))
+        entries = [TraceEntry(line) for line in f if line.strip()]
+    entries.sort(key=lambda e: e.start)
+    return entries
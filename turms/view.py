@@ -5,27 +5,144 @@
 #   Sipi Ylä-Nojonen, 2022
 
 import asyncio
+import collections
+import concurrent.futures
 import queue
 from queue import Empty
+import threading
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import simpledialog
 
-import pathvalidate
 from pathvalidate import sanitize_filename, validate_filename
 
 from logger import TurmsLogger as Logger
 from downloader import DEFAULT_DL_DIRECTORY
 
+class GuiDispatcher:
+    """ Hands calls over to thread running window mainloop. Tk widgets are only
+    used from that thread, so event loop thread posts GUI updates to it with
+    after() instead of calling widgets itself. Without a window, f.e. when
+    running without GUI, calls are made in calling thread.
+
+    Tkinter call from another thread waits until GUI thread has handled it.
+    Calls are therefore queued and GUI thread is woken up only once for all
+    calls queued before it gets to them, so that event loop seldom waits.
+    """
+
+    __window = None
+    __thread = None
+    __closed = False
+
+    # Calls waiting for GUI thread and whether it has been woken up for them.
+    __pending = collections.deque()
+    __lock = threading.Lock()
+    __scheduled = False
+
+    @staticmethod
+    def attach(window):
+        """ Route GUI calls to given window. Has to be called in thread running its mainloop. """
+        GuiDispatcher.__window = window
+        GuiDispatcher.__thread = threading.get_ident()
+        GuiDispatcher.__closed = False
+
+    @staticmethod
+    def close():
+        """ Drop GUI calls made after window has been closed """
+        GuiDispatcher.__closed = True
+
+    @staticmethod
+    def in_gui_thread():
+        """ Whether calling thread may use widgets directly """
+        return GuiDispatcher.__window is None or threading.get_ident() == GuiDispatcher.__thread
+
+    @staticmethod
+    def post(func, *args):
+        """ Call function in GUI thread without waiting for it.
+
+        :return:    False if call was dropped because window is closed.
+        """
+        if GuiDispatcher.__closed:
+            return False
+        if GuiDispatcher.in_gui_thread():
+            func(*args)
+            return True
+
+        with GuiDispatcher.__lock:
+            GuiDispatcher.__pending.append((func, args))
+            if GuiDispatcher.__scheduled:
+                return True
+            GuiDispatcher.__scheduled = True
+        try:
+            GuiDispatcher.__window.after(0, GuiDispatcher.__run_pending)
+        except (RuntimeError, tk.TclError):
+            # Mainloop has exited.
+            with GuiDispatcher.__lock:
+                GuiDispatcher.__pending.clear()
+                GuiDispatcher.__scheduled = False
+            return False
+        return True
+
+    @staticmethod
+    def __run_pending():
+        """ Make queued calls, in GUI thread """
+        with GuiDispatcher.__lock:
+            calls = list(GuiDispatcher.__pending)
+            GuiDispatcher.__pending.clear()
+            GuiDispatcher.__scheduled = False
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception as e:
+                Logger.error("GUI update failed: %s" % e)
+
+    @staticmethod
+    def submit(func, *args):
+        """ Call function in GUI thread.
+
+        :return:    concurrent.futures.Future of the result.
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        if not GuiDispatcher.post(run):
+            future.set_exception(RuntimeError("Application window has been closed."))
+        return future
+
+    @staticmethod
+    def call(func, *args):
+        """ Call function in GUI thread and wait for result. Blocks calling thread. """
+        return GuiDispatcher.submit(func, *args).result()
+
+    @staticmethod
+    async def ask(func, *args):
+        """ Call function in GUI thread and await result without blocking event loop,
+        f.e. to read input fields or show a dialog from a coroutine. """
+        return await asyncio.wrap_future(GuiDispatcher.submit(func, *args))
+
+
 class ConsoleQueue:
-    def __init__(self, queue_):
-        """ Initiate with specified widget for print output """
+    def __init__(self, queue_, notify=None):
+        """ Initiate with specified widget for print output
+
+        :param notify:  Function called after each write, f.e. to schedule printing it.
+        """
         self._target = queue_
+        self._notify = notify
 
     def write(self, string):
         """ Write function for redirectiong sys.stdout writes to Tkinter application"""
         if self._target:
             self._target.put(string)
+            if self._notify:
+                self._notify()
 
     def flush(self):
         pass
@@ -40,25 +157,30 @@ class ConsoleWriter:
         self._queue = queue.Queue()
         self.__listen = True
 
-    async def start_listener(self):
-        """ Start listening loop for GUI console output """
+    def start_listener(self):
+        """ Start printing GUI console output """
         self.__listen = True
-        await self.listener()
+        self.notify()
 
-    async def stop_listener(self):
-        """ Stop listening for GUI console output """
+    def stop_listener(self):
+        """ Stop printing GUI console output """
         self.__listen = False
 
-    async def listener(self):
+    def notify(self):
+        """ Schedule printing queued output in GUI thread. Can be called from any
+        thread. Output written before printing is done is printed with it. """
+        if self.__listen:
+            GuiDispatcher.post(self.listener)
+
+    def listener(self):
         """ Write function for outputting logging data to Tkinter GUI console """
         while self.__listen:
             try:
                 text = self._queue.get(block=False)
-
-                if self.__target:
-                    self.__target.insert_text(text)
             except Empty:
-                await asyncio.sleep(0.2)              # Return other tasks when queue is empty
+                return
+            if self.__target:
+                self.__target.insert_text(text)
 
     def queue(self):
         """ Return queue for log output """
@@ -80,12 +202,12 @@ class View(object):
         """ Creates or return write stream console for application """
         if not self.__console and not self.__pipe:
             self.__console = ConsoleWriter(widget)
-            self.__pipe = ConsoleQueue(self.__console.queue())
+            self.__pipe = ConsoleQueue(self.__console.queue(), self.__console.notify)
         return self.__pipe
 
-    async def start_listener(self):
+    def start_listener(self):
         """ Start printing out from GUI output queue. """
-        await self.__console.start_listener()
+        self.__console.start_listener()
 
     def stop_listener(self):
         """ Stop processing print out queue. """
@@ -94,43 +216,52 @@ class View(object):
     def state_to_connect(self):
         """ Change GUI to show 'connected to server' state """
         # When user presses "Connect" button
-        self.__widgets["connect"]["state"] = tk.DISABLED
-        self.__widgets["disconnect"]["state"] = tk.NORMAL
+        GuiDispatcher.post(self.__set_states, {"connect": tk.DISABLED, "disconnect": tk.NORMAL,
+                                               "upload": tk.NORMAL, "download": tk.NORMAL,
+                                               "pause": tk.NORMAL, "resume": tk.NORMAL,
+                                               "cancel": tk.NORMAL, "sync": tk.NORMAL})
 
     def state_to_disconnect(self):
         """ Change GUI to show 'not connected to server' state """
         # When user presses "Disconnect" button
-        self.__widgets["connect"]["state"] = tk.NORMAL
-        self.__widgets["disconnect"]["state"] = tk.DISABLED
+        GuiDispatcher.post(self.__set_states, {"connect": tk.NORMAL, "disconnect": tk.DISABLED,
+                                               "upload": tk.DISABLED, "download": tk.DISABLED,
+                                               "pause": tk.DISABLED, "resume": tk.DISABLED,
+                                               "cancel": tk.DISABLED, "sync": tk.DISABLED})
 
     def state_to_server_running(self):
         """ Change GUI to show 'server running' state """
-        self.__widgets["serverstop"]["state"] = tk.NORMAL
-        self.__widgets["serverstart"]["state"] = tk.DISABLED
+        GuiDispatcher.post(self.__set_states, {"serverstop": tk.NORMAL, "serverstart": tk.DISABLED})
 
     def state_to_server_stopped(self):
         """ Change GUI to show 'server not running' state """
-        self.__widgets["serverstart"]["state"] = tk.NORMAL
-        self.__widgets["serverstop"]["state"] = tk.DISABLED
+        GuiDispatcher.post(self.__set_states, {"serverstart": tk.NORMAL, "serverstop": tk.DISABLED})
+
+    def __set_states(self, states):
+        """ Set states of widgets by name, in GUI thread """
+        for name, state in states.items():
+            self.__widgets[name]["state"] = state
 
     def print_out_filetree(self, content):
         """
-        Prints out list of filenames to application GUI filetree view
+        Prints out list of filenames to application GUI filetree view.
+        Names are validated and rows updated in batches by the widget,
+        so this returns right away.
 
-        :param content:     List of strings representing filenames
+        :param content:     List of strings representing filenames. Directory
+                            names end with '/' and '../' is the parent directory.
         :return:            None
         """
-        tree = self.__widgets["filetree"]
-        tree.delete(*tree.get_children())
+        GuiDispatcher.post(self.__widgets["filetree"].update_items, content)
 
-        # Print out content to GUI
-        for i, item in enumerate(content):
-            try:
-                validate_filename(item)                 # Check that print is a valid filename
-                parsed = item
-                tree.insert("", tk.END, value=parsed)
-            except pathvalidate.ValidationError:
-                Logger.warning("Ignoring invalid filename in response.")
+    def print_out_progress(self, stats):
+        """
+        Shows progress of active downloads in application GUI.
+
+        :param stats:       List of TransferStats of active downloads.
+        :return:            None
+        """
+        GuiDispatcher.post(self.__widgets["progress"].show, stats)
 
     @staticmethod
     def prompt_save_location(filename):
@@ -152,15 +283,33 @@ class View(object):
             splitname.pop(-1)
             name = "".join(splitname)
 
-        return tk.filedialog.asksaveasfilename(defaultextension=extension,
-                                               initialdir=DEFAULT_DL_DIRECTORY,
-                                               initialfile=name)
+        return GuiDispatcher.call(lambda: tk.filedialog.asksaveasfilename(defaultextension=extension,
+                                                                          initialdir=DEFAULT_DL_DIRECTORY,
+                                                                          initialfile=name))
+
+    @staticmethod
+    def prompt_directory():
+        """ Prompt user for a directory to save several files in.
+
+        :return:    Path of chosen directory or empty string if cancelled.
+        """
+        return GuiDispatcher.call(lambda: tk.filedialog.askdirectory(initialdir=DEFAULT_DL_DIRECTORY))
+
+    @staticmethod
+    def prompt_open_file():
+        """ Prompt user for a file to open.
+
+        :return:    Path of chosen file or empty string if cancelled.
+        """
+        return GuiDispatcher.call(lambda: tk.filedialog.askopenfilename(initialdir=DEFAULT_DL_DIRECTORY))
 
     @staticmethod
     def prompt_input(msg, show=""):
         """ Prompt user for string input.
 
+        Can be called from any thread, dialog is shown in GUI thread.
+
         :param msg:     Message to prompt user with
         :param show:    Characters to show in place of input
         """
-        return simpledialog.askstring(title="Server", prompt=msg, show=show)
+        return GuiDispatcher.call(lambda: simpledialog.askstring(title="Server", prompt=msg, show=show))
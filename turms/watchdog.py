@@ -0,0 +1,138 @@
+#   --- Turms ---
+#   Watchdog measuring lag of asyncio
+#   event loop and catching code that
+#   blocks it.
+#
+#   Sipi Ylä-Nojonen, 2022
+
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+
+from logger import TurmsLogger as Logger
+
+# Lag samples percentiles are computed from.
+SAMPLE_COUNT = 1000
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, pct):
+    """ Value below which given percentage of sorted samples fall """
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+    return samples[index]
+
+
+class LoopWatchdog:
+    """ Measures event loop lag and records stacks of blocking code.
+
+    A heartbeat task sleeps for a fixed interval and measures how late it
+    wakes up, which is the time loop spent running something else. Monitor
+    thread checks that heartbeat keeps beating. If loop doesn't get back to
+    it within threshold, stack of the loop thread is logged while the code
+    blocking it is still running.
+    """
+
+    __loop = None
+    __interval = 0.1
+    __threshold = 0.25
+    __report_interval = 60.0
+
+    __task = None
+    __thread = None
+    __loop_thread = None
+    __stop = None
+
+    # Monotonic time of last heartbeat and whether current stall was logged.
+    __beat = 0.0
+    __reported = False
+
+    __samples = None
+    __max_lag = 0.0
+    __stalls = 0
+
+    def __init__(self, interval=0.1, threshold=0.25, report_interval=60.0):
+        """
+        :param interval:        Seconds between heartbeats.
+        :param threshold:       Seconds loop may be blocked before its stack is logged.
+        :param report_interval: Seconds between logging lag percentiles, 0 to not log them.
+        """
+        self.__interval = interval
+        self.__threshold = threshold
+        self.__report_interval = report_interval
+        self.__samples = collections.deque(maxlen=SAMPLE_COUNT)
+        self.__stop = threading.Event()
+
+    def start(self):
+        """ Start watching event loop. Has to be called in event loop. """
+        self.__loop = asyncio.get_event_loop()
+        self.__loop_thread = threading.get_ident()
+        self.__beat = time.monotonic()
+        self.__stop.clear()
+        self.__task = self.__loop.create_task(self.__heartbeat())
+        self.__thread = threading.Thread(target=self.__monitor, daemon=True)
+        self.__thread.start()
+        Logger.info("Event loop watchdog started, threshold %.0f ms." % (self.__threshold * 1000))
+
+    def stop(self):
+        """ Stop watching and log lag statistics """
+        self.__stop.set()
+        if self.__task:
+            self.__task.cancel()
+            self.__task = None
+        self.report()
+
+    def percentiles(self):
+        """ Return lag percentiles of recent heartbeats in seconds.
+
+        :return:    Dictionary with 'p50', 'p95', 'p99', 'max' and 'stalls',
+                    amount of times loop was blocked past threshold.
+        """
+        samples = sorted(self.__samples)
+        result = {"p%i" % pct: percentile(samples, pct) for pct in PERCENTILES}
+        result["max"] = self.__max_lag
+        result["stalls"] = self.__stalls
+        return result
+
+    def report(self):
+        """ Log lag percentiles """
+        if not self.__samples:
+            return
+        stats = self.percentiles()
+        Logger.info("Event loop lag p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms, %i stalls."
+                    % (stats["p50"] * 1000, stats["p95"] * 1000, stats["p99"] * 1000,
+                       stats["max"] * 1000, stats["stalls"]))
+
+    async def __heartbeat(self):
+        """ Measure how late loop wakes up from sleep """
+        last_report = time.monotonic()
+        while not self.__stop.is_set():
+            start = time.monotonic()
+            await asyncio.sleep(self.__interval)
+            now = time.monotonic()
+            lag = max(0.0, now - start - self.__interval)
+            self.__samples.append(lag)
+            self.__max_lag = max(self.__max_lag, lag)
+            self.__beat = now
+            self.__reported = False
+
+            if self.__report_interval and now - last_report >= self.__report_interval:
+                self.report()
+                last_report = now
+
+    def __monitor(self):
+        """ Log stack of loop thread when heartbeat is late past threshold """
+        while not self.__stop.wait(self.__threshold / 4):
+            late = time.monotonic() - self.__beat - self.__interval
+            if late < self.__threshold or self.__reported:
+                continue
+            self.__reported = True
+            self.__stalls += 1
+
+            frame = sys._current_frames().get(self.__loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "Stack not available.\n"
+            Logger.warning("Event loop blocked for %.0f ms, running:\n%s" % (late * 1000, stack.rstrip()))